@@ -0,0 +1,431 @@
+"""
+Background IRT calibration of uploaded test results.
+
+An upload only stores the scored responses and queues a CalibrationJob. The
+IRT fit (irt_engine.py) and the write-back to Question.statistics happen
+here, outside the request. A job calibrates either one test's results, or (CALIBRATION_SCOPE =
+"course", or on demand) all results of a course pooled together, with each
+question's responses coming from every test that used it. Jobs run in a
+thread pool of the web process (CALIBRATION_EXECUTOR="thread") or in
+`manage.py run_calibration_worker` (CALIBRATION_EXECUTOR="worker").
+There is no broker: the job table is the queue, and a job is claimed by
+flipping it from pending to running with a conditional UPDATE, so any number
+of workers can poll it safely.
+"""
+import logging
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from itertools import islice
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+from scipy import sparse
+
+from .irt import ItemParameters, estimate_abilities
+from .irt_engine import MAX_ITERATIONS, IRTFitError, calibrate, initial_parameters, item_parameters
+from .item_analysis import analyze_items
+from .models import CalibrationJob, Question, Test, TestQuestion, TestResult, TestStatistics
+from .responses import load_result_matrices, unpack_rows
+
+logger = logging.getLogger(__name__)
+
+THREAD = 'thread'
+WORKER = 'worker'
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def save_question_statistics(questions):
+    """Write only the statistics column, in batched UPDATEs."""
+    Question.objects.bulk_update(
+        questions, ['statistics'], batch_size=settings.RESULTS_BULK_BATCH_SIZE
+    )
+
+
+def save_test_statistics(
+    test, question_ids: List[int], items: List[Dict], summary: Dict, irt: Optional[Dict] = None
+) -> TestStatistics:
+    """Store the item analysis of a test; items are in question_ids order."""
+    defaults = {
+        'num_students': summary['num_students'],
+        'num_items': summary['num_items'],
+        'mean_score': summary['mean_score'],
+        'sd_score': summary['sd_score'],
+        'kr20': summary['kr20'],
+        'cronbach_alpha': summary['cronbach_alpha'],
+        'sem': summary['sem'],
+        'items': {str(question_id): item for question_id, item in zip(question_ids, items)},
+    }
+    if irt is not None:
+        defaults['irt'] = irt
+    statistics, _ = TestStatistics.objects.update_or_create(test=test, defaults=defaults)
+    return statistics
+
+
+def save_abilities(test_id: int, parameters: ItemParameters, chunk_size: int = 2000) -> int:
+    """
+    Estimate and store the ability of every result of a test, a chunk of
+    results at a time.
+
+    Args:
+        test_id: Test whose results to score
+        parameters: Parameters of the test's questions, in answer order
+
+    Returns:
+        Number of results scored
+    """
+    num_questions = len(parameters.difficulty)
+    results = TestResult.objects.filter(test_id=test_id, answer_count=num_questions).order_by('id')
+    scored = 0
+    last_id = 0
+    # Keyset pagination rather than an open cursor, since each chunk is written back
+    while chunk := list(results.filter(id__gt=last_id).values_list('id', 'answer_bits')[:chunk_size]):
+        ids, answer_bits = zip(*chunk)
+        block = unpack_rows(answer_bits, num_questions)
+        theta, se = estimate_abilities(
+            sparse.csr_matrix(np.where(block > 0, 1, -1).astype('int8')), parameters, settings.IRT_ABILITY_METHOD
+        )
+        TestResult.objects.bulk_update(
+            [
+                TestResult(pk=pk, theta=float(t), theta_se=None if np.isnan(e) else float(e))
+                for pk, t, e in zip(ids, theta, se)
+            ],
+            ['theta', 'theta_se'],
+            batch_size=settings.RESULTS_BULK_BATCH_SIZE
+        )
+        scored += len(ids)
+        last_id = ids[-1]
+    return scored
+
+
+def enqueue_calibration(course, test=None, user=None) -> CalibrationJob:
+    """
+    Queue a calibration of a test's stored results or, without a test, a
+    pooled calibration of the whole course.
+
+    With the thread executor the job starts once the surrounding transaction
+    commits; otherwise it waits for a worker.
+    """
+    job = CalibrationJob.objects.create(
+        scope=CalibrationJob.TEST if test is not None else CalibrationJob.COURSE,
+        course=course,
+        test=test,
+        created_by=user
+    )
+    if settings.CALIBRATION_EXECUTOR == THREAD:
+        transaction.on_commit(lambda: _get_executor().submit(_run_in_thread, job.id))
+    return job
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.CALIBRATION_THREADS, thread_name_prefix='calibration'
+            )
+        return _executor
+
+
+def _run_in_thread(job_id: int):
+    try:
+        run_job(job_id)
+    finally:
+        # Threads of the pool outlive requests, so nothing else closes their connection
+        close_old_connections()
+
+
+def run_job(job_id: int) -> bool:
+    """
+    Claim and run one pending job.
+
+    Returns:
+        False if another worker claimed the job first
+    """
+    claimed = CalibrationJob.objects.filter(pk=job_id, status=CalibrationJob.PENDING).update(
+        status=CalibrationJob.RUNNING, started_at=timezone.now(), progress=0, stage='Starting'
+    )
+    if not claimed:
+        return False
+
+    job = CalibrationJob.objects.select_related('test', 'course').get(pk=job_id)
+
+    def report(progress: int, stage: str):
+        CalibrationJob.objects.filter(pk=job_id).update(progress=progress, stage=stage)
+
+    try:
+        if job.scope == CalibrationJob.COURSE:
+            result = calibrate_course(job.course, report)
+        else:
+            result = calibrate_test(job.test, report)
+    except Exception as e:
+        logger.exception("Calibration job %s failed", job_id)
+        CalibrationJob.objects.filter(pk=job_id).update(
+            status=CalibrationJob.FAILED, error=str(e), finished_at=timezone.now()
+        )
+    else:
+        CalibrationJob.objects.filter(pk=job_id).update(
+            status=CalibrationJob.COMPLETED, progress=100, stage='Done',
+            result=result, finished_at=timezone.now()
+        )
+    return True
+
+
+def run_pending_jobs(limit: Optional[int] = None) -> int:
+    """Run pending jobs oldest first; returns how many this process ran."""
+    job_ids = CalibrationJob.objects.filter(
+        status=CalibrationJob.PENDING
+    ).order_by('created_at').values_list('id', flat=True)
+    if limit:
+        job_ids = job_ids[:limit]
+    return sum(run_job(job_id) for job_id in list(job_ids))
+
+
+def requeue_stale_jobs(older_than: timedelta) -> int:
+    """Put back jobs left running by a worker that died."""
+    return CalibrationJob.objects.filter(
+        status=CalibrationJob.RUNNING, started_at__lt=timezone.now() - older_than
+    ).update(status=CalibrationJob.PENDING, stage='Requeued')
+
+
+def _fit_progress(report: Callable[[int, str], None], start: int, end: int) -> Callable[[str, int], None]:
+    """Report EM iterations of the candidate models as progress between start and end."""
+    models = list(settings.IRT_MODELS)
+
+    def on_iteration(model: str, iteration: int):
+        if iteration % 10 == 0:
+            done = (models.index(model) + min(iteration / MAX_ITERATIONS, 1)) / len(models)
+            report(start + int((end - start) * done), f'Fitting {model} model (iteration {iteration})')
+
+    return on_iteration
+
+
+def calibrate_test(test, report: Callable[[int, str], None] = lambda progress, stage: None) -> Dict:
+    """
+    Fit the IRT models on all stored results of a test, update the
+    statistics of its questions and the abilities of its results.
+
+    Classical statistics are always written; if no IRT model can be fitted
+    they are written with the error instead of IRT parameters, and the error
+    is kept in the test statistics and the job result.
+
+    Args:
+        test: Test to calibrate
+        report: Called with (percent, stage) as the calibration advances
+
+    Returns:
+        Summary stored as the job result
+    """
+    report(5, 'Loading responses')
+    questions = list(Question.objects.filter(test_questions__test=test).order_by('test_questions__order'))
+    num_questions = len(questions)
+    response_matrix, choices = load_result_matrices(TestResult.objects.filter(test=test), num_questions)
+    if not response_matrix.size:
+        raise ValueError('No stored responses match the questions of this test')
+
+    report(15, 'Item analysis')
+    classical, test_summary = analyze_items(response_matrix, choices)
+
+    report(25, 'Fitting IRT models')
+    responses = sparse.csr_matrix(np.where(response_matrix > 0, 1, -1).astype('int8'))
+    initial = initial_parameters([(question.statistics or {}).get('irt_parameters') for question in questions])
+    irt_error = None
+    try:
+        fit = calibrate(responses, initial, on_iteration=_fit_progress(report, 25, 85))
+    except IRTFitError as e:
+        logger.error("IRT calculation failed for test %s: %s", test.id, e)
+        irt_error = str(e)
+
+    abilities = 0
+    if irt_error is None:
+        report(85, 'Estimating abilities')
+        abilities = save_abilities(test.id, fit.parameters)
+
+    report(90, 'Saving statistics')
+    save_test_statistics(
+        test, [question.id for question in questions], classical, test_summary,
+        irt=fit.diagnostics if irt_error is None else {'error': irt_error}
+    )
+    last_updated = str(datetime.now())
+    for i, question in enumerate(questions):
+        if not question.statistics:
+            question.statistics = {}
+        new_stats = {
+            'classical_parameters': classical[i],
+            'last_updated': last_updated
+        }
+        if irt_error is None:
+            new_stats['irt_parameters'] = item_parameters(fit.parameters, i)
+            question.statistics.pop('error', None)
+        else:
+            new_stats['error'] = f'IRT calculation failed: {irt_error}'
+        question.statistics.update(new_stats)
+    save_question_statistics(questions)
+
+    result = {
+        'responses': len(response_matrix),
+        'questions': num_questions,
+        'irt_calculated': irt_error is None,
+        'model_used': fit.parameters.model if irt_error is None else None,
+        'kr20': test_summary['kr20'],
+        'abilities': abilities,
+    }
+    if irt_error is None:
+        result['irt_diagnostics'] = fit.diagnostics
+    else:
+        result['irt_error'] = irt_error
+    return result
+
+
+def course_test_questions(course) -> Dict[int, List[int]]:
+    """Question ids of every test of a course, in answer order."""
+    test_questions = defaultdict(list)
+    for test_id, question_id in TestQuestion.objects.filter(test__course=course).order_by(
+        'test_id', 'order', 'id'
+    ).values_list('test_id', 'question_id'):
+        test_questions[test_id].append(question_id)
+    return test_questions
+
+
+def build_course_response_matrix(
+    course,
+    test_questions: Optional[Dict[int, List[int]]] = None,
+    chunk_size: int = 2000
+) -> Tuple[sparse.csr_matrix, List[int], int]:
+    """
+    Assemble every stored result of a course into one sparse matrix.
+
+    Each TestResult is a participant row; each question used by any test of
+    the course is one item column, linked across tests through TestQuestion.
+    Stored entries are the administered responses, +1 correct / -1
+    incorrect, so a question only costs memory for the students who saw it.
+    Results are streamed per test in chunks.
+
+    Returns:
+        Tuple of (participants x items matrix, question id of each column,
+        number of tests that contributed results)
+    """
+    if test_questions is None:
+        test_questions = course_test_questions(course)
+    question_ids = []
+    column_of = {}
+    test_columns = {}
+    for test_id, test_question_ids in test_questions.items():
+        for question_id in test_question_ids:
+            if question_id not in column_of:
+                column_of[question_id] = len(question_ids)
+                question_ids.append(question_id)
+        test_columns[test_id] = [column_of[question_id] for question_id in test_question_ids]
+
+    rows, columns, values = [], [], []
+    participants = 0
+    tests = 0
+    for test_id, test_items in test_columns.items():
+        test_items = np.array(test_items, dtype='int32')
+        # Results uploaded before the test's questions changed no longer line up
+        packed_rows = TestResult.objects.filter(
+            test_id=test_id, answer_count=len(test_items)
+        ).values_list('answer_bits', flat=True).iterator(chunk_size=chunk_size)
+        contributed = False
+        while chunk := list(islice(packed_rows, chunk_size)):
+            block = unpack_rows(chunk, len(test_items))
+            rows.append(np.repeat(np.arange(participants, participants + len(block), dtype='int32'), len(test_items)))
+            columns.append(np.tile(test_items, len(block)))
+            values.append(np.where(block.ravel() > 0, 1, -1).astype('int8'))
+            participants += len(block)
+            contributed = True
+        tests += contributed
+
+    if not participants:
+        return sparse.csr_matrix((0, len(question_ids)), dtype='int8'), question_ids, 0
+    matrix = sparse.csr_matrix(
+        (np.concatenate(values), (np.concatenate(rows), np.concatenate(columns))),
+        shape=(participants, len(question_ids))
+    )
+    return matrix, question_ids, tests
+
+
+def calibrate_course(course, report: Callable[[int, str], None] = lambda progress, stage: None) -> Dict:
+    """
+    Calibrate all questions of a course jointly on every stored result.
+
+    Responses to questions a student's test did not contain are missing by
+    design, so they are left out of the likelihood instead of being counted
+    wrong. The pooled parameters go to statistics['pooled'] of each
+    question, next to the per-test ones that each upload overwrites, and
+    every result gets an ability on the pooled scale.
+
+    Args:
+        course: Course to calibrate
+        report: Called with (percent, stage) as the calibration advances
+
+    Returns:
+        Summary stored as the job result
+    """
+    report(5, 'Loading responses')
+    test_questions = course_test_questions(course)
+    responses, question_ids, tests = build_course_response_matrix(course, test_questions)
+    if not responses.nnz:
+        raise ValueError('No stored responses match the questions of this course')
+
+    questions = Question.objects.only('id', 'statistics').in_bulk(question_ids)
+    stored = [getattr(questions.get(question_id), 'statistics', None) or {} for question_id in question_ids]
+    initial = initial_parameters([statistics.get('pooled', {}).get('irt_parameters') for statistics in stored])
+
+    report(20, 'Fitting pooled IRT models')
+    calibration = calibrate(responses, initial, on_iteration=_fit_progress(report, 20, 85))
+    fit = calibration.parameters
+
+    report(85, 'Item analysis and abilities per test')
+    column_of = {question_id: column for column, question_id in enumerate(question_ids)}
+    abilities = 0
+    # Only the per-test records: per-test values in Question.statistics would overwrite each other
+    for test_id, test_question_ids in test_questions.items():
+        test_responses, test_choices = load_result_matrices(
+            TestResult.objects.filter(test_id=test_id), len(test_question_ids)
+        )
+        if len(test_responses):
+            items, summary = analyze_items(test_responses, test_choices)
+            save_test_statistics(Test(pk=test_id), test_question_ids, items, summary)
+            abilities += save_abilities(
+                test_id, fit.select([column_of[question_id] for question_id in test_question_ids])
+            )
+
+    report(90, 'Saving statistics')
+    last_updated = str(datetime.now())
+    updated_questions = []
+    for column, question_id in enumerate(question_ids):
+        question = questions.get(question_id)
+        if question is None or not fit.administered[column]:
+            continue
+        if not question.statistics:
+            question.statistics = {}
+        question.statistics['pooled'] = {
+            'irt_parameters': item_parameters(fit, column),
+            'classical_parameters': {
+                'p_value': float(fit.correct[column] / fit.administered[column]),
+                'total_responses': int(fit.administered[column]),
+                'correct_responses': int(fit.correct[column]),
+            },
+            'course_id': course.id,
+            'last_updated': last_updated
+        }
+        updated_questions.append(question)
+    save_question_statistics(updated_questions)
+
+    return {
+        'responses': int(responses.nnz),
+        'participants': responses.shape[0],
+        'questions': len(updated_questions),
+        'tests': tests,
+        'irt_calculated': True,
+        'model_used': fit.model,
+        'irt_diagnostics': calibration.diagnostics,
+        'abilities': abilities,
+    }
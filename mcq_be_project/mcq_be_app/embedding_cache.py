@@ -0,0 +1,140 @@
+"""
+Content-addressed cache of text embeddings.
+
+Embeddings are keyed by (model, hash of the normalized text), so the same
+text is encoded once whether it arrives as a bank question, as part of a
+raw test comparison, or as a draft being typed. Lookups go through a
+bounded in-process LRU first, then the database: the stored question
+embeddings, and, when EMBEDDING_CACHE_DB is enabled, a table of ad-hoc
+text embeddings.
+"""
+import hashlib
+import logging
+import re
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import Dict, Iterable
+
+import numpy as np
+
+from .models import CachedEmbedding, QuestionEmbedding
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_text(text: str) -> str:
+    """Canonical form used for hashing: NFC, trimmed, whitespace runs collapsed."""
+    return re.sub(r'\s+', ' ', unicodedata.normalize('NFC', text or '')).strip()
+
+
+def text_hash(text: str) -> str:
+    """sha256 of the normalized text."""
+    return hashlib.sha256(normalize_text(text).encode('utf-8')).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Two-tier embedding cache with hit/miss counters.
+
+    Counters are per process; `stats()` reports them for monitoring.
+    """
+
+    def __init__(self, max_entries: int = 20000, persist: bool = False):
+        """
+        Args:
+            max_entries: Capacity of the in-process LRU tier
+            persist: Also store and look up ad-hoc text embeddings in the database
+        """
+        self.max_entries = max_entries
+        self.persist = persist
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.database_hits = 0
+        self.misses = 0
+
+    def get_many(self, model_key: str, hashes: Iterable[str]) -> Dict[str, np.ndarray]:
+        """
+        Return the cached embeddings among the given text hashes.
+
+        Database hits are promoted to the in-process tier.
+        """
+        found = {}
+        missing = []
+        with self._lock:
+            for key in set(hashes):
+                vector = self._entries.get((model_key, key))
+                if vector is None:
+                    missing.append(key)
+                else:
+                    self._entries.move_to_end((model_key, key))
+                    found[key] = vector
+            self.memory_hits += len(found)
+
+        if missing:
+            from_database = self._load(model_key, missing)
+            self._remember(model_key, from_database)
+            found.update(from_database)
+            with self._lock:
+                self.database_hits += len(from_database)
+                self.misses += len(missing) - len(from_database)
+        return found
+
+    def put_many(self, model_key: str, vectors: Dict[str, np.ndarray]):
+        """Cache freshly encoded embeddings, keyed by text hash."""
+        self._remember(model_key, vectors)
+        if self.persist and vectors:
+            CachedEmbedding.objects.bulk_create(
+                [
+                    CachedEmbedding(
+                        model_name=model_key,
+                        text_hash=key,
+                        vector=np.asarray(vector, dtype='float32').tobytes()
+                    )
+                    for key, vector in vectors.items()
+                ],
+                ignore_conflicts=True
+            )
+
+    def _load(self, model_key: str, hashes: list) -> Dict[str, np.ndarray]:
+        try:
+            rows = list(
+                QuestionEmbedding.objects.filter(model_name=model_key, text_hash__in=hashes)
+                .values_list('text_hash', 'vector')
+            )
+            if self.persist:
+                rows += CachedEmbedding.objects.filter(
+                    model_name=model_key, text_hash__in=hashes
+                ).values_list('text_hash', 'vector')
+        except Exception:
+            # The cache must never fail an encode
+            logger.exception("Embedding cache lookup failed")
+            return {}
+        return {key: np.frombuffer(vector, dtype='float32') for key, vector in rows}
+
+    def _remember(self, model_key: str, vectors: Dict[str, np.ndarray]):
+        with self._lock:
+            for key, vector in vectors.items():
+                # Copy, so a cached row does not keep its whole batch alive
+                self._entries[(model_key, key)] = np.array(vector, dtype='float32')
+                self._entries.move_to_end((model_key, key))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            lookups = self.memory_hits + self.database_hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'persist': self.persist,
+                'memory_hits': self.memory_hits,
+                'database_hits': self.database_hits,
+                'misses': self.misses,
+                'hit_rate': round((lookups - self.misses) / lookups, 4) if lookups else 0.0
+            }
@@ -0,0 +1,475 @@
+"""
+Batched sentence embedding, in-process or through a shared worker pool.
+
+Request threads never call the model directly. Their encode requests go
+through an EmbeddingBatcher, which merges requests arriving within a few
+milliseconds of each other into one model call. By default the batcher
+runs the model in the web process (LocalEncoder). When
+EMBEDDING_SERVICE_ADDRESS is set, web processes instead send their texts
+to an EmbeddingServer (started with `manage.py run_embedding_server`),
+which holds one model copy per worker process, whatever the number of
+web processes.
+
+This module is imported by the spawned worker processes, so it must not
+touch Django models or settings at import time.
+"""
+import asyncio
+import glob
+import logging
+import os
+import platform
+import queue
+import shutil
+import threading
+import time
+from abc import ABC, abstractmethod
+from concurrent.futures import Future, ProcessPoolExecutor
+from multiprocessing import get_context
+from multiprocessing.connection import Client, Listener
+from typing import Callable, List, Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Inference backends: PyTorch, ONNX Runtime, and ONNX Runtime with
+# dynamically int8-quantized weights
+TORCH = 'torch'
+ONNX = 'onnx'
+ONNX_INT8 = 'onnx-int8'
+INFERENCE_BACKENDS = (TORCH, ONNX, ONNX_INT8)
+
+
+class EmbeddingServiceError(Exception):
+    """Raised when the embedding server fails to encode a request."""
+
+
+class EmbeddingBatcher:
+    """
+    Merges concurrent encode requests into batches.
+
+    A dispatcher thread takes the first pending request, waits up to
+    max_wait seconds for more to arrive (or until max_batch_size texts are
+    collected), then encodes them with one call. `encode` may return the
+    embeddings directly or a Future of them; with a Future, up to
+    max_in_flight batches are encoded concurrently.
+    """
+
+    def __init__(
+        self,
+        encode: Callable[[List[str]], object],
+        max_batch_size: int = 64,
+        max_wait: float = 0.005,
+        max_in_flight: int = 1
+    ):
+        self._encode = encode
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._queue = queue.Queue()
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, texts: List[str]) -> Future:
+        """Queue texts for encoding; the Future resolves to their float32 embeddings."""
+        future = Future()
+        self._queue.put((list(texts), future))
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(
+                        target=self._dispatch, name='embedding-batcher', daemon=True
+                    )
+                    self._thread.start()
+        return future
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        """Encode texts and wait for the result; large requests are split across batches."""
+        chunks = [
+            self.submit(texts[start:start + self.max_batch_size])
+            for start in range(0, len(texts), self.max_batch_size)
+        ]
+        return np.vstack([chunk.result() for chunk in chunks])
+
+    def _dispatch(self):
+        while True:
+            batch = [self._queue.get()]
+            size = len(batch[0][0])
+            deadline = time.monotonic() + self.max_wait
+            while size < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                batch.append(item)
+                size += len(item[0])
+
+            self._slots.acquire()
+            texts = [text for item_texts, _ in batch for text in item_texts]
+            try:
+                result = self._encode(texts)
+            except Exception as e:
+                result = Future()
+                result.set_exception(e)
+            if isinstance(result, Future):
+                result.add_done_callback(lambda done, batch=batch: self._deliver(batch, done))
+            else:
+                done = Future()
+                done.set_result(result)
+                self._deliver(batch, done)
+
+    def _deliver(self, batch, done: Future):
+        try:
+            try:
+                embeddings = np.asarray(done.result(), dtype='float32')
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                return
+            offset = 0
+            for texts, future in batch:
+                future.set_result(embeddings[offset:offset + len(texts)])
+                offset += len(texts)
+        finally:
+            self._slots.release()
+
+
+class BaseEncoder(ABC):
+    """Common interface of the local and remote encoders."""
+
+    dimension: int
+
+    @abstractmethod
+    def encode(self, texts: List[str]) -> np.ndarray:
+        """Encode texts into a float32 matrix, one row per text."""
+
+    async def encode_async(self, texts: List[str]) -> np.ndarray:
+        """Encode texts without blocking the event loop."""
+        return await asyncio.to_thread(self.encode, texts)
+
+
+class LocalEncoder(BaseEncoder):
+    """Runs the model in this process, one batch at a time."""
+
+    def __init__(self, load_model: Callable, max_batch_size: int = 64, max_wait: float = 0.005):
+        """
+        Args:
+            load_model: Returns the SentenceTransformer; called on first use
+        """
+        self._load_model = load_model
+        self.batcher = EmbeddingBatcher(self._encode_batch, max_batch_size, max_wait)
+
+    def _encode_batch(self, texts: List[str]) -> np.ndarray:
+        return self._load_model().encode(texts, convert_to_numpy=True)
+
+    @property
+    def dimension(self) -> int:
+        return self._load_model().get_sentence_embedding_dimension()
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        return self.batcher.encode(texts)
+
+
+class EmbeddingClient(BaseEncoder):
+    """
+    Sends encode requests to an EmbeddingServer.
+
+    Each thread keeps its own connection. If the server cannot be reached
+    the fallback encoder is used, so a stopped server degrades to
+    in-process encoding instead of failing requests.
+    """
+
+    def __init__(
+        self,
+        model_name: str,
+        address,
+        authkey: bytes,
+        fallback: Optional[BaseEncoder] = None,
+        timeout: float = 30
+    ):
+        self.model_name = model_name
+        self.address = address
+        self.authkey = authkey
+        self.fallback = fallback
+        self.timeout = timeout
+        self._local = threading.local()
+        self._dimension = None
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = Client(self.address, authkey=self.authkey)
+            self._local.connection = connection
+        return connection
+
+    def _drop_connection(self):
+        connection = getattr(self._local, 'connection', None)
+        self._local.connection = None
+        if connection is not None:
+            try:
+                connection.close()
+            except OSError:
+                pass
+
+    def _request(self, *request):
+        for attempt in range(2):
+            try:
+                connection = self._connection()
+                connection.send(request)
+                if not connection.poll(self.timeout):
+                    # The late reply would be read as the answer to the next request
+                    self._drop_connection()
+                    raise EmbeddingServiceError(f"Embedding server {self.address} timed out")
+                status, payload = connection.recv()
+                break
+            except (EOFError, OSError):
+                # Stale connection (e.g. server restarted): reconnect once
+                self._drop_connection()
+                if attempt:
+                    raise
+        if status == 'error':
+            raise EmbeddingServiceError(payload)
+        return payload
+
+    def _call(self, *request):
+        try:
+            return self._request(*request)
+        except (EOFError, OSError) as e:
+            if self.fallback is None:
+                raise EmbeddingServiceError(f"Embedding server {self.address} unreachable: {e}")
+            logger.warning(f"Embedding server {self.address} unreachable ({e}); encoding locally")
+            return None
+
+    @property
+    def dimension(self) -> int:
+        if self._dimension is None:
+            dimension = self._call('dimension', self.model_name)
+            if dimension is None:
+                return self.fallback.dimension
+            self._dimension = dimension
+        return self._dimension
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        embeddings = self._call('encode', self.model_name, list(texts))
+        if embeddings is None:
+            return self.fallback.encode(texts)
+        return embeddings
+
+
+def embedding_key(model_name: str, backend: str = TORCH) -> str:
+    """
+    Name under which a model's embeddings are stored and served.
+    
+    ONNX Runtime reproduces the PyTorch vectors, so both share the model
+    name; int8 vectors differ slightly and are kept apart.
+    """
+    return f"{model_name}@{backend}" if backend == ONNX_INT8 else model_name
+
+
+def default_quantization() -> str:
+    """Quantization config for this CPU: 'arm64' on ARM, else the widely supported 'avx2'."""
+    return 'arm64' if platform.machine().lower() in ('arm64', 'aarch64') else 'avx2'
+
+
+def load_sentence_transformer(
+    model_name: str,
+    backend: str = TORCH,
+    cache_dir: str = 'onnx_models',
+    quantization: Optional[str] = None
+):
+    """
+    Load a SentenceTransformer for the given inference backend.
+    
+    For the ONNX backends the model is exported (and for ONNX_INT8,
+    dynamically quantized) on first use and cached under cache_dir, so
+    later loads skip the export. Exports are written to a temporary
+    directory and renamed into place, which keeps concurrent workers from
+    reading a half-written model.
+    """
+    from sentence_transformers import SentenceTransformer
+    if backend not in INFERENCE_BACKENDS:
+        raise ValueError(f"Unsupported inference backend: {backend}")
+    if backend == TORCH:
+        return SentenceTransformer(model_name)
+
+    quantization = quantization or default_quantization()
+    variant = 'onnx' if backend == ONNX else f'onnx-int8-{quantization}'
+    export_dir = os.path.join(cache_dir, model_name.replace('/', '__'), variant)
+    if not os.path.isdir(export_dir):
+        logger.info(f"Exporting {model_name} to {export_dir}")
+        staging_dir = f"{export_dir}.tmp-{os.getpid()}"
+        SentenceTransformer(model_name, backend='onnx').save(staging_dir)
+        if backend == ONNX_INT8:
+            from sentence_transformers.backend import export_dynamic_quantized_onnx_model
+            export_dynamic_quantized_onnx_model(
+                SentenceTransformer(staging_dir, backend='onnx', model_kwargs={'file_name': 'onnx/model.onnx'}),
+                quantization,
+                staging_dir
+            )
+        try:
+            os.rename(staging_dir, export_dir)
+        except OSError:
+            # Another process finished the same export first
+            shutil.rmtree(staging_dir, ignore_errors=True)
+
+    file_name = 'onnx/model.onnx'
+    if backend == ONNX_INT8:
+        # Named model_qint8_<config>.onnx, or model_quint8_avx2.onnx
+        pattern = os.path.join(export_dir, 'onnx', f'model_*int8_{quantization}.onnx')
+        quantized = sorted(glob.glob(pattern))
+        if not quantized:
+            # Falling back to the fp32 model would store its vectors under the int8 embedding key
+            raise FileNotFoundError(
+                f"No {quantization} int8 model matching {pattern}; delete {export_dir} to export it again"
+            )
+        file_name = os.path.relpath(quantized[0], export_dir)
+    return SentenceTransformer(export_dir, backend='onnx', model_kwargs={'file_name': file_name})
+
+
+# Worker process state: one model per process
+_worker_model = None
+
+
+def _load_worker_model(load_args: tuple, threads: int):
+    global _worker_model
+    import torch
+    # Keep workers from oversubscribing the CPU cores between them
+    torch.set_num_threads(threads)
+    _worker_model = load_sentence_transformer(*load_args)
+
+
+def _encode_in_worker(texts: List[str]) -> np.ndarray:
+    return np.asarray(_worker_model.encode(texts, convert_to_numpy=True), dtype='float32')
+
+
+def _worker_dimension() -> int:
+    return _worker_model.get_sentence_embedding_dimension()
+
+
+class EmbeddingServer:
+    """
+    Serves encode requests from any number of web processes using a fixed
+    pool of model worker processes.
+    """
+
+    def __init__(
+        self,
+        model_name: str,
+        address,
+        authkey: bytes,
+        workers: int = 2,
+        max_batch_size: int = 64,
+        max_wait: float = 0.005,
+        threads_per_worker: int = 0,
+        inference_backend: str = TORCH,
+        onnx_cache_dir: str = 'onnx_models',
+        onnx_quantization: Optional[str] = None
+    ):
+        self.model_name = embedding_key(model_name, inference_backend)
+        self.address = address
+        self.authkey = authkey
+        threads = threads_per_worker or max(1, (os.cpu_count() or 1) // workers)
+        # Spawned, not forked: torch is not fork-safe once initialized
+        self.pool = ProcessPoolExecutor(
+            workers,
+            mp_context=get_context('spawn'),
+            initializer=_load_worker_model,
+            initargs=((model_name, inference_backend, onnx_cache_dir, onnx_quantization), threads)
+        )
+        self.batcher = EmbeddingBatcher(
+            lambda texts: self.pool.submit(_encode_in_worker, texts),
+            max_batch_size,
+            max_wait,
+            max_in_flight=workers
+        )
+        self.dimension = self.pool.submit(_worker_dimension).result()
+
+    def serve_forever(self):
+        # The default backlog of 1 drops simultaneous connects from busy web processes
+        with Listener(self.address, backlog=128, authkey=self.authkey) as listener:
+            logger.info(f"Embedding server listening on {self.address}")
+            while True:
+                try:
+                    connection = listener.accept()
+                except Exception as e:
+                    # e.g. a client with the wrong authkey
+                    logger.warning(f"Rejected embedding client: {e}")
+                    continue
+                threading.Thread(target=self._handle, args=(connection,), daemon=True).start()
+
+    def _handle(self, connection):
+        with connection:
+            while True:
+                try:
+                    request = connection.recv()
+                except (EOFError, OSError):
+                    return
+                try:
+                    if request[1] != self.model_name:
+                        # Stored embeddings are keyed by model name; never mix models
+                        reply = ('error', f"Server runs {self.model_name}, not {request[1]}")
+                    elif request[0] == 'dimension':
+                        reply = ('ok', self.dimension)
+                    elif request[0] == 'encode':
+                        reply = ('ok', self.batcher.encode(request[2]))
+                    else:
+                        reply = ('error', f"Unknown request: {request[0]}")
+                except Exception as e:
+                    logger.exception("Embedding request failed")
+                    reply = ('error', repr(e))
+                connection.send(reply)
+
+    def close(self):
+        self.pool.shutdown(cancel_futures=True)
+
+
+def parse_address(address: str):
+    """'host:port' becomes a TCP address; anything else is a Unix socket path."""
+    host, _, port = address.rpartition(':')
+    if host and port.isdigit():
+        return (host, int(port))
+    return address
+
+
+def service_authkey() -> bytes:
+    """
+    Shared secret of the embedding server and its clients:
+    EMBEDDING_SERVICE_AUTHKEY, or SECRET_KEY when that is empty.
+    """
+    from django.conf import settings
+    from django.core.exceptions import ImproperlyConfigured
+    authkey = getattr(settings, 'EMBEDDING_SERVICE_AUTHKEY', '') or settings.SECRET_KEY
+    if not authkey:
+        raise ImproperlyConfigured(
+            "The embedding server needs EMBEDDING_SERVICE_AUTHKEY or SECRET_KEY to authenticate its clients"
+        )
+    return authkey.encode()
+
+
+def create_encoder(model_name: str, load_model: Callable) -> BaseEncoder:
+    """
+    Build the encoder selected by the EMBEDDING_* settings.
+    
+    Args:
+        model_name: embedding_key of the model, checked by the server
+        load_model: Returns the local SentenceTransformer
+    """
+    from django.conf import settings
+    local = LocalEncoder(
+        load_model,
+        getattr(settings, 'EMBEDDING_MAX_BATCH_SIZE', 64),
+        getattr(settings, 'EMBEDDING_BATCH_WAIT_MS', 5) / 1000
+    )
+    address = getattr(settings, 'EMBEDDING_SERVICE_ADDRESS', '')
+    if not address:
+        return local
+    return EmbeddingClient(
+        model_name,
+        parse_address(address),
+        service_authkey(),
+        fallback=local,
+        timeout=getattr(settings, 'EMBEDDING_SERVICE_TIMEOUT', 30)
+    )
@@ -0,0 +1,358 @@
+"""
+1PL/2PL/3PL item calibration on sparse response matrices.
+
+girth's estimators take a dense items x participants matrix and build
+(items x participants x quadrature) arrays, which is fine for one test but
+not for a course, where every question was only answered by the students of
+the tests that used it. This module fits the models by marginal maximum
+likelihood with the EM algorithm of Bock & Aitkin, working on a
+participants x items scipy.sparse matrix whose stored entries are the
+administered responses (+1 correct, -1 incorrect). Responses that were not
+administered are simply absent, so memory and time grow with the number of
+responses, not with participants x items.
+
+1PL estimates one discrimination shared by all items, 2PL one per item, and
+3PL adds a guessing parameter; 1PL and 2PL have no guessing.
+
+estimate_abilities then scores participants against fitted item parameters
+(EAP or MLE), on the same sparse matrix, for all participants at once.
+"""
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Callable, Optional
+
+import numpy as np
+from scipy import optimize, sparse
+from scipy.special import expit, logsumexp
+
+logger = logging.getLogger(__name__)
+
+ONE_PL = '1PL'
+TWO_PL = '2PL'
+THREE_PL = '3PL'
+MODELS = (ONE_PL, TWO_PL, THREE_PL)
+EAP = 'eap'
+MLE = 'mle'
+
+# Parameter bounds, as in girth's threepl_mml
+DISCRIMINATION_BOUNDS = (0.25, 4.0)
+DIFFICULTY_BOUNDS = (-6.0, 6.0)
+GUESSING_BOUNDS = (0.0, 0.33)
+# Range of the ability quadrature, and of MLE abilities
+ABILITY_BOUNDS = (-5.0, 5.0)
+
+
+@dataclass
+class ItemParameters:
+    discrimination: np.ndarray
+    difficulty: np.ndarray
+    guessing: np.ndarray
+    model: str = THREE_PL
+    log_likelihood: float = 0.0
+    num_parameters: int = 0
+    participants: int = 0
+    iterations: int = 0
+    converged: bool = False
+    max_change: float = 0.0
+    fit_seconds: float = 0.0
+    warm_started: bool = False
+    administered: np.ndarray = field(default=None)
+    correct: np.ndarray = field(default=None)
+
+    @property
+    def aic(self) -> float:
+        return 2 * self.num_parameters - 2 * self.log_likelihood
+
+    @property
+    def bic(self) -> float:
+        return float(self.num_parameters * np.log(max(self.participants, 1)) - 2 * self.log_likelihood)
+
+    def select(self, columns) -> 'ItemParameters':
+        """Parameters of a subset of the items, e.g. one test's questions of a pooled fit."""
+        return ItemParameters(
+            discrimination=self.discrimination[columns],
+            difficulty=self.difficulty[columns],
+            guessing=self.guessing[columns],
+            model=self.model
+        )
+
+    def diagnostics(self) -> dict:
+        return {
+            'model': self.model,
+            'log_likelihood': self.log_likelihood,
+            'aic': self.aic,
+            'bic': self.bic,
+            'num_parameters': self.num_parameters,
+            'iterations': self.iterations,
+            'converged': self.converged,
+            'max_change': self.max_change,
+            'fit_seconds': round(self.fit_seconds, 4),
+            'warm_started': self.warm_started,
+        }
+
+
+def response_counts(responses: sparse.csr_matrix):
+    """Administered and correct responses per item."""
+    return responses.getnnz(axis=0), np.asarray((responses > 0).sum(axis=0)).ravel()
+
+
+def fit_irt(
+    responses: sparse.spmatrix,
+    model: str = THREE_PL,
+    max_iterations: int = 200,
+    tolerance: float = 1e-4,
+    quadrature_points: int = 41,
+    initial: Optional[ItemParameters] = None,
+    on_iteration: Optional[Callable[[int], None]] = None
+) -> ItemParameters:
+    """
+    Fit an IRT model to a sparse response matrix.
+
+    Abilities are integrated over a standard normal on fixed quadrature
+    points. Each EM iteration is two sparse products for the E-step and one
+    bounded L-BFGS-B run over all items for the M-step (given the
+    posterior, the items only interact through a shared 1PL discrimination).
+
+    Args:
+        responses: participants x items, +1 correct / -1 incorrect, absent = not administered
+        model: '1PL', '2PL' or '3PL'
+        max_iterations: EM iterations at most
+        tolerance: Stop once no parameter moves more than this
+        quadrature_points: Ability quadrature nodes on ABILITY_BOUNDS
+        initial: Start from these parameters (NaN = no value) instead of the default guess
+        on_iteration: Called with the iteration number after each EM iteration
+
+    Returns:
+        Item parameters (items without responses get NaN), with fit diagnostics
+    """
+    if model not in MODELS:
+        raise ValueError(f"Unknown IRT model: {model}")
+    started = time.perf_counter()
+    responses = sparse.csr_matrix(responses)
+    correct = (responses > 0).astype('float64')
+    incorrect = (responses < 0).astype('float64')
+    administered, correct_counts = response_counts(responses)
+    num_items = responses.shape[1]
+    observed = administered > 0
+    num_observed = int(observed.sum())
+
+    theta, log_prior = _quadrature(quadrature_points)
+
+    p_values = np.clip(correct_counts / np.maximum(administered, 1), 0.01, 0.99)
+    a = np.ones(num_items)
+    b = np.clip(-np.log(p_values / (1 - p_values)), *DIFFICULTY_BOUNDS)
+    c = np.zeros(num_items)
+    if initial is not None:
+        a = np.clip(np.where(np.isnan(initial.discrimination), a, initial.discrimination), *DISCRIMINATION_BOUNDS)
+        b = np.clip(np.where(np.isnan(initial.difficulty), b, initial.difficulty), *DIFFICULTY_BOUNDS)
+        c = np.clip(np.nan_to_num(initial.guessing, nan=0.0), *GUESSING_BOUNDS)
+    if model != THREE_PL:
+        c[:] = 0
+    if model == ONE_PL:
+        a[:] = a[observed].mean() if num_observed else 1.0
+
+    bounds = _bounds(model, num_observed)
+    converged = False
+    change = np.inf
+    iteration = 0
+    for iteration in range(1, max_iterations + 1):
+        _, posterior = _e_step(correct, incorrect, a, b, c, theta, log_prior)
+
+        # Expected correct (r) and administered (n) counts per item and node
+        r = (correct.T @ posterior)[observed]
+        n = r + (incorrect.T @ posterior)[observed]
+
+        # M-step
+        start = _pack(model, a[observed], b[observed], c[observed])
+        solution = optimize.minimize(
+            _negative_expected_log_likelihood, start, args=(model, theta, r, n),
+            jac=True, method='L-BFGS-B', bounds=bounds, options={'maxiter': 50}
+        )
+        change = float(np.max(np.abs(solution.x - start))) if len(start) else 0.0
+        a[observed], b[observed], c[observed] = _unpack(model, solution.x, num_observed)
+        if on_iteration is not None:
+            on_iteration(iteration)
+        if change < tolerance:
+            converged = True
+            break
+
+    log_likelihood, _ = _e_step(correct, incorrect, a, b, c, theta, log_prior)
+    fit_seconds = time.perf_counter() - started
+    logger.info(
+        "%s fit on %s responses: %s iterations, log-likelihood %.2f, converged %s, %.2fs",
+        model, responses.nnz, iteration, log_likelihood, converged, fit_seconds
+    )
+    missing = np.where(observed, 1.0, np.nan)
+    return ItemParameters(
+        discrimination=a * missing,
+        difficulty=b * missing,
+        guessing=c * missing,
+        model=model,
+        log_likelihood=log_likelihood,
+        num_parameters=_num_parameters(model, num_observed),
+        participants=responses.shape[0],
+        iterations=iteration,
+        converged=converged,
+        max_change=change,
+        fit_seconds=fit_seconds,
+        warm_started=initial is not None,
+        administered=administered,
+        correct=correct_counts
+    )
+
+
+def estimate_abilities(
+    responses: sparse.spmatrix,
+    parameters: ItemParameters,
+    method: str = EAP,
+    quadrature_points: int = 41,
+    max_iterations: int = 50,
+    tolerance: float = 1e-4
+):
+    """
+    Estimate the ability of every participant from fitted item parameters.
+
+    EAP is the mean of the posterior on the quadrature nodes under a
+    standard normal prior, with the posterior standard deviation as its
+    standard error. MLE runs Fisher scoring for all participants at once,
+    with the standard error from the test information; abilities of
+    participants who got everything right (or wrong) have no finite
+    maximum and end at ABILITY_BOUNDS. Items without parameters (NaN) are
+    ignored.
+
+    Args:
+        responses: participants x items, +1 correct / -1 incorrect, absent = not administered
+        parameters: Parameters of the items, in column order
+        method: 'eap' or 'mle'
+
+    Returns:
+        Tuple of (ability, standard error) arrays; the standard error is NaN
+        when a participant has no responses to estimate from
+    """
+    usable = ~np.isnan(parameters.difficulty)
+    responses = sparse.csr_matrix(responses)[:, usable]
+    responses.eliminate_zeros()
+    a = parameters.discrimination[usable]
+    b = parameters.difficulty[usable]
+    c = parameters.guessing[usable]
+    num_participants = responses.shape[0]
+
+    if method == EAP:
+        nodes, log_prior = _quadrature(quadrature_points)
+        correct = (responses > 0).astype('float64')
+        incorrect = (responses < 0).astype('float64')
+        _, posterior = _e_step(correct, incorrect, a, b, c, nodes, log_prior)
+        theta = posterior @ nodes
+        se = np.sqrt(np.maximum(posterior @ nodes ** 2 - theta ** 2, 0))
+        return theta, se
+    if method != MLE:
+        raise ValueError(f"Unknown ability estimation method: {method}")
+
+    # One entry per administered response; per-participant sums are bincounts over rows
+    rows = np.repeat(np.arange(num_participants), np.diff(responses.indptr))
+    columns = responses.indices
+    x = (responses.data > 0).astype('float64')
+    a, b, c = a[columns], b[columns], c[columns]
+
+    theta = np.zeros(num_participants)
+    active = np.ones(num_participants, dtype=bool)
+    for _ in range(max_iterations):
+        # Only participants still moving are updated, so a few slow ones do not cost a full pass
+        entries = active[rows]
+        score, information = _ability_derivatives(
+            theta[rows[entries]], x[entries], a[entries], b[entries], c[entries], rows[entries], num_participants
+        )
+        step = np.clip(np.divide(score, information, out=np.zeros_like(score), where=information > 0), -1, 1)
+        # Measured after clipping: participants at a bound keep pushing against it
+        updated = np.clip(theta + step * active, *ABILITY_BOUNDS)
+        active &= np.abs(updated - theta) >= tolerance
+        theta = updated
+        if not active.any():
+            break
+    _, information = _ability_derivatives(theta[rows], x, a, b, c, rows, num_participants)
+    with np.errstate(divide='ignore'):
+        se = np.where(information > 0, 1 / np.sqrt(information), np.nan)
+    return theta, se
+
+
+def _ability_derivatives(theta, x, a, b, c, rows, num_participants):
+    """Per participant d(log-likelihood)/d(theta) and Fisher information, from per-response terms."""
+    s = expit(a * (theta - b))
+    p = np.clip(c + (1 - c) * s, 1e-9, 1 - 1e-9)
+    dp = a * (1 - c) * s * (1 - s)
+    score = np.bincount(rows, weights=(x - p) * dp / (p * (1 - p)), minlength=num_participants)
+    information = np.bincount(rows, weights=dp ** 2 / (p * (1 - p)), minlength=num_participants)
+    return score, information
+
+
+def _quadrature(points):
+    """Ability nodes and the log of a standard normal prior on them."""
+    nodes = np.linspace(*ABILITY_BOUNDS, points)
+    log_prior = -0.5 * nodes ** 2
+    return nodes, log_prior - logsumexp(log_prior)
+
+
+def _e_step(correct, incorrect, a, b, c, theta, log_prior):
+    """Marginal log-likelihood, and the posterior over the quadrature nodes for every participant."""
+    p = _probability(a, b, c, theta)
+    log_joint = correct @ np.log(p) + incorrect @ np.log1p(-p) + log_prior
+    log_marginal = logsumexp(log_joint, axis=1, keepdims=True)
+    return float(log_marginal.sum()), np.exp(log_joint - log_marginal)
+
+
+def _num_parameters(model, num_items):
+    return {ONE_PL: num_items + 1, TWO_PL: 2 * num_items, THREE_PL: 3 * num_items}[model] if num_items else 0
+
+
+def _bounds(model, num_items):
+    if model == ONE_PL:
+        return [DISCRIMINATION_BOUNDS] + [DIFFICULTY_BOUNDS] * num_items
+    bounds = [DISCRIMINATION_BOUNDS] * num_items + [DIFFICULTY_BOUNDS] * num_items
+    if model == THREE_PL:
+        bounds += [GUESSING_BOUNDS] * num_items
+    return bounds
+
+
+def _pack(model, a, b, c):
+    if model == ONE_PL:
+        return np.concatenate([a[:1], b])
+    if model == TWO_PL:
+        return np.concatenate([a, b])
+    return np.concatenate([a, b, c])
+
+
+def _unpack(model, params, num_items):
+    if model == ONE_PL:
+        return np.full(num_items, params[0]), params[1:], np.zeros(num_items)
+    if model == TWO_PL:
+        return params[:num_items], params[num_items:], np.zeros(num_items)
+    return np.split(params, 3)
+
+
+def _probability(a, b, c, theta):
+    """items x nodes probability of a correct response."""
+    return np.clip(
+        c[:, None] + (1 - c[:, None]) * expit(a[:, None] * (theta[None, :] - b[:, None])),
+        1e-9, 1 - 1e-9
+    )
+
+
+def _negative_expected_log_likelihood(params, model, theta, r, n):
+    a, b, c = _unpack(model, params, r.shape[0])
+    s = expit(a[:, None] * (theta[None, :] - b[:, None]))
+    p = np.clip(c[:, None] + (1 - c[:, None]) * s, 1e-9, 1 - 1e-9)
+    value = np.sum(r * np.log(p) + (n - r) * np.log1p(-p))
+
+    # d(log-likelihood)/dp, then the chain rule through p(a, b, c)
+    w = r / p - (n - r) / (1 - p)
+    ds = (1 - c[:, None]) * s * (1 - s)
+    grad_a = np.sum(w * ds * (theta[None, :] - b[:, None]), axis=1)
+    grad_b = -np.sum(w * ds * a[:, None], axis=1)
+    if model == ONE_PL:
+        gradient = np.concatenate([[grad_a.sum()], grad_b])
+    elif model == TWO_PL:
+        gradient = np.concatenate([grad_a, grad_b])
+    else:
+        gradient = np.concatenate([grad_a, grad_b, np.sum(w * (1 - s), axis=1)])
+    return -value, -gradient
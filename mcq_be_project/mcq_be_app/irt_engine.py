@@ -0,0 +1,198 @@
+"""
+IRT calibration engine: model selection, warm starts and a fit cache.
+
+Calibrations go through `calibrate`, which fits every candidate model of
+IRT_MODELS with irt.py and keeps the one with the lowest information
+criterion (IRT_SELECTION_CRITERION, "aic" or "bic"). Fits start from the
+item parameters already stored for the questions when there are any, so a
+refit after a few more results converges in a handful of EM iterations.
+
+Results are cached in the database by a hash of the response matrix and the
+fit settings: recalibrating unchanged data (a re-run or requeued job, a
+course refit when none of its results changed) returns the stored fit
+without running EM. The warm start is deliberately not part of the key: it
+comes from the previous fit of the same questions, so on unchanged data it
+only changes where EM starts, and keying on it would make every re-run a
+miss. Warm starts are used when the cache misses.
+"""
+import hashlib
+import logging
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Sequence
+
+import numpy as np
+from django.conf import settings
+from scipy import sparse
+
+from .irt import MODELS, ItemParameters, fit_irt, response_counts
+from .models import CachedCalibration
+
+logger = logging.getLogger(__name__)
+
+CRITERIA = ('aic', 'bic')
+MAX_ITERATIONS = 200
+TOLERANCE = 1e-4
+# Part of the cache key: bump when a change to irt.py changes its results
+ESTIMATOR_VERSION = 1
+
+
+class IRTFitError(Exception):
+    pass
+
+
+@dataclass
+class CalibrationFit:
+    parameters: ItemParameters
+    diagnostics: Dict  # Selected model's diagnostics, criterion, candidates, cache hit
+
+
+def response_hash(responses: sparse.spmatrix, models: Sequence[str], criterion: str) -> str:
+    """sha256 of a +1/-1 sparse response matrix and the fit settings."""
+    matrix = sparse.csr_matrix(responses, dtype='int8')
+    matrix.sum_duplicates()
+    matrix.sort_indices()
+    digest = hashlib.sha256()
+    digest.update(
+        f"v{ESTIMATOR_VERSION}:{','.join(models)}:{criterion}:{MAX_ITERATIONS}:{TOLERANCE}:{matrix.shape}".encode()
+    )
+    for array in (matrix.indptr.astype('int64'), matrix.indices.astype('int32'), matrix.data):
+        digest.update(array.tobytes())
+    return digest.hexdigest()
+
+
+def initial_parameters(stored: List[Optional[Dict]]) -> Optional[ItemParameters]:
+    """
+    Warm start from stored {'discrimination', 'difficulty', 'guessing'}
+    dicts, one per item (None where an item has none).
+    """
+    values = np.array([
+        [np.nan if value is None else value for value in (
+            (item or {}).get('discrimination'), (item or {}).get('difficulty'), (item or {}).get('guessing')
+        )]
+        for item in stored
+    ], dtype='float64').reshape(-1, 3)
+    if np.isnan(values).all():
+        return None
+    return ItemParameters(discrimination=values[:, 0], difficulty=values[:, 1], guessing=values[:, 2])
+
+
+def item_parameters(fit: ItemParameters, column: int) -> Dict:
+    """Stored form of one item's parameters."""
+    return {
+        'difficulty': float(fit.difficulty[column]),
+        'discrimination': float(fit.discrimination[column]),
+        'guessing': float(fit.guessing[column]),
+        'model': fit.model,
+    }
+
+
+def calibrate(
+    responses: sparse.spmatrix,
+    initial: Optional[ItemParameters] = None,
+    models: Optional[Sequence[str]] = None,
+    criterion: Optional[str] = None,
+    on_iteration: Optional[Callable[[str, int], None]] = None
+) -> CalibrationFit:
+    """
+    Fit the candidate models and keep the best by information criterion.
+
+    Args:
+        responses: participants x items, +1 correct / -1 incorrect, absent = not administered
+        initial: Warm start parameters (see initial_parameters)
+        models: Candidate models, IRT_MODELS by default
+        criterion: 'aic' or 'bic', IRT_SELECTION_CRITERION by default
+        on_iteration: Called with (model, iteration) after each EM iteration
+
+    Raises:
+        IRTFitError: If no candidate model could be fitted
+    """
+    models = tuple(models or settings.IRT_MODELS)
+    criterion = (criterion or settings.IRT_SELECTION_CRITERION).lower()
+    if criterion not in CRITERIA or not models or set(models) - set(MODELS):
+        raise ValueError(f"Invalid IRT settings: models {models}, criterion {criterion}")
+
+    responses = sparse.csr_matrix(responses, dtype='int8')
+    key = response_hash(responses, models, criterion)
+    if settings.IRT_FIT_CACHE:
+        cached = CachedCalibration.objects.filter(response_hash=key).first()
+        if cached is not None:
+            logger.info("IRT fit cache hit %s (%s)", key[:12], cached.model)
+            return _from_cache(cached, responses)
+
+    candidates = {}
+    fits = []
+    for model in models:
+        callback = None if on_iteration is None else (lambda iteration, model=model: on_iteration(model, iteration))
+        try:
+            fit = fit_irt(
+                responses, model, max_iterations=MAX_ITERATIONS, tolerance=TOLERANCE,
+                initial=initial, on_iteration=callback
+            )
+        except Exception as e:
+            logger.exception("%s fit failed", model)
+            candidates[model] = {'error': str(e)}
+            continue
+        if not np.isfinite(fit.log_likelihood):
+            candidates[model] = {'error': 'Log-likelihood is not finite'}
+            continue
+        if not fit.converged:
+            logger.warning("%s fit did not converge in %s iterations", model, fit.iterations)
+        candidates[model] = fit.diagnostics()
+        fits.append(fit)
+    if not fits:
+        raise IRTFitError('; '.join(f"{model}: {c['error']}" for model, c in candidates.items()))
+
+    best = min(fits, key=lambda fit: getattr(fit, criterion))
+    diagnostics = {
+        **best.diagnostics(),
+        'criterion': criterion,
+        'candidates': candidates,
+        'cached': False,
+        'response_hash': key,
+    }
+    if settings.IRT_FIT_CACHE:
+        # Another worker may store the same fit first; get_or_create keeps whichever row won
+        CachedCalibration.objects.get_or_create(
+            response_hash=key,
+            defaults={
+                'model': best.model,
+                'parameters': {
+                    'discrimination': _to_list(best.discrimination),
+                    'difficulty': _to_list(best.difficulty),
+                    'guessing': _to_list(best.guessing),
+                },
+                'diagnostics': diagnostics,
+            }
+        )
+    return CalibrationFit(best, diagnostics)
+
+
+def _from_cache(cached: CachedCalibration, responses: sparse.csr_matrix) -> CalibrationFit:
+    diagnostics = dict(cached.diagnostics, cached=True)
+    administered, correct = response_counts(responses)
+    parameters = ItemParameters(
+        discrimination=_to_array(cached.parameters['discrimination']),
+        difficulty=_to_array(cached.parameters['difficulty']),
+        guessing=_to_array(cached.parameters['guessing']),
+        model=cached.model,
+        log_likelihood=diagnostics.get('log_likelihood', 0.0),
+        num_parameters=diagnostics.get('num_parameters', 0),
+        participants=responses.shape[0],
+        iterations=diagnostics.get('iterations', 0),
+        converged=diagnostics.get('converged', False),
+        max_change=diagnostics.get('max_change', 0.0),
+        fit_seconds=diagnostics.get('fit_seconds', 0.0),
+        warm_started=diagnostics.get('warm_started', False),
+        administered=administered,
+        correct=correct
+    )
+    return CalibrationFit(parameters, diagnostics)
+
+
+def _to_list(values: np.ndarray) -> List[Optional[float]]:
+    # JSON has no NaN: items without responses are stored as null
+    return [None if np.isnan(value) else float(value) for value in values]
+
+
+def _to_array(values: List[Optional[float]]) -> np.ndarray:
+    return np.array([np.nan if value is None else value for value in values], dtype='float64')
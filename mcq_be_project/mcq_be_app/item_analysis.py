@@ -0,0 +1,134 @@
+"""
+Classical item analysis of a test's response matrix.
+
+Everything is computed with whole-matrix NumPy operations from the
+students x questions 0/1 matrix (and, for the distractor analysis, the
+matrix of chosen options, one ASCII code per answer with 0 for blank):
+
+- per item: p-value, point-biserial and corrected (item-rest) item-total
+  correlations, upper/lower 27% discrimination index, and the selection
+  rate of every option overall and in the upper and lower groups;
+- per test: score mean and standard deviation, KR-20, Cronbach's alpha
+  and the standard error of measurement.
+
+Correlations of items everyone (or no one) answered correctly are
+undefined and reported as None.
+"""
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+GROUP_FRACTION = 0.27
+OMITTED = 'omitted'
+
+
+def analyze_items(
+    responses: np.ndarray,
+    choices: Optional[np.ndarray] = None,
+    group_fraction: float = GROUP_FRACTION
+) -> Tuple[List[Dict], Dict]:
+    """
+    Analyze a response matrix.
+
+    Args:
+        responses: students x questions, 1 = correct
+        choices: students x questions chosen option codes (ord of the option label, 0 = blank)
+        group_fraction: Share of students in each of the upper and lower groups
+
+    Returns:
+        Tuple of (statistics of each question, in column order; statistics of the test)
+    """
+    x = np.asarray(responses, dtype='float64')
+    num_students, num_items = x.shape
+    total = x.sum(axis=1)
+
+    p = x.mean(axis=0)
+    item_var = p * (1 - p)
+    total_var = total.var()
+    # Covariance of each item with the total score
+    cov = (x - p).T @ (total - total.mean()) / num_students
+    point_biserial = _divide(cov, np.sqrt(item_var * total_var))
+    # Correlation with the rest of the test, so the item does not correlate with itself
+    rest_var = total_var + item_var - 2 * cov
+    corrected = _divide(cov - item_var, np.sqrt(item_var * rest_var))
+
+    group_size = max(1, int(round(group_fraction * num_students)))
+    order = np.argsort(total, kind='stable')
+    lower, upper = order[:group_size], order[-group_size:]
+    upper_p = x[upper].mean(axis=0)
+    lower_p = x[lower].mean(axis=0)
+
+    option_rates = _option_rates(choices, upper, lower) if choices is not None and choices.size else None
+
+    items = []
+    for i in range(num_items):
+        item = {
+            'p_value': float(p[i]),
+            'total_responses': num_students,
+            'correct_responses': int(x[:, i].sum()),
+            'point_biserial': _float(point_biserial[i]),
+            'corrected_item_total': _float(corrected[i]),
+            'discrimination_index': float(upper_p[i] - lower_p[i]),
+            'upper_p': float(upper_p[i]),
+            'lower_p': float(lower_p[i]),
+        }
+        if option_rates is not None:
+            item['options'] = option_rates[i]
+        items.append(item)
+
+    if num_items > 1:
+        factor = num_items / (num_items - 1)
+        kr20 = factor * (1 - item_var.sum() / total_var) if total_var else None
+        # Alpha from sample variances; for 0/1 items it equals KR-20
+        sample_total_var = total.var(ddof=1) if num_students > 1 else 0
+        alpha = (
+            factor * (1 - x.var(axis=0, ddof=1).sum() / sample_total_var)
+            if sample_total_var else None
+        )
+    else:
+        kr20 = alpha = None
+    sd = float(np.sqrt(total_var))
+    test = {
+        'num_students': num_students,
+        'num_items': num_items,
+        'mean_score': float(total.mean()) if num_students else 0.0,
+        'sd_score': sd,
+        'kr20': _float(kr20),
+        'cronbach_alpha': _float(alpha),
+        'sem': _float(sd * np.sqrt(1 - kr20)) if kr20 is not None and kr20 <= 1 else None,
+        'group_size': group_size,
+    }
+    return items, test
+
+
+def _option_rates(choices: np.ndarray, upper: np.ndarray, lower: np.ndarray) -> List[Dict]:
+    """Per item {option: {'rate', 'upper', 'lower'}} for every option anyone chose."""
+    choices = np.asarray(choices, dtype='uint8')
+    codes = np.unique(choices)
+    # (options x items) selection rates, overall and per group
+    selected = choices[None, :, :] == codes[:, None, None]
+    rates = selected.mean(axis=1)
+    upper_rates = selected[:, upper].mean(axis=1)
+    lower_rates = selected[:, lower].mean(axis=1)
+    labels = [OMITTED if code == 0 else chr(code) for code in codes]
+    return [
+        {
+            label: {
+                'rate': float(rates[o, i]),
+                'upper': float(upper_rates[o, i]),
+                'lower': float(lower_rates[o, i]),
+            }
+            for o, label in enumerate(labels)
+            if rates[o, i] > 0
+        }
+        for i in range(choices.shape[1])
+    ]
+
+
+def _divide(numerator, denominator):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(denominator > 0, numerator / denominator, np.nan)
+
+
+def _float(value):
+    return None if value is None or not np.isfinite(value) else float(value)
@@ -0,0 +1,100 @@
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+
+from mcq_be_app.embedding_service import INFERENCE_BACKENDS, TORCH
+from mcq_be_app.models import Question
+from mcq_be_app.similarity_service import SimilarityService
+
+SAMPLE_TOPICS = [
+    'photosynthesis', 'the French Revolution', 'binary search', 'supply and demand',
+    'Newton\'s second law', 'the water cycle', 'cell division', 'linear equations',
+]
+SAMPLE_TEMPLATES = [
+    'Which of the following best describes {}?',
+    'What is the main consequence of {} in this scenario?',
+    'Explain the role of {} with an example.',
+    'Which statement about {} is incorrect?',
+]
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark embedding throughput (sentences/sec) of the inference backends "
+        "and their agreement with the PyTorch embeddings."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--backends', default=','.join(INFERENCE_BACKENDS),
+                            help='Comma-separated inference backends to compare')
+        parser.add_argument('--sentences', type=int, default=1000)
+        parser.add_argument('--batch-size', type=int, default=32)
+        parser.add_argument('--k', type=int, default=10,
+                            help='Neighbours compared for the ranking agreement')
+        parser.add_argument('--source', choices=['synthetic', 'db'], default='synthetic',
+                            help='Templated sentences, or the stored question texts')
+
+    def handle(self, *args, **options):
+        backends = [b for b in options['backends'].split(',') if b]
+        for backend in backends:
+            if backend not in INFERENCE_BACKENDS:
+                raise CommandError(f"Unknown inference backend: {backend}")
+        if TORCH not in backends:
+            backends.insert(0, TORCH)
+
+        texts = self._load_texts(options['source'], options['sentences'])
+        k = min(options['k'], len(texts) - 1)
+        self.stdout.write(f"{len(texts)} sentences, batch size {options['batch_size']}")
+        self.stdout.write(
+            f"{'backend':<10} {'load s':>7} {'sent/s':>9} {'speedup':>8} {'cosine':>7} {'top-k':>6}"
+        )
+
+        reference = None
+        reference_rate = None
+        for backend in backends:
+            service = SimilarityService(inference_backend=backend)
+            start = time.perf_counter()
+            model = service.model
+            model.encode(texts[:options['batch_size']])  # Warm up
+            load_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            embeddings = model.encode(texts, batch_size=options['batch_size'], normalize_embeddings=True)
+            rate = len(texts) / (time.perf_counter() - start)
+
+            if reference is None:
+                reference, reference_rate = embeddings, rate
+            cosine = float(np.mean(np.sum(embeddings * reference, axis=1)))
+            overlap = self._neighbour_overlap(reference, embeddings, k)
+            self.stdout.write(
+                f"{backend:<10} {load_time:>7.1f} {rate:>9.0f} {rate / reference_rate:>7.2f}x "
+                f"{cosine:>7.4f} {overlap:>6.3f}"
+            )
+
+    @staticmethod
+    def _load_texts(source, count):
+        if source == 'db':
+            texts = list(
+                Question.objects.exclude(question_text='').values_list('question_text', flat=True)[:count]
+            )
+            if len(texts) < 2:
+                raise CommandError("Not enough stored questions")
+            return texts
+        return [
+            SAMPLE_TEMPLATES[i % len(SAMPLE_TEMPLATES)].format(SAMPLE_TOPICS[(i // 4) % len(SAMPLE_TOPICS)])
+            + f" (variant {i})"
+            for i in range(count)
+        ]
+
+    @staticmethod
+    def _neighbour_overlap(reference, embeddings, k):
+        """Mean fraction of each sentence's k nearest neighbours shared with the reference."""
+        def neighbours(matrix):
+            scores = matrix @ matrix.T
+            np.fill_diagonal(scores, -np.inf)
+            return np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        expected, actual = neighbours(reference), neighbours(embeddings)
+        return float(np.mean([
+            len(np.intersect1d(row, expected_row)) / k for row, expected_row in zip(actual, expected)
+        ]))
@@ -0,0 +1,100 @@
+import time
+
+import numpy as np
+import pandas as pd
+from django.core.management.base import BaseCommand
+
+from mcq_be_app.scoring import VersionIndex, build_version_mappings, score_answer_sheet
+
+
+def legacy_score(df_answers, version_mappings, num_questions):
+    """The per-row scoring loop upload_test_results used before scoring.py."""
+    response_matrix = []
+    used_versions = []
+    for idx, row in df_answers.iterrows():
+        student_responses = [0] * num_questions
+        has_answers = False
+        c_columns = [col for col in df_answers.columns if col.startswith('C')]
+        used_version = None
+        for version, mapping in version_mappings.items():
+            test_responses = [0] * num_questions
+            valid_answers = 0
+            for col in c_columns:
+                if pd.notna(row[col]):
+                    q_num = int(col[1:])
+                    if q_num in mapping:
+                        mapped_index = mapping[q_num] - 1
+                        if 0 <= mapped_index < num_questions:
+                            test_responses[mapped_index] = 1 if str(row[col]).endswith('1') else 0
+                            valid_answers += 1
+            if valid_answers > sum(student_responses):
+                student_responses = test_responses
+                used_version = version
+                has_answers = valid_answers > 0
+        if has_answers:
+            response_matrix.append(student_responses)
+            used_versions.append(used_version)
+    return response_matrix, used_versions
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark answer-sheet scoring on synthetic uploads of growing size, "
+        "against the legacy per-row loop."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--students', default='100,500,2000,10000',
+                            help='Comma-separated sheet sizes')
+        parser.add_argument('--questions', type=int, default=60)
+        parser.add_argument('--versions', type=int, default=8)
+        parser.add_argument('--legacy-max', type=int, default=2000,
+                            help='Largest sheet also scored with the legacy loop')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = np.random.default_rng(options['seed'])
+        num_questions = options['questions']
+        df_mapping = self._mapping_sheet(rng, num_questions, options['versions'])
+        version_mappings = build_version_mappings(df_mapping)
+        version_index = VersionIndex.from_mappings(version_mappings, num_questions)
+
+        self.stdout.write(f"{num_questions} questions, {options['versions']} versions")
+        self.stdout.write(f"{'students':>9} {'vector s':>9} {'legacy s':>9} {'speedup':>8}")
+        for num_students in [int(n) for n in options['students'].split(',') if n]:
+            df_answers = self._answer_sheet(rng, num_students, num_questions)
+
+            start = time.perf_counter()
+            response_matrix, _, used_versions, _ = score_answer_sheet(df_answers, version_index, num_questions)
+            vector_time = time.perf_counter() - start
+
+            if num_students > options['legacy_max']:
+                self.stdout.write(f"{num_students:>9} {vector_time:>9.3f} {'-':>9} {'-':>8}")
+                continue
+
+            start = time.perf_counter()
+            legacy_matrix, legacy_versions = legacy_score(df_answers, version_mappings, num_questions)
+            legacy_time = time.perf_counter() - start
+
+            if response_matrix.tolist() != legacy_matrix or used_versions != legacy_versions:
+                self.stderr.write(self.style.ERROR(f"{num_students} students: results differ from the legacy loop"))
+            self.stdout.write(
+                f"{num_students:>9} {vector_time:>9.3f} {legacy_time:>9.3f} {legacy_time / vector_time:>7.1f}x"
+            )
+
+    @staticmethod
+    def _mapping_sheet(rng, num_questions, num_versions):
+        columns = {'Question': np.arange(1, num_questions + 1)}
+        for v in range(num_versions):
+            columns[f'Version {v + 1}'] = rng.permutation(num_questions) + 1
+        return pd.DataFrame(columns)
+
+    @staticmethod
+    def _answer_sheet(rng, num_students, num_questions):
+        # Answer codes end in 1 when correct; about 5% of answers are left blank
+        codes = rng.choice(['A0', 'B0', 'C1', 'D1'], size=(num_students, num_questions)).astype(object)
+        codes[rng.random(codes.shape) < 0.05] = None
+        df = pd.DataFrame(codes, columns=[f'C{i + 1}' for i in range(num_questions)])
+        # A few students left everything blank
+        df.iloc[::97] = None
+        return df
@@ -0,0 +1,123 @@
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+
+from mcq_be_app.models import QuestionEmbedding
+from mcq_be_app.similarity_service import (
+    COSINE, FLAT, HNSW, INDEX_BACKENDS, IVFPQ, L2, SimilarityIndex, SimilarityService,
+    build_faiss_index
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark the similarity index backends: build time, query latency, "
+        "memory and recall@k against the exact flat index."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size', type=int, default=100000,
+                            help='Number of indexed vectors (synthetic source only)')
+        parser.add_argument('--queries', type=int, default=1000)
+        parser.add_argument('--k', type=int, default=10)
+        parser.add_argument('--dimension', type=int, default=384,
+                            help='Vector dimension (synthetic source only)')
+        parser.add_argument('--metric', choices=[COSINE, L2], default=COSINE)
+        parser.add_argument('--backends', default=','.join(INDEX_BACKENDS),
+                            help='Comma-separated backends to compare')
+        parser.add_argument('--ef-search', default='64,128,256',
+                            help='Comma-separated HNSW efSearch values to sweep')
+        parser.add_argument('--nprobe', default='8,32,128',
+                            help='Comma-separated IVF-PQ nprobe values to sweep')
+        parser.add_argument('--source', choices=['synthetic', 'db'], default='synthetic',
+                            help='Clustered random vectors, or the stored question embeddings')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        backends = [b for b in options['backends'].split(',') if b]
+        for backend in backends:
+            if backend not in INDEX_BACKENDS:
+                raise CommandError(f"Unknown backend: {backend}")
+
+        corpus, queries = self._load_vectors(options)
+        # The model is loaded lazily and never needed here
+        service = SimilarityService(metric=options['metric'])
+        corpus = service._prepare(corpus)
+        queries = service._prepare(queries)
+        k = min(options['k'], len(corpus))
+        self.stdout.write(
+            f"{len(corpus)} vectors x {corpus.shape[1]} dims, {len(queries)} queries, "
+            f"k={k}, metric={options['metric']}"
+        )
+
+        # Exact ground truth
+        flat, _ = build_faiss_index(corpus, options['metric'], FLAT)
+        start = time.perf_counter()
+        _, truth = flat.search(queries, k)
+        flat_latency = (time.perf_counter() - start) / len(queries)
+
+        self.stdout.write(
+            f"{'backend':<8} {'params':<14} {'build s':>9} {'ms/query':>9} "
+            f"{'speedup':>8} {f'recall@{k}':>10} {'index MB':>9}"
+        )
+        for backend in backends:
+            start = time.perf_counter()
+            index, built = build_faiss_index(corpus, options['metric'], backend)
+            build_seconds = time.perf_counter() - start
+            if built != backend:
+                self.stdout.write(f"{backend:<8} skipped: corpus too small, fell back to {built}")
+                continue
+            similarity_index = SimilarityIndex(
+                index, [], [], corpus, metric=options['metric'], backend=backend
+            )
+
+            for label, configure in self._sweep(backend, index, options):
+                configure()
+                start = time.perf_counter()
+                _, found = similarity_index.search(queries, k)
+                latency = (time.perf_counter() - start) / len(queries)
+                recall = np.mean([
+                    len(np.intersect1d(row, expected)) / k
+                    for row, expected in zip(found, truth)
+                ])
+                index_mb = (similarity_index.nbytes - corpus.nbytes) / 1024 ** 2
+                self.stdout.write(
+                    f"{backend:<8} {label:<14} {build_seconds:>9.2f} {latency * 1000:>9.3f} "
+                    f"{flat_latency / latency:>7.1f}x {recall:>10.4f} {index_mb:>9.1f}"
+                )
+
+    def _sweep(self, backend, index, options):
+        if backend == HNSW:
+            for ef in self._int_list(options['ef_search']):
+                yield f"efSearch={ef}", lambda ef=ef: setattr(index.hnsw, 'efSearch', ef)
+        elif backend == IVFPQ:
+            for nprobe in self._int_list(options['nprobe']):
+                yield f"nprobe={nprobe}", lambda nprobe=nprobe: setattr(index, 'nprobe', nprobe)
+        else:
+            yield 'exact', lambda: None
+
+    @staticmethod
+    def _int_list(value):
+        return [int(v) for v in value.split(',') if v]
+
+    def _load_vectors(self, options):
+        rng = np.random.default_rng(options['seed'])
+        if options['source'] == 'db':
+            vectors = np.array([
+                np.frombuffer(vector, dtype='float32')
+                for vector in QuestionEmbedding.objects.values_list('vector', flat=True).iterator()
+            ])
+            if len(vectors) <= options['queries']:
+                raise CommandError("Not enough stored embeddings for the requested query count")
+            rng.shuffle(vectors)
+            return vectors[options['queries']:], vectors[:options['queries']]
+
+        # Sentence embeddings are strongly clustered by topic; uniform noise
+        # would make approximate search look much worse than it is in practice
+        total = options['size'] + options['queries']
+        dimension = options['dimension']
+        centers = rng.standard_normal((max(1, total // 200), dimension), dtype=np.float32)
+        vectors = centers[rng.integers(0, len(centers), total)]
+        vectors += 0.5 * rng.standard_normal((total, dimension), dtype=np.float32)
+        return vectors[options['queries']:], vectors[:options['queries']]
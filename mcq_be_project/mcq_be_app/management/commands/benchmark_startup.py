@@ -0,0 +1,117 @@
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+# Runs in a fresh interpreter so every measurement is a real cold start
+CHILD_SCRIPT = '''
+import json, sys, time
+spec = json.loads(sys.argv[1])
+start = time.perf_counter()
+import django
+django.setup()
+setup_done = time.perf_counter()
+from django.urls import get_resolver
+get_resolver().url_patterns  # Imports every view module
+urls_done = time.perf_counter()
+result = {'setup': setup_done - start, 'import': urls_done - setup_done}
+if spec['path']:
+    from django.contrib.auth.models import User
+    from rest_framework.test import APIClient
+    client = APIClient()
+    client.force_authenticate(User.objects.get(pk=spec['user_id']))
+    request = getattr(client, spec['method'].lower())
+    for key in ('first', 'second'):
+        begin = time.perf_counter()
+        response = request(spec['path'], spec['body'], format='json')
+        result[key] = time.perf_counter() - begin
+    result['status'] = response.status_code
+print(json.dumps(result))
+'''
+
+DEFAULT_ENDPOINTS = [
+    'GET /api/courses/',
+    'GET /api/questions/similar-pairs/',
+    'POST /api/questions/check-similarity/ {"question_text": "What is the speed of light?"}',
+]
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure cold-start cost: Django setup, import of all views, and the "
+        "first and second request latency of each endpoint, each in a fresh process."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--endpoint', action='append', dest='endpoints',
+                            help='"METHOD /path/ [json body]"; repeatable. '
+                                 'Defaults to a few cheap and similarity endpoints')
+        parser.add_argument('--username',
+                            help='User the requests are authenticated as (default: first superuser or user)')
+        parser.add_argument('--runs', type=int, default=3,
+                            help='Fresh processes per endpoint; the median is reported')
+
+    def handle(self, *args, **options):
+        user = self._get_user(options['username'])
+        specs = [{'method': 'GET', 'path': None, 'body': None}]
+        specs += [self._parse_endpoint(endpoint) for endpoint in options['endpoints'] or DEFAULT_ENDPOINTS]
+
+        self.stdout.write(
+            f"{'endpoint':<50} {'setup ms':>9} {'import ms':>10} {'first ms':>9} {'second ms':>10} status"
+        )
+        for spec in specs:
+            spec['user_id'] = user.pk
+            runs = [self._run_child(spec) for _ in range(options['runs'])]
+            median = {
+                key: statistics.median(run[key] for run in runs) * 1000
+                for key in ('setup', 'import', 'first', 'second') if key in runs[0]
+            }
+            label = f"{spec['method']} {spec['path']}" if spec['path'] else '(import only)'
+            self.stdout.write(
+                f"{label:<50} {median['setup']:>9.0f} {median['import']:>10.0f} "
+                f"{median.get('first', 0):>9.0f} {median.get('second', 0):>10.0f} "
+                f"{runs[-1].get('status', '')}"
+            )
+
+    @staticmethod
+    def _get_user(username):
+        if username:
+            try:
+                return User.objects.get(username=username)
+            except User.DoesNotExist:
+                raise CommandError(f"User not found: {username}")
+        user = User.objects.order_by('-is_superuser', 'pk').first()
+        if user is None:
+            raise CommandError("No users exist; create one or pass --username")
+        return user
+
+    @staticmethod
+    def _parse_endpoint(endpoint):
+        parts = endpoint.split(None, 2)
+        if len(parts) < 2:
+            raise CommandError(f"Expected 'METHOD /path/ [json body]', got: {endpoint}")
+        try:
+            body = json.loads(parts[2]) if len(parts) == 3 else None
+        except ValueError:
+            raise CommandError(f"Invalid JSON body: {parts[2]}")
+        return {'method': parts[0].upper(), 'path': parts[1], 'body': body}
+
+    @staticmethod
+    def _run_child(spec):
+        env = os.environ.copy()
+        env['PYTHONPATH'] = os.pathsep.join(
+            path for path in (str(settings.BASE_DIR), env.get('PYTHONPATH')) if path
+        )
+        completed = subprocess.run(
+            [sys.executable, '-c', CHILD_SCRIPT, json.dumps(spec)],
+            env=env, capture_output=True, text=True
+        )
+        if completed.returncode != 0:
+            raise CommandError(f"Benchmark process failed:\n{completed.stderr}")
+        # Views may print; the result is the last line
+        return json.loads(completed.stdout.strip().splitlines()[-1])
@@ -0,0 +1,39 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from mcq_be_app.calibration import requeue_stale_jobs, run_pending_jobs
+
+
+class Command(BaseCommand):
+    help = (
+        "Run queued IRT calibration jobs. Needed with CALIBRATION_EXECUTOR=worker; "
+        "with the thread executor it picks up jobs lost to a web process restart. "
+        "Several workers can run side by side."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+                            help='Run the jobs pending now and exit')
+        parser.add_argument('--poll', type=float, default=2.0,
+                            help='Seconds between polls when the queue is empty')
+        parser.add_argument('--stale-after', type=int, default=60,
+                            help='Minutes after which a running job is presumed dead and requeued (0 = never)')
+
+    def handle(self, *args, **options):
+        stale_after = timedelta(minutes=options['stale_after'])
+        while True:
+            if options['stale_after']:
+                requeued = requeue_stale_jobs(stale_after)
+                if requeued:
+                    self.stdout.write(f"Requeued {requeued} stale job(s)")
+            ran = run_pending_jobs(limit=1 if not options['once'] else None)
+            if ran:
+                self.stdout.write(f"Ran {ran} job(s)")
+            if options['once']:
+                return
+            close_old_connections()
+            if not ran:
+                time.sleep(options['poll'])
@@ -0,0 +1,48 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from mcq_be_app.embedding_service import EmbeddingServer, parse_address, service_authkey
+from mcq_be_app.similarity_service import get_similarity_service
+
+
+class Command(BaseCommand):
+    help = (
+        "Run the shared embedding server: a pool of model worker processes that "
+        "encode micro-batched requests from all web processes. Point the web "
+        "processes at it with EMBEDDING_SERVICE_ADDRESS."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--address', default=settings.EMBEDDING_SERVICE_ADDRESS or '127.0.0.1:6010',
+                            help='"host:port" or Unix socket path to listen on')
+        parser.add_argument('--workers', type=int, default=settings.EMBEDDING_WORKERS)
+        parser.add_argument('--batch-size', type=int, default=settings.EMBEDDING_MAX_BATCH_SIZE,
+                            help='Maximum texts per model call')
+        parser.add_argument('--wait-ms', type=int, default=settings.EMBEDDING_BATCH_WAIT_MS,
+                            help='How long a batch waits for more requests')
+        parser.add_argument('--threads', type=int, default=0,
+                            help='Torch threads per worker (default: cores / workers)')
+
+    def handle(self, *args, **options):
+        service = get_similarity_service()
+        model_name, inference_backend, onnx_cache_dir, onnx_quantization = service.model_load_args
+        self.stdout.write(f"Loading {model_name} ({inference_backend}) in {options['workers']} worker(s)...")
+        server = EmbeddingServer(
+            model_name,
+            parse_address(options['address']),
+            service_authkey(),
+            workers=options['workers'],
+            max_batch_size=options['batch_size'],
+            max_wait=options['wait_ms'] / 1000,
+            threads_per_worker=options['threads'],
+            inference_backend=inference_backend,
+            onnx_cache_dir=onnx_cache_dir,
+            onnx_quantization=onnx_quantization
+        )
+        self.stdout.write(self.style.SUCCESS(f"Embedding server listening on {options['address']}"))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.close()
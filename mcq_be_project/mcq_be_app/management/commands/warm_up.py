@@ -0,0 +1,56 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from mcq_be_app.models import Question
+from mcq_be_app.similarity_service import get_similarity_service
+
+
+class Command(BaseCommand):
+    help = (
+        "Load the heavy subsystems (similarity model, FAISS, pandas, SciPy, spaCy) "
+        "ahead of the first request. Run it at build time to fetch the model "
+        "weights, or with --embeddings to precompute the stored question embeddings."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--skip-model', action='store_true',
+                            help='Only import the libraries, do not load the similarity model')
+        parser.add_argument('--embeddings', action='store_true',
+                            help='Encode and store embeddings for all questions that lack one')
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Questions per batch with --embeddings')
+
+    def handle(self, *args, **options):
+        self._timed('pandas', lambda: __import__('pandas'))
+        self._timed('SciPy', lambda: __import__('mcq_be_app.irt_engine'))
+        self._timed('faiss', lambda: __import__('faiss'))
+        self._timed('spaCy', self._load_spacy)
+
+        service = get_similarity_service()
+        if not options['skip_model']:
+            self._timed(f"similarity model {service.model_name}", service.warm_up)
+
+        if options['embeddings']:
+            self._timed('question embeddings', lambda: self._store_embeddings(service, options['batch_size']))
+
+    def _timed(self, label, load):
+        start = time.perf_counter()
+        try:
+            load()
+        except (ImportError, OSError) as e:
+            self.stdout.write(self.style.WARNING(f"{label}: skipped ({e})"))
+            return
+        self.stdout.write(f"{label}: {(time.perf_counter() - start) * 1000:.0f} ms")
+
+    @staticmethod
+    def _load_spacy():
+        from mcq_be_app.validators import get_nlp
+        get_nlp()
+
+    def _store_embeddings(self, service, batch_size):
+        question_ids = list(Question.objects.order_by('id').values_list('id', flat=True))
+        for start in range(0, len(question_ids), batch_size):
+            # load_embeddings encodes and persists only missing or stale rows
+            service.load_embeddings(Question.objects.filter(id__in=question_ids[start:start + batch_size]))
+        self.stdout.write(f"Checked embeddings of {len(question_ids)} questions")
@@ -0,0 +1,29 @@
+# Generated by Django 5.1.7 on 2026-10-17 02:58
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mcq_be_app', '0011_questiongroup_question_question_group'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QuestionEmbedding',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model_name', models.CharField(max_length=255)),
+                ('text_hash', models.CharField(max_length=64)),
+                ('vector', models.BinaryField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('question', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='embeddings', to='mcq_be_app.question')),
+            ],
+            options={
+                'unique_together': {('question', 'model_name')},
+            },
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.1.7 on 2026-10-17 03:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mcq_be_app', '0012_questionembedding'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CachedEmbedding',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model_name', models.CharField(max_length=255)),
+                ('text_hash', models.CharField(max_length=64)),
+                ('vector', models.BinaryField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='questionembedding',
+            index=models.Index(fields=['model_name', 'text_hash'], name='mcq_be_app__model_n_5fd8d3_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='cachedembedding',
+            unique_together={('model_name', 'text_hash')},
+        ),
+    ]
@@ -0,0 +1,42 @@
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def set_job_courses(apps, schema_editor):
+    CalibrationJob = apps.get_model('mcq_be_app', 'CalibrationJob')
+    Test = apps.get_model('mcq_be_app', 'Test')
+    CalibrationJob.objects.filter(course__isnull=True).update(
+        course=Subquery(Test.objects.filter(pk=OuterRef('test_id')).values('course_id')[:1])
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mcq_be_app', '0014_calibrationjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='calibrationjob',
+            name='scope',
+            field=models.CharField(choices=[('test', 'Test'), ('course', 'Course (pooled)')], default='test', max_length=20),
+        ),
+        migrations.AddField(
+            model_name='calibrationjob',
+            name='course',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='calibration_jobs', to='mcq_be_app.course'),
+        ),
+        migrations.RunPython(set_job_courses, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='calibrationjob',
+            name='course',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='calibration_jobs', to='mcq_be_app.course'),
+        ),
+        migrations.AlterField(
+            model_name='calibrationjob',
+            name='test',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='calibration_jobs', to='mcq_be_app.test'),
+        ),
+    ]
@@ -0,0 +1,61 @@
+import numpy as np
+from django.db import migrations, models
+
+BATCH_SIZE = 2000
+
+
+def pack_answers(apps, schema_editor):
+    TestResult = apps.get_model('mcq_be_app', 'TestResult')
+    batch = []
+    for result in TestResult.objects.only('id', 'answers').iterator(chunk_size=BATCH_SIZE):
+        answers = np.asarray(result.answers or []) > 0
+        result.answer_bits = np.packbits(answers).tobytes()
+        result.answer_count = len(answers)
+        batch.append(result)
+        if len(batch) == BATCH_SIZE:
+            TestResult.objects.bulk_update(batch, ['answer_bits', 'answer_count'])
+            batch = []
+    TestResult.objects.bulk_update(batch, ['answer_bits', 'answer_count'])
+
+
+def unpack_answers(apps, schema_editor):
+    TestResult = apps.get_model('mcq_be_app', 'TestResult')
+    batch = []
+    for result in TestResult.objects.only('id', 'answer_bits', 'answer_count').iterator(chunk_size=BATCH_SIZE):
+        bits = np.frombuffer(bytes(result.answer_bits), dtype='uint8')
+        result.answers = np.unpackbits(bits, count=result.answer_count).tolist()
+        batch.append(result)
+        if len(batch) == BATCH_SIZE:
+            TestResult.objects.bulk_update(batch, ['answers'])
+            batch = []
+    TestResult.objects.bulk_update(batch, ['answers'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mcq_be_app', '0015_calibrationjob_scope'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='testresult',
+            name='answer_bits',
+            field=models.BinaryField(default=b''),
+        ),
+        migrations.AddField(
+            model_name='testresult',
+            name='answer_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='testresult',
+            name='answers',
+            field=models.JSONField(null=True),
+        ),
+        migrations.RunPython(pack_answers, unpack_answers),
+        migrations.RemoveField(
+            model_name='testresult',
+            name='answers',
+        ),
+    ]
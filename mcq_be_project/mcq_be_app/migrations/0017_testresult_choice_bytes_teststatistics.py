@@ -0,0 +1,33 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mcq_be_app', '0016_testresult_answer_bits'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='testresult',
+            name='choice_bytes',
+            field=models.BinaryField(default=b''),
+        ),
+        migrations.CreateModel(
+            name='TestStatistics',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('num_students', models.PositiveIntegerField(default=0)),
+                ('num_items', models.PositiveIntegerField(default=0)),
+                ('mean_score', models.FloatField(default=0)),
+                ('sd_score', models.FloatField(default=0)),
+                ('kr20', models.FloatField(blank=True, null=True)),
+                ('cronbach_alpha', models.FloatField(blank=True, null=True)),
+                ('sem', models.FloatField(blank=True, null=True)),
+                ('items', models.JSONField(default=dict)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('test', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='statistics', to='mcq_be_app.test')),
+            ],
+        ),
+    ]
@@ -0,0 +1,27 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mcq_be_app', '0017_testresult_choice_bytes_teststatistics'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CachedCalibration',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('response_hash', models.CharField(max_length=64, unique=True)),
+                ('model', models.CharField(max_length=10)),
+                ('parameters', models.JSONField(default=dict)),
+                ('diagnostics', models.JSONField(default=dict)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='teststatistics',
+            name='irt',
+            field=models.JSONField(default=dict),
+        ),
+    ]
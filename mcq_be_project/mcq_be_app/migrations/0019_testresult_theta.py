@@ -0,0 +1,21 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mcq_be_app', '0018_cachedcalibration_teststatistics_irt'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='testresult',
+            name='theta',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='testresult',
+            name='theta_se',
+            field=models.FloatField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,26 @@
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mcq_be_app', '0019_testresult_theta'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TestVersionMapping',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('versions', models.JSONField(default=list)),
+                ('num_questions', models.PositiveIntegerField()),
+                ('question_index', models.BinaryField()),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('created_by', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='version_mappings', to=settings.AUTH_USER_MODEL)),
+                ('test', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='version_mapping', to='mcq_be_app.test')),
+            ],
+        ),
+    ]
@@ -1,10 +1,15 @@
 from django.db import models
 from django.contrib.auth.models import User
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
 from django.contrib import admin
 import uuid
 
+import numpy as np
+
+from .responses import pack_answers, unpack_answers
+from .scoring import VersionIndex
+
 
 class UserProfile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE, related_name="profile")
@@ -108,6 +113,51 @@ class Question(models.Model):
         return self.question_text[:50]
 
 
+class QuestionEmbedding(models.Model):
+    question = models.ForeignKey(
+        Question, related_name="embeddings", on_delete=models.CASCADE
+    )
+    model_name = models.CharField(max_length=255)
+    text_hash = models.CharField(max_length=64)  # sha256 of the normalized question_text
+    vector = models.BinaryField()  # Raw float32 bytes
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ("question", "model_name")
+        indexes = [models.Index(fields=["model_name", "text_hash"])]  # Embedding cache lookups
+
+    def __str__(self):
+        return f"Embedding of question {self.question_id} ({self.model_name})"
+
+
+class CachedEmbedding(models.Model):
+    # Embeddings of texts that are not (yet) questions, e.g. drafts being checked
+    model_name = models.CharField(max_length=255)
+    text_hash = models.CharField(max_length=64)  # sha256 of the normalized text
+    vector = models.BinaryField()  # Raw float32 bytes
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ("model_name", "text_hash")
+
+    def __str__(self):
+        return f"Cached embedding {self.text_hash[:12]} ({self.model_name})"
+
+
+@receiver(post_save, sender=Question)
+def refresh_question_embedding(sender, instance, **kwargs):
+    # Imported lazily: the similarity service depends on this module
+    from .similarity_service import queue_question_change
+    queue_question_change(instance)
+
+
+@receiver(post_delete, sender=Question)
+def drop_question_from_similarity_index(sender, instance, **kwargs):
+    from .similarity_service import queue_question_change
+    queue_question_change(instance)
+
+
 class Answer(models.Model):
     question = models.ForeignKey(
         Question, related_name="answers", on_delete=models.CASCADE
@@ -176,15 +226,125 @@ class TestQuestion(models.Model):
         return f"Question {self.question.id} in Test {self.test.id}"
 
 
+class TestVersionMapping(models.Model):
+    """
+    Question order of each shuffled version of a test, validated once when
+    it is uploaded and then used to score every result upload of the test.
+    """
+    test = models.OneToOneField(Test, on_delete=models.CASCADE, related_name='version_mapping')
+    versions = models.JSONField(default=list)  # Version names, in mapping sheet order
+    num_questions = models.PositiveIntegerField()  # Questions of the test when the mapping was validated
+    question_index = models.BinaryField()  # int16 versions x version question numbers, see scoring.VersionIndex
+    created_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, related_name='version_mappings')
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def version_index(self) -> VersionIndex:
+        return VersionIndex(
+            self.versions,
+            np.frombuffer(self.question_index, dtype='int16').reshape(len(self.versions), -1)
+        )
+
+    def set_version_index(self, version_index: VersionIndex):
+        self.versions = list(version_index.versions)
+        self.question_index = version_index.question_index.astype('int16').tobytes()
+
+    def __str__(self):
+        return f"Version mapping of Test {self.test_id} ({len(self.versions)} versions)"
+
+
 class TestResult(models.Model):
     test = models.ForeignKey(Test, on_delete=models.CASCADE, related_name='results')
     student_id = models.CharField(max_length=36)  # Will use UUID
-    answers = models.JSONField()  # Will store array of booleans
+    answer_bits = models.BinaryField(default=b'')  # np.packbits of the responses, 1 = correct
+    answer_count = models.PositiveIntegerField(default=0)
+    choice_bytes = models.BinaryField(default=b'')  # Chosen option label per question as ASCII, 0 = blank
+    theta = models.FloatField(null=True, blank=True)  # Ability from the last calibration, see irt.estimate_abilities
+    theta_se = models.FloatField(null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
     class Meta:
         unique_together = ['test', 'student_id']
 
+    @property
+    def answers(self):
+        return unpack_answers(self.answer_bits, self.answer_count)
+
+    @answers.setter
+    def answers(self, values):
+        self.answer_bits, self.answer_count = pack_answers(values)
+
+
+class TestStatistics(models.Model):
+    """Classical item analysis of a test's stored results, from item_analysis.py."""
+    test = models.OneToOneField(Test, on_delete=models.CASCADE, related_name='statistics')
+    num_students = models.PositiveIntegerField(default=0)
+    num_items = models.PositiveIntegerField(default=0)
+    mean_score = models.FloatField(default=0)
+    sd_score = models.FloatField(default=0)
+    kr20 = models.FloatField(null=True, blank=True)
+    cronbach_alpha = models.FloatField(null=True, blank=True)
+    sem = models.FloatField(null=True, blank=True)
+    items = models.JSONField(default=dict)  # Item statistics keyed by question id
+    irt = models.JSONField(default=dict)  # Diagnostics of the last IRT fit, from irt_engine.py
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Statistics of Test {self.test_id}"
+
+
+class CachedCalibration(models.Model):
+    # IRT fits keyed by the response matrix they were fitted on, see irt_engine.py
+    response_hash = models.CharField(max_length=64, unique=True)  # sha256 of the responses and fit settings
+    model = models.CharField(max_length=10)
+    parameters = models.JSONField(default=dict)  # discrimination/difficulty/guessing lists in column order
+    diagnostics = models.JSONField(default=dict)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Cached {self.model} calibration {self.response_hash[:12]}"
+
+
+class CalibrationJob(models.Model):
+    """
+    IRT calibration run outside the request by calibration.py: of one test's
+    results, or pooled over every result of a course.
+    """
+    TEST = 'test'
+    COURSE = 'course'
+    SCOPE_CHOICES = [
+        (TEST, 'Test'),
+        (COURSE, 'Course (pooled)'),
+    ]
+    PENDING = 'pending'
+    RUNNING = 'running'
+    COMPLETED = 'completed'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (COMPLETED, 'Completed'),
+        (FAILED, 'Failed'),
+    ]
+    scope = models.CharField(max_length=20, choices=SCOPE_CHOICES, default=TEST)
+    course = models.ForeignKey(Course, on_delete=models.CASCADE, related_name='calibration_jobs')
+    test = models.ForeignKey(Test, on_delete=models.CASCADE, null=True, blank=True, related_name='calibration_jobs')
+    created_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, related_name='calibration_jobs')
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=PENDING)
+    progress = models.PositiveSmallIntegerField(default=0)  # Percent
+    stage = models.CharField(max_length=100, blank=True)
+    result = models.JSONField(default=dict)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['status', 'created_at'])]
+
+    def __str__(self):
+        target = f"Test {self.test_id}" if self.scope == self.TEST else f"Course {self.course_id}"
+        return f"Calibration job {self.id} for {target} ({self.status})"
+
 
 class TestDraft(models.Model):
     course = models.ForeignKey(Course, on_delete=models.CASCADE, related_name='test_drafts')
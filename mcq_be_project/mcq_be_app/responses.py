@@ -0,0 +1,56 @@
+"""
+Packed storage of TestResult answer vectors.
+
+A student's responses are stored as bits (1 = correct) with np.packbits,
+plus their count, instead of a JSON array: 60 answers take 8 bytes, and a
+whole test decodes into a NumPy matrix with one query, a byte join and
+np.unpackbits, without parsing any JSON. The chosen options are stored next
+to them as one ASCII byte per question (0 = blank).
+"""
+from typing import Iterable, List, Tuple
+
+import numpy as np
+
+
+def pack_answers(answers: Iterable) -> Tuple[bytes, int]:
+    """Returns (packed bits, number of answers)."""
+    answers = np.asarray(list(answers)) > 0
+    return np.packbits(answers).tobytes(), len(answers)
+
+
+def pack_rows(matrix: np.ndarray) -> List[bytes]:
+    """Pack each row of a students x questions 0/1 matrix."""
+    return [row.tobytes() for row in np.packbits(np.asarray(matrix) > 0, axis=1)]
+
+
+def unpack_answers(bits: bytes, count: int) -> List[int]:
+    return np.unpackbits(np.frombuffer(bits, dtype='uint8'), count=count).tolist()
+
+
+def unpack_rows(rows: Iterable[bytes], count: int) -> np.ndarray:
+    """Stack packed rows of the same answer count into a uint8 students x questions matrix."""
+    packed = np.frombuffer(b''.join(rows), dtype='uint8')
+    return np.unpackbits(packed.reshape(-1, (count + 7) // 8), axis=1, count=count)
+
+
+def load_result_matrices(results, num_questions: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Load the responses and chosen options of a TestResult queryset in one query.
+
+    Rows whose answer count differs from num_questions (uploaded before the
+    test's questions changed) are left out.
+
+    Returns:
+        Tuple of (uint8 students x questions responses, uint8 students x
+        questions option codes, 0 where unknown, e.g. for results stored
+        before options were recorded)
+    """
+    rows = list(results.filter(answer_count=num_questions).values_list('answer_bits', 'choice_bytes'))
+    if not rows or not num_questions:
+        return np.zeros((len(rows), num_questions), dtype='uint8'), np.zeros((len(rows), num_questions), dtype='uint8')
+    answer_bits, choice_bytes = zip(*rows)
+    blank = bytes(num_questions)
+    choices = np.frombuffer(
+        b''.join(bytes(row) if len(row) == num_questions else blank for row in choice_bytes), dtype='uint8'
+    ).reshape(-1, num_questions)
+    return unpack_rows(answer_bits, num_questions), choices
@@ -0,0 +1,57 @@
+"""
+Streaming export of a test's results.
+
+One row per student with the raw score, the ability (theta) estimated by the
+last calibration and its standard error, as CSV or NDJSON. Results are read
+in primary-key order a chunk at a time and encoded as the response is sent,
+so an export holds one chunk in memory however many students the test has.
+"""
+import csv
+import json
+from typing import Dict, Iterable, Iterator
+
+import numpy as np
+
+FIELDS = ['student_id', 'score', 'max_score', 'theta', 'theta_se']
+CONTENT_TYPES = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+
+
+def iter_result_rows(results, chunk_size: int = 1000) -> Iterator[Dict]:
+    """Export rows of a TestResult queryset, one chunk query at a time."""
+    results = results.order_by('id')
+    last_id = 0
+    while chunk := list(results.filter(id__gt=last_id).values_list(
+        'id', 'student_id', 'answer_bits', 'answer_count', 'theta', 'theta_se'
+    )[:chunk_size]):
+        for _, student_id, answer_bits, answer_count, theta, theta_se in chunk:
+            yield {
+                'student_id': student_id,
+                # Padding bits of np.packbits are zero, so the set bits are the correct answers
+                'score': int(np.unpackbits(np.frombuffer(answer_bits, dtype='uint8')).sum()),
+                'max_score': answer_count,
+                'theta': theta,
+                'theta_se': theta_se,
+            }
+        last_id = chunk[-1][0]
+
+
+class _Echo:
+    """File-like object for csv.writer that hands each line back instead of storing it."""
+
+    def write(self, value):
+        return value
+
+
+def encode_rows(rows: Iterable[Dict], output: str) -> Iterator[str]:
+    """Encode export rows as CSV lines (with a header) or NDJSON lines."""
+    if output == 'ndjson':
+        for row in rows:
+            yield json.dumps(row) + '\n'
+        return
+    writer = csv.DictWriter(_Echo(), fieldnames=FIELDS)
+    yield writer.writeheader()
+    for row in rows:
+        yield writer.writerow(row)
@@ -0,0 +1,121 @@
+"""
+Streaming readers for uploaded result files.
+
+An upload is either an xlsx workbook (answers on the first sheet, version
+mapping on the third) or a CSV pair (answers file + mapping file), as
+exported by the scanner software. Once a test has a stored version mapping
+the answers can come alone. The mapping is small and read whole; the
+answers are yielded as DataFrame chunks of a fixed number of students, read
+with openpyxl in read-only mode or pandas' chunked CSV reader, so memory
+stays bounded by the chunk size however large the session is.
+"""
+import os
+from contextlib import contextmanager
+from itertools import islice
+from typing import Iterator, Optional, Tuple
+
+import pandas as pd
+
+CSV_EXTENSIONS = {'.csv', '.txt'}
+MAPPING_SHEET = 2
+
+
+class ResultFileError(ValueError):
+    pass
+
+
+def is_csv(file) -> bool:
+    return os.path.splitext(getattr(file, 'name', '') or '')[1].lower() in CSV_EXTENSIONS
+
+
+@contextmanager
+def open_result_upload(file, mapping_file=None, chunk_size: int = 1000, with_mapping: bool = True):
+    """
+    Open an uploaded result file.
+
+    Args:
+        file: Answers: xlsx workbook or CSV
+        mapping_file: Version mapping (CSV, or the first sheet of an xlsx);
+            required with a CSV answers file, overrides the workbook's third sheet
+        chunk_size: Students per answers chunk
+        with_mapping: Read the mapping; without it, mapping_file and the
+            workbook's third sheet are ignored and None is yielded instead
+
+    Yields:
+        Tuple of (mapping DataFrame or None, iterator over answers DataFrame chunks)
+    """
+    workbook = None
+    try:
+        if is_csv(file):
+            if with_mapping and mapping_file is None:
+                raise ResultFileError(
+                    'A mapping file is required with a CSV answers file, unless the test has a stored version mapping'
+                )
+            answer_chunks = _csv_chunks(file, chunk_size)
+        else:
+            workbook = _open_workbook(file)
+            answer_chunks = _sheet_chunks(workbook.worksheets[0], chunk_size)
+
+        if not with_mapping:
+            df_mapping = None
+        elif mapping_file is not None:
+            df_mapping = read_mapping(mapping_file)
+        elif len(workbook.worksheets) <= MAPPING_SHEET:
+            raise ResultFileError('The workbook has no mapping sheet (expected as the third sheet)')
+        else:
+            df_mapping = _sheet_frame(workbook.worksheets[MAPPING_SHEET])
+        yield df_mapping, answer_chunks
+    finally:
+        if workbook is not None:
+            workbook.close()
+
+
+def read_mapping(file) -> pd.DataFrame:
+    if is_csv(file):
+        return pd.read_csv(file, encoding='utf-8-sig')
+    workbook = _open_workbook(file)
+    try:
+        return _sheet_frame(workbook.worksheets[0])
+    finally:
+        workbook.close()
+
+
+def _open_workbook(file):
+    from openpyxl import load_workbook
+
+    return load_workbook(file, read_only=True, data_only=True)
+
+
+def _csv_chunks(file, chunk_size: int) -> Iterator[pd.DataFrame]:
+    # Read as text: answer codes such as "01" must keep their last character
+    yield from pd.read_csv(file, dtype=str, chunksize=chunk_size, encoding='utf-8-sig')
+
+
+def _sheet_chunks(sheet, chunk_size: int) -> Iterator[pd.DataFrame]:
+    rows = sheet.iter_rows(values_only=True)
+    header = _header(rows)
+    if header is None:
+        return
+    width = len(header)
+    while chunk := [row[:width] for row in islice(rows, chunk_size)]:
+        # object dtype keeps cell values as read; blank cells would otherwise turn ints into floats
+        yield pd.DataFrame(chunk, columns=header, dtype=object)
+
+
+def _sheet_frame(sheet) -> pd.DataFrame:
+    rows = sheet.iter_rows(values_only=True)
+    header = _header(rows)
+    if header is None:
+        return pd.DataFrame()
+    width = len(header)
+    return pd.DataFrame([row[:width] for row in rows], columns=header).dropna(how='all')
+
+
+def _header(rows) -> Optional[Tuple]:
+    header = next(rows, None)
+    if header is None:
+        return None
+    # Read-only sheets can report trailing empty columns
+    while header and header[-1] is None:
+        header = header[:-1]
+    return tuple(header)
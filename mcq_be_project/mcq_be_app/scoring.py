@@ -0,0 +1,162 @@
+"""
+Vectorized scoring of uploaded answer sheets.
+
+An upload has an answers sheet (one row per student, columns C1..Cn whose
+values are the chosen option followed by '1' when the answer is correct,
+e.g. 'B1', or '0' when it is not) and a mapping sheet (first
+column: question number in the test; every other column: the number of
+that question in one shuffled version). The version each student took is
+not recorded, so every student is scored against every version at once
+and the version is picked per student afterwards.
+
+A validated mapping is kept as a VersionIndex, the array form that
+TestVersionMapping stores so that later uploads skip the mapping sheet.
+"""
+import re
+from dataclasses import dataclass
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+ANSWER_COLUMN = re.compile(r'^C(\d+)$')
+
+
+def build_version_mappings(df_mapping) -> Dict[str, Dict[int, int]]:
+    """
+    Read the mapping sheet into {version: {version question number: test question number}}.
+
+    Rows missing either number are skipped.
+    """
+    db_questions = df_mapping.iloc[:, 0].to_numpy()
+    db_present = df_mapping.iloc[:, 0].notna().to_numpy()
+    version_mappings = {}
+    for version_col in df_mapping.columns[1:]:
+        column = df_mapping[version_col]
+        present = db_present & column.notna().to_numpy()
+        version_mappings[version_col] = dict(zip(
+            column.to_numpy()[present].astype(int).tolist(),
+            db_questions[present].astype(int).tolist()
+        ))
+    return version_mappings
+
+
+def mapping_mismatches(version_mappings: Dict[str, Dict[int, int]], num_questions: int) -> Dict[str, int]:
+    """Versions that do not map onto exactly the test's questions, with how many of them they map."""
+    questions = set(range(1, num_questions + 1))
+    mismatches = {}
+    for version, mapping in version_mappings.items():
+        mapped = set(mapping.values())
+        if mapped != questions:
+            mismatches[version] = len(mapped & questions)
+    return mismatches
+
+
+@dataclass
+class VersionIndex:
+    versions: List[str]
+    # versions x version question numbers: 0-based index of the test question, -1 if none
+    question_index: np.ndarray
+
+    @classmethod
+    def from_mappings(cls, version_mappings: Dict[str, Dict[int, int]], num_questions: int) -> 'VersionIndex':
+        versions = list(version_mappings)
+        width = max((max(mapping, default=0) for mapping in version_mappings.values()), default=0)
+        question_index = np.full((len(versions), width), -1, dtype='int16')
+        for v, version in enumerate(versions):
+            for number, question in version_mappings[version].items():
+                if number >= 1 and 1 <= question <= num_questions:
+                    question_index[v, number - 1] = question - 1
+        return cls(versions, question_index)
+
+
+def score_answer_sheet(
+    df_answers,
+    version_index: VersionIndex,
+    num_questions: int
+) -> Tuple[np.ndarray, np.ndarray, List[str], np.ndarray]:
+    """
+    Score every student against every version.
+
+    Each version's mapping becomes a (answer columns x questions) placement
+    matrix, so one matrix product yields the (students x versions x questions)
+    correctness tensor. A student's version is chosen with the rule the
+    upload has always used: going through the versions in order, a version
+    replaces the current pick when it places more answers than the pick
+    has correct answers. Students with no placeable answer are skipped.
+
+    Args:
+        df_answers: Answers sheet
+        version_index: Mapping of the versions, e.g. VersionIndex.from_mappings(build_version_mappings(...))
+        num_questions: Number of questions in the test
+
+    Returns:
+        Tuple of (response matrix of the scored students as int8
+        students x questions, their row positions in the sheet, the version
+        each of them was scored with, the option they chose for each
+        question as uint8 ASCII codes with 0 for blank or unlabelled)
+    """
+    versions = version_index.versions
+    answer_columns = [
+        (col, int(match.group(1)))
+        for col in df_answers.columns
+        if isinstance(col, str) and (match := ANSWER_COLUMN.match(col))
+    ]
+    num_students = len(df_answers)
+    if not versions or not answer_columns or not num_students:
+        return (
+            np.zeros((0, num_questions), dtype='int8'), np.zeros(0, dtype=int), [],
+            np.zeros((0, num_questions), dtype='uint8')
+        )
+
+    answers = df_answers[[col for col, _ in answer_columns]]
+    answered = answers.notna().to_numpy()
+    codes = answers.astype(str).to_numpy().astype(str)
+    correct = answered & np.char.endswith(codes, '1')
+
+    # placement[v, c, q]: answer column c holds test question q in version v;
+    # question_column[v, q]: that column, or the extra blank column past the last one
+    placement = np.zeros((len(versions), len(answer_columns), num_questions), dtype='float32')
+    question_column = np.full((len(versions), num_questions), len(answer_columns))
+    numbers = np.array([q_num for _, q_num in answer_columns])
+    known = (numbers >= 1) & (numbers <= version_index.question_index.shape[1])
+    column_question = np.full((len(versions), len(answer_columns)), -1)
+    column_question[:, known] = version_index.question_index[:, numbers[known] - 1]
+    column_question[column_question >= num_questions] = -1
+    v_placed, c_placed = np.nonzero(column_question >= 0)
+    q_placed = column_question[v_placed, c_placed]
+    placement[v_placed, c_placed, q_placed] = 1
+    question_column[v_placed, q_placed] = c_placed
+
+    # (students x versions) answers placed, and (students x versions x questions) correctness
+    placed_counts = answered.astype('float32') @ placement.any(axis=2).T.astype('float32')
+    num_versions, num_columns, _ = placement.shape
+    responses = (
+        correct.astype('float32') @ placement.transpose(1, 0, 2).reshape(num_columns, -1)
+    ).reshape(num_students, num_versions, num_questions) > 0
+    correct_counts = responses.sum(axis=2)
+
+    chosen = np.full(num_students, -1)
+    chosen_correct = np.zeros(num_students)
+    for v in range(len(versions)):
+        better = placed_counts[:, v] > chosen_correct
+        chosen[better] = v
+        chosen_correct[better] = correct_counts[better, v]
+
+    rows = np.flatnonzero(chosen >= 0)
+    response_matrix = responses[rows, chosen[rows]].astype('int8')
+    choices = np.take_along_axis(
+        np.hstack([_option_codes(codes[rows], answered[rows]), np.zeros((len(rows), 1), dtype='uint8')]),
+        question_column[chosen[rows]],
+        axis=1
+    )
+    return response_matrix, rows, [versions[v] for v in chosen[rows]], choices
+
+
+def _option_codes(codes: np.ndarray, answered: np.ndarray) -> np.ndarray:
+    """ASCII code of each single-character option label (the answer code minus its 0/1 flag), 0 if none."""
+    labels = np.char.strip(np.char.rstrip(codes, '01'))
+    single = answered & (np.char.str_len(labels) == 1)
+    option_codes = np.zeros(labels.shape, dtype='uint8')
+    if single.any():
+        option_codes[single] = np.frombuffer(''.join(labels[single]).encode('ascii', 'replace'), dtype='uint8')
+    return option_codes
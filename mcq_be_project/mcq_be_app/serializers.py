@@ -1,5 +1,8 @@
+from collections import defaultdict
+
+from django.db.models import Count, Max, Prefetch
 from rest_framework import serializers
-from .models import QuestionBank, Question, Answer, Course, Taxonomy, QuestionTaxonomy, TestQuestion, Test, TestDraft, QuestionGroup
+from .models import QuestionBank, Question, Answer, Course, Taxonomy, QuestionTaxonomy, TestQuestion, Test, TestDraft, QuestionGroup, CalibrationJob, TestStatistics, TestVersionMapping
 from django.utils.timezone import localtime
 
 
@@ -43,11 +46,35 @@ class QuestionTaxonomySerializer(serializers.ModelSerializer):
         fields = ["id", "taxonomy", "level"]
 
 
+def question_prefetches(prefix=''):
+    """
+    Prefetch lookups for everything QuestionSerializer reads, so serializing
+    any number of questions takes two extra queries. `prefix` is the path to
+    the questions, e.g. 'test_questions__question__' from a Test queryset.
+    """
+    return [
+        f'{prefix}answers',
+        Prefetch(f'{prefix}taxonomies', queryset=QuestionTaxonomy.objects.select_related('taxonomy')),
+    ]
+
+
+def test_prefetches():
+    """Prefetch lookups for everything TestSerializer reads."""
+    return [
+        Prefetch('test_questions', queryset=TestQuestion.objects.select_related('question')),
+        *question_prefetches('test_questions__question__'),
+    ]
+
+
+def is_prefetched(obj, name):
+    return name in getattr(obj, '_prefetched_objects_cache', {})
+
+
 class QuestionSerializer(serializers.ModelSerializer):
     answers = AnswerSerializer(many=True, read_only=True)
     taxonomies = serializers.SerializerMethodField()
     statistics = serializers.SerializerMethodField()
-    question_bank_id = serializers.IntegerField(source='question_bank.id', read_only=True)
+    question_bank_id = serializers.IntegerField(read_only=True)
     question_group_id = serializers.PrimaryKeyRelatedField(
         source='question_group',
         queryset=QuestionGroup.objects.all(),
@@ -71,7 +98,9 @@ class QuestionSerializer(serializers.ModelSerializer):
         ]
 
     def get_taxonomies(self, obj):
-        question_taxonomies = obj.taxonomies.select_related('taxonomy').all()
+        question_taxonomies = obj.taxonomies.all()
+        if not is_prefetched(obj, 'taxonomies'):
+            question_taxonomies = question_taxonomies.select_related('taxonomy')
         return [
             {
                 'id': qt.id,
@@ -172,8 +201,54 @@ class QuestionSerializer(serializers.ModelSerializer):
         return stats
 
 
+def load_bank_tree(banks):
+    """
+    Load banks with their whole subtrees for QuestionBankSerializer.
+
+    Every bank of the banks' courses is read in one query, annotated with
+    its question count and latest question update, and the hierarchy is
+    assembled in Python; the questions of all banks in the subtrees come
+    from one more (prefetched) query. Each bank gets `loaded_children` and
+    `loaded_questions`, which the serializer uses instead of querying.
+
+    Returns:
+        The given banks, in order, as loaded instances
+    """
+    roots = list(banks)
+    if not roots:
+        return roots
+    course_banks = {
+        bank.id: bank
+        for bank in QuestionBank.objects.filter(course_id__in={root.course_id for root in roots}).annotate(
+            num_questions=Count('questions'), questions_updated_at=Max('questions__updated_at')
+        ).order_by('id')
+    }
+    children = defaultdict(list)
+    for bank in course_banks.values():
+        if bank.parent_id in course_banks:
+            children[bank.parent_id].append(bank)
+
+    roots = [course_banks.get(root.id, root) for root in roots]
+    subtree = {}
+    pending = list(roots)
+    while pending:
+        bank = pending.pop()
+        if bank.id in subtree:
+            continue
+        subtree[bank.id] = bank
+        bank.loaded_children = children[bank.id]
+        bank.loaded_questions = []
+        pending.extend(bank.loaded_children)
+
+    for question in Question.objects.filter(question_bank_id__in=subtree).prefetch_related(
+        *question_prefetches()
+    ).order_by('id'):
+        subtree[question.question_bank_id].loaded_questions.append(question)
+    return roots
+
+
 class QuestionBankSerializer(serializers.ModelSerializer):
-    questions = QuestionSerializer(many=True, read_only=True)
+    questions = serializers.SerializerMethodField()
     question_count = serializers.SerializerMethodField()
     last_modified = serializers.SerializerMethodField()
     children = serializers.SerializerMethodField()
@@ -184,19 +259,35 @@ class QuestionBankSerializer(serializers.ModelSerializer):
         allow_null=True
     )
 
+    # Banks from load_bank_tree are serialized from what it loaded; others are queried
+
+    def get_questions(self, obj):
+        questions = getattr(obj, 'loaded_questions', None)
+        if questions is None:
+            questions = obj.questions.all()
+        return QuestionSerializer(questions, many=True).data
+
     def get_children(self, obj):
-        children = obj.children.all()
+        children = getattr(obj, 'loaded_children', None)
+        if children is None:
+            children = obj.children.all()
         return QuestionBankSerializer(children, many=True).data
 
     def get_question_count(self, obj):
+        if hasattr(obj, 'num_questions'):
+            return obj.num_questions
         return obj.questions.count()
 
     def get_last_modified(self, obj):
-        latest_question = obj.questions.order_by("-updated_at").first()
+        if hasattr(obj, 'questions_updated_at'):
+            latest_update = obj.questions_updated_at
+        elif is_prefetched(obj, 'questions'):
+            latest_update = max((question.updated_at for question in obj.questions.all()), default=None)
+        else:
+            latest_question = obj.questions.order_by("-updated_at").first()
+            latest_update = latest_question.updated_at if latest_question else None
         bank_updated = localtime(obj.updated_at) if hasattr(obj, "updated_at") else None
-        question_updated = (
-            localtime(latest_question.updated_at) if latest_question else None
-        )
+        question_updated = localtime(latest_update) if latest_update else None
 
         if bank_updated and question_updated:
             return max(bank_updated, question_updated)
@@ -277,3 +368,62 @@ class QuestionGroupSerializer(serializers.ModelSerializer):
             'updated_at'
         ]
         read_only_fields = ['question_bank']
+
+
+class CalibrationJobSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = CalibrationJob
+        fields = [
+            "id",
+            "scope",
+            "course",
+            "test",
+            "status",
+            "progress",
+            "stage",
+            "result",
+            "error",
+            "created_at",
+            "started_at",
+            "finished_at",
+        ]
+
+
+class TestStatisticsSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = TestStatistics
+        fields = [
+            "test",
+            "num_students",
+            "num_items",
+            "mean_score",
+            "sd_score",
+            "kr20",
+            "cronbach_alpha",
+            "sem",
+            "items",
+            "irt",
+            "updated_at",
+        ]
+
+
+class TestVersionMappingSerializer(serializers.ModelSerializer):
+    # {version: [test question number of version question 1, 2, ... or None]}
+    mapping = serializers.SerializerMethodField()
+
+    class Meta:
+        model = TestVersionMapping
+        fields = [
+            "test",
+            "versions",
+            "num_questions",
+            "mapping",
+            "updated_at",
+        ]
+
+    def get_mapping(self, obj):
+        version_index = obj.version_index()
+        return {
+            version: [int(q) + 1 if q >= 0 else None for q in row]
+            for version, row in zip(version_index.versions, version_index.question_index)
+        }
@@ -1,191 +1,910 @@
-from sentence_transformers import SentenceTransformer
-import faiss
 import numpy as np
-from typing import List, Dict, Tuple, Optional
-from .models import Question
+import threading
+from collections import OrderedDict, defaultdict
+from typing import Callable, List, Dict, Tuple, Optional
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Max
+from .embedding_cache import EmbeddingCache, text_hash
+from .embedding_service import INFERENCE_BACKENDS, TORCH, create_encoder, embedding_key, load_sentence_transformer
+from .models import Question, QuestionBank, QuestionEmbedding, QuestionTaxonomy, TestQuestion
 import logging
 
 logger = logging.getLogger(__name__)
 
-class SimilarityService:
-    """Service for finding similar questions using vector embeddings and FAISS."""
+_pending_changes = threading.local()
+
+# Index scopes: every question, one course, or one question bank
+GLOBAL_SCOPE = ('all', None)
+
+# Similarity metrics. 'cosine' searches L2-normalized embeddings with an
+# inner-product index so scores are true cosine similarities; 'l2' keeps the
+# legacy squared-L2 distance index and its 1 - distance / 10 score mapping.
+COSINE = 'cosine'
+L2 = 'l2'
+
+# Index backends. 'flat' is exact; 'hnsw' and 'ivfpq' are approximate and
+# trade a little recall for much faster search on large corpora. 'auto'
+# picks one from the corpus size.
+FLAT = 'flat'
+HNSW = 'hnsw'
+IVFPQ = 'ivfpq'
+AUTO = 'auto'
+INDEX_BACKENDS = (FLAT, HNSW, IVFPQ)
+
+# Fewest vectors needed to train 8-bit product quantizer codebooks
+IVFPQ_MIN_TRAINING_SIZE = 39 * 256
+
+
+def _setting(name: str, default):
+    return getattr(settings, name, default)
+
+
+def select_index_backend(size: int, backend: Optional[str] = None) -> str:
+    """
+    Resolve the index backend to use for a corpus of the given size.
+    
+    Args:
+        size: Number of vectors to index
+        backend: One of INDEX_BACKENDS or AUTO; defaults to the
+            SIMILARITY_INDEX_BACKEND setting
+    """
+    backend = backend or _setting('SIMILARITY_INDEX_BACKEND', AUTO)
+    if backend == AUTO:
+        if size < _setting('SIMILARITY_HNSW_MIN_SIZE', 50000):
+            return FLAT
+        if size < _setting('SIMILARITY_IVFPQ_MIN_SIZE', 2000000):
+            return HNSW
+        return IVFPQ
+    if backend not in INDEX_BACKENDS:
+        raise ValueError(f"Unsupported index backend: {backend}")
+    if backend == IVFPQ and size < IVFPQ_MIN_TRAINING_SIZE:
+        logger.warning(f"Too few vectors ({size}) to train IVF-PQ, using a flat index")
+        return FLAT
+    return backend
+
+
+def build_faiss_index(embeddings: np.ndarray, metric: str, backend: Optional[str] = None):
+    """
+    Build a FAISS index over prepared embeddings.
+    
+    Args:
+        embeddings: float32 matrix, already normalized in COSINE mode
+        metric: COSINE or L2
+        backend: One of INDEX_BACKENDS or AUTO; see select_index_backend
+        
+    Returns:
+        Tuple of (index, resolved backend name)
+    """
+    size, dimension = embeddings.shape
+    backend = select_index_backend(size, backend)
+    import faiss
+    faiss_metric = faiss.METRIC_INNER_PRODUCT if metric == COSINE else faiss.METRIC_L2
+
+    if backend == HNSW:
+        index = faiss.IndexHNSWFlat(dimension, _setting('SIMILARITY_HNSW_M', 32), faiss_metric)
+        index.hnsw.efConstruction = _setting('SIMILARITY_HNSW_EF_CONSTRUCTION', 200)
+        index.hnsw.efSearch = _setting('SIMILARITY_HNSW_EF_SEARCH', 128)
+    elif backend == IVFPQ:
+        # Roughly 4 * sqrt(n) lists, keeping at least 39 training points per list
+        nlist = _setting('SIMILARITY_IVFPQ_NLIST', 0) or int(4 * np.sqrt(size))
+        nlist = max(1, min(nlist, size // 39))
+        if metric == COSINE:
+            quantizer = faiss.IndexFlatIP(dimension)
+        else:
+            quantizer = faiss.IndexFlatL2(dimension)
+        index = faiss.IndexIVFPQ(
+            quantizer,
+            dimension,
+            nlist,
+            _setting('SIMILARITY_IVFPQ_M', 96),  # Sub-quantizers; must divide the dimension
+            8,
+            faiss_metric
+        )
+        # Train on a sample; k-means quality saturates well before the full corpus
+        sample_size = min(size, max(256 * nlist, IVFPQ_MIN_TRAINING_SIZE))
+        sample = embeddings[np.random.default_rng(0).choice(size, sample_size, replace=False)]
+        index.train(sample)
+        index.nprobe = _setting('SIMILARITY_IVFPQ_NPROBE', 32)
+    elif metric == COSINE:
+        index = faiss.IndexFlatIP(dimension)
+    else:
+        index = faiss.IndexFlatL2(dimension)
+
+    if size:
+        index.add(embeddings)
+    return index, backend
+
+
+def bank_scope(question_bank_id: int) -> Tuple[str, int]:
+    return ('bank', int(question_bank_id))
+
+
+def course_scope(course_id: int) -> Tuple[str, int]:
+    return ('course', int(course_id))
+
+
+def test_scope(test_id: int) -> Tuple[str, int]:
+    return ('test', int(test_id))
+
+
+class QuestionMetadata:
+    """
+    Per-row attributes of the questions in a SimilarityIndex.
     
-    def __init__(self, model_name: str = 'all-MiniLM-L6-v2'):
+    Kept alongside the vectors so search results can be enriched and
+    filtered without going back to the database.
+    """
+
+    def __init__(
+        self,
+        question_bank_ids: List[int],
+        difficulties: List[str],
+        taxonomies: List[Dict[int, str]],
+        taxonomy_names: Dict[int, str]
+    ):
         """
-        Initialize the similarity service with a sentence transformer model.
+        Args:
+            question_bank_ids: Question bank of each row
+            difficulties: Difficulty of each row
+            taxonomies: For each row, a dict of taxonomy id to level
+            taxonomy_names: Name of every taxonomy referenced
+        """
+        self.question_bank_ids = np.asarray(question_bank_ids, dtype='int64')
+        self.difficulties = np.asarray(difficulties, dtype=object)
+        self.taxonomies = taxonomies
+        self.taxonomy_names = taxonomy_names
+
+    def describe(self, row: int) -> Dict:
+        return {
+            'question_bank_id': int(self.question_bank_ids[row]),
+            'difficulty': self.difficulties[row],
+            'taxonomies': [
+                {
+                    'taxonomy_id': taxonomy_id,
+                    'taxonomy_name': self.taxonomy_names.get(taxonomy_id),
+                    'level': level
+                }
+                for taxonomy_id, level in self.taxonomies[row].items()
+            ]
+        }
+
+    def mask(
+        self,
+        question_bank_ids: Optional[List[int]] = None,
+        difficulties: Optional[List[str]] = None,
+        taxonomy_id: Optional[int] = None,
+        taxonomy_levels: Optional[List[str]] = None
+    ) -> Optional[np.ndarray]:
+        """
+        Boolean mask of the rows matching every given filter, or None when
+        no filter is given.
         
         Args:
-            model_name: Name of the sentence-transformers model to use
+            question_bank_ids: Keep questions of these banks
+            difficulties: Keep questions with one of these difficulties
+            taxonomy_id: Keep questions classified under this taxonomy
+            taxonomy_levels: With taxonomy_id, keep only these levels
         """
-        self.model = SentenceTransformer(model_name)
-        self.index = None
-        self.question_ids = []
-        self.dimension = self.model.get_sentence_embedding_dimension()
+        if question_bank_ids is None and not difficulties and taxonomy_id is None:
+            return None
+        mask = np.ones(len(self.question_bank_ids), dtype=bool)
+        if question_bank_ids is not None:
+            mask &= np.isin(self.question_bank_ids, [int(bank_id) for bank_id in question_bank_ids])
+        if difficulties:
+            mask &= np.isin(self.difficulties, list(difficulties))
+        if taxonomy_id is not None:
+            taxonomy_id = int(taxonomy_id)
+            levels = set(taxonomy_levels) if taxonomy_levels else None
+            mask &= np.fromiter(
+                (
+                    taxonomy_id in row and (levels is None or row[taxonomy_id] in levels)
+                    for row in self.taxonomies
+                ),
+                dtype=bool,
+                count=len(self.taxonomies)
+            )
+        return mask
+
+
+class SimilarityIndex:
+    """A FAISS index over a fixed set of questions, with their embeddings, texts and metadata."""
+
+    def __init__(
+        self,
+        index,
+        question_ids: List[int],
+        question_texts: List[str],
+        embeddings: np.ndarray,
+        fingerprint=None,
+        metric: str = COSINE,
+        backend: str = FLAT,
+        metadata: Optional[QuestionMetadata] = None
+    ):
+        self.index = index
+        self.question_ids = question_ids
+        self.question_texts = question_texts
+        self.embeddings = embeddings
+        self.fingerprint = fingerprint
+        self.metric = metric
+        self.backend = backend
+        self.metadata = metadata
+
+    def describe(self, row: int) -> Dict:
+        """Id, text and metadata of the question in a row."""
+        result = {
+            'question_id': self.question_ids[row],
+            'question_text': self.question_texts[row]
+        }
+        if self.metadata is not None:
+            result.update(self.metadata.describe(row))
+        return result
+
+    @property
+    def ntotal(self) -> int:
+        return self.index.ntotal
+
+    @property
+    def nbytes(self) -> int:
+        """Approximate memory held by the index and embedding matrix."""
+        if self.backend == HNSW:
+            index_bytes = self.ntotal * (self.index.d * 4 + self.index.hnsw.nb_neighbors(0) * 4)
+        elif self.backend == IVFPQ:
+            index_bytes = self.ntotal * (self.index.code_size + 8)
+        else:
+            index_bytes = self.ntotal * self.index.d * 4
+        return index_bytes + self.embeddings.nbytes
+
+    def _search_params(self, mask: Optional[np.ndarray]):
+        """FAISS search parameters restricting the search to the masked rows."""
+        if mask is None:
+            return None
+        import faiss
+        selector = faiss.IDSelectorBatch(np.flatnonzero(mask).astype('int64'))
+        if self.backend == HNSW:
+            return faiss.SearchParametersHNSW(sel=selector, efSearch=self.index.hnsw.efSearch)
+        if self.backend == IVFPQ:
+            return faiss.SearchParametersIVF(sel=selector, nprobe=self.index.nprobe)
+        return faiss.SearchParameters(sel=selector)
+
+    def search(
+        self,
+        queries: np.ndarray,
+        k: int,
+        mask: Optional[np.ndarray] = None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Search the index for the k best matches of each query.
         
-        # Initialize an empty FAISS index
-        self.reset_index()
+        Product-quantized indexes only approximate scores, so their candidates
+        are over-fetched and re-scored exactly against the stored embeddings;
+        every backend thus returns scores on the same scale as a flat index.
+        Missing results are padded with index -1.
+        
+        Args:
+            queries: Query vectors, prepared like the indexed embeddings
+            k: Number of results per query
+            mask: Optional boolean mask of the rows that may be returned
+        """
+        k = min(k, self.ntotal)
+        if mask is not None and not mask.any():
+            return (
+                np.full((len(queries), k), -np.inf if self.metric == COSINE else np.inf, dtype='float32'),
+                np.full((len(queries), k), -1, dtype='int64')
+            )
+        params = self._search_params(mask)
+        if self.backend != IVFPQ:
+            return self.index.search(queries, k, params=params)
+
+        candidates = min(self.ntotal, k * _setting('SIMILARITY_RERANK_FACTOR', 10))
+        _, indices = self.index.search(queries, candidates, params=params)
+        missing = indices < 0
+        vectors = self.embeddings[np.where(missing, 0, indices)]
+        scores = np.einsum('qd,qcd->qc', queries, vectors)
+        if self.metric == COSINE:
+            scores[missing] = -np.inf
+            order = np.argsort(-scores, axis=1)[:, :k]
+        else:
+            scores = (queries ** 2).sum(axis=1)[:, None] + (vectors ** 2).sum(axis=2) - 2 * scores
+            scores[missing] = np.inf
+            order = np.argsort(scores, axis=1)[:, :k]
+        indices = np.where(missing, -1, indices)
+        return (
+            np.take_along_axis(scores, order, axis=1),
+            np.take_along_axis(indices, order, axis=1)
+        )
+
+
+class TestSignature:
+    """
+    The unit-length question embeddings of a test and their centroid.
     
-    def reset_index(self):
-        """Reset the FAISS index."""
-        self.index = faiss.IndexFlatL2(self.dimension)
-        self.question_ids = []
+    The centroid is the plain mean of the unit vectors, so the dot product of
+    two centroids equals the mean pairwise cosine similarity of the tests,
+    i.e. their overall_similarity in compare_tests.
+    """
+
+    def __init__(self, questions: List[Dict], embeddings: np.ndarray, fingerprint=None):
+        self.questions = questions
+        self.embeddings = embeddings
+        self.centroid = (
+            embeddings.mean(axis=0) if len(questions)
+            else np.zeros(embeddings.shape[1], dtype='float32')
+        )
+        self.fingerprint = fingerprint
+
+    @property
+    def nbytes(self) -> int:
+        return self.embeddings.nbytes + self.centroid.nbytes
+
+
+class IndexRegistry:
+    """
+    Thread-safe LRU cache of similarity indexes keyed by scope.
     
-    def add_questions(self, questions: List[Dict]):
+    Indexes are built lazily on first use and the least recently used ones
+    are evicted once their combined size exceeds the memory budget. The most
+    recently used index is always kept, even if it alone exceeds the budget.
+    """
+
+    def __init__(self, memory_budget: int):
         """
-        Add questions to the index.
-        
         Args:
-            questions: List of question dictionaries with 'id' and 'question_text' fields
+            memory_budget: Maximum total size of cached indexes, in bytes
         """
-        if not questions:
-            return
-            
-        texts = [q.get('question_text', '') for q in questions]
-        ids = [q.get('id') for q in questions]
-        
-        # Generate embeddings
-        embeddings = self.model.encode(texts, convert_to_numpy=True)
-        
-        # Add to FAISS index
-        self.index.add(np.array(embeddings).astype('float32'))
-        self.question_ids.extend(ids)
+        self.memory_budget = memory_budget
+        self._indexes = OrderedDict()
+        self._lock = threading.Lock()
+        self._build_locks = {}
+
+    def get(
+        self,
+        scope: Tuple,
+        build: Callable[[], SimilarityIndex],
+        fingerprint=None
+    ) -> SimilarityIndex:
+        """
+        Return the cached index for a scope, building it if needed.
         
-        logger.info(f"Added {len(questions)} questions to similarity index")
+        Args:
+            scope: Scope key, e.g. bank_scope(3)
+            build: Callable building the index when it is missing or stale
+            fingerprint: Optional value describing the current data; a cached
+                index built from a different fingerprint is rebuilt
+        """
+        entry = self.lookup(scope, fingerprint)
+        if entry is not None:
+            return entry
+
+        # Only one thread builds a given scope; the others wait and reuse it
+        with self._lock:
+            build_lock = self._build_locks.setdefault(scope, threading.Lock())
+        with build_lock:
+            entry = self.lookup(scope, fingerprint)
+            if entry is None:
+                entry = build()
+                self.put(scope, entry)
+        return entry
+
+    def lookup(self, scope: Tuple, fingerprint=None):
+        """Return the cached entry of a scope, or None if it is missing or stale."""
+        with self._lock:
+            entry = self._indexes.get(scope)
+            if entry is None:
+                return None
+            if fingerprint is not None and entry.fingerprint != fingerprint:
+                del self._indexes[scope]
+                return None
+            self._indexes.move_to_end(scope)
+            return entry
+
+    def put(self, scope: Tuple, entry):
+        """Cache an entry, evicting least recently used ones beyond the budget."""
+        with self._lock:
+            self._indexes[scope] = entry
+            self._indexes.move_to_end(scope)
+            self._evict()
+
+    def invalidate(self, *scopes: Tuple):
+        """Drop the cached indexes of the given scopes."""
+        with self._lock:
+            for scope in scopes:
+                self._indexes.pop(scope, None)
+
+    def clear(self):
+        with self._lock:
+            self._indexes.clear()
+
+    @property
+    def nbytes(self) -> int:
+        with self._lock:
+            return sum(entry.nbytes for entry in self._indexes.values())
+
+    def _evict(self):
+        total = sum(entry.nbytes for entry in self._indexes.values())
+        while total > self.memory_budget and len(self._indexes) > 1:
+            scope, entry = self._indexes.popitem(last=False)
+            total -= entry.nbytes
+            logger.info(f"Evicted similarity index {scope} ({entry.nbytes} bytes)")
+
+
+class SimilarityService:
+    """Service for finding similar questions using vector embeddings and FAISS."""
     
-    def build_index_from_db(self, question_bank_id: Optional[int] = None):
+    def __init__(
+        self,
+        model_name: str = 'all-MiniLM-L6-v2',
+        metric: Optional[str] = None,
+        inference_backend: Optional[str] = None
+    ):
         """
-        Build the index from questions in the database.
+        Initialize the similarity service with a sentence transformer model.
         
         Args:
-            question_bank_id: Optional ID to filter questions by question bank
+            model_name: Name of the sentence-transformers model to use
+            metric: COSINE or L2; defaults to the SIMILARITY_METRIC setting
+            inference_backend: 'torch', 'onnx' or 'onnx-int8'; defaults to
+                the SIMILARITY_INFERENCE_BACKEND setting
         """
-        # Reset the index
-        self.reset_index()
+        self.model_name = model_name
+        self.metric = metric or getattr(settings, 'SIMILARITY_METRIC', COSINE)
+        if self.metric not in (COSINE, L2):
+            raise ValueError(f"Unsupported similarity metric: {self.metric}")
+        self.inference_backend = inference_backend or _setting('SIMILARITY_INFERENCE_BACKEND', TORCH)
+        if self.inference_backend not in INFERENCE_BACKENDS:
+            raise ValueError(f"Unsupported inference backend: {self.inference_backend}")
+        # Stored embeddings are keyed by this, not the bare model name
+        self.embedding_key = embedding_key(model_name, self.inference_backend)
+        self._model = None
+        self._encoder = None
+        self._model_lock = threading.Lock()
+        memory_budget = _setting('SIMILARITY_INDEX_MEMORY_BUDGET_MB', 512) * 1024 * 1024
+        self.indexes = IndexRegistry(memory_budget)
+        self.embedding_cache = EmbeddingCache(
+            _setting('EMBEDDING_CACHE_SIZE', 20000),
+            persist=_setting('EMBEDDING_CACHE_DB', False)
+        )
+        self.test_signatures = IndexRegistry(memory_budget // 4)
+
+    @property
+    def model(self):
+        """
+        The sentence transformer, loaded on first use.
         
-        # Query questions from database
-        queryset = Question.objects.all()
-        if question_bank_id:
-            queryset = queryset.filter(question_bank_id=question_bank_id)
+        Loading it (and importing torch) takes seconds, so it is deferred
+        until a request actually needs embeddings.
+        """
+        if self._model is None:
+            with self._model_lock:
+                if self._model is None:
+                    logger.info(f"Loading sentence transformer {self.model_name} ({self.inference_backend})")
+                    self._model = load_sentence_transformer(*self.model_load_args)
+        return self._model
+
+    @property
+    def model_load_args(self) -> Tuple:
+        """Arguments of load_sentence_transformer for this service's model."""
+        return (
+            self.model_name,
+            self.inference_backend,
+            _setting('SIMILARITY_ONNX_CACHE_DIR', 'onnx_models'),
+            _setting('SIMILARITY_ONNX_QUANTIZATION', '') or None
+        )
+
+    @property
+    def encoder(self):
+        """Batching encoder, local or backed by the embedding server (see embedding_service)."""
+        if self._encoder is None:
+            with self._model_lock:
+                if self._encoder is None:
+                    self._encoder = create_encoder(self.embedding_key, lambda: self.model)
+        return self._encoder
+
+    @property
+    def dimension(self) -> int:
+        return self.encoder.dimension
+
+    def warm_up(self):
+        """Load the model and FAISS and run one encode, so the first request doesn't pay for it."""
+        import faiss  # noqa: F401
+        self._encode(['warm up'])
+
+    def _encode(self, texts: List[str]) -> np.ndarray:
+        """
+        Encode texts into a float32 embedding matrix.
+        
+        Texts are looked up in the embedding cache by content hash first;
+        only unseen texts are encoded, each once. Requests from concurrent
+        threads are micro-batched by the encoder rather than running the
+        model in parallel.
+        """
+        if not texts:
+            return np.empty((0, self.dimension), dtype='float32')
+        hashes = [text_hash(text) for text in texts]
+        vectors = self.embedding_cache.get_many(self.embedding_key, hashes)
+        missing = {}
+        for text, key in zip(texts, hashes):
+            if key not in vectors:
+                missing.setdefault(key, text)
+        if missing:
+            fresh = np.asarray(self.encoder.encode(list(missing.values())), dtype='float32')
+            fresh = dict(zip(missing, fresh))
+            self.embedding_cache.put_many(self.embedding_key, fresh)
+            vectors.update(fresh)
+        return np.stack([vectors[key] for key in hashes])
+
+    @staticmethod
+    def _normalize(embeddings: np.ndarray) -> np.ndarray:
+        """Return a copy of the embeddings scaled to unit length, so dot products are cosines."""
+        import faiss
+        embeddings = np.array(embeddings, dtype='float32', order='C')
+        faiss.normalize_L2(embeddings)
+        return embeddings
+
+    def _prepare(self, embeddings: np.ndarray) -> np.ndarray:
+        """Bring raw embeddings into the space searched by the index."""
+        return self._normalize(embeddings) if self.metric == COSINE else embeddings
+
+    def _to_similarity(self, scores: np.ndarray) -> np.ndarray:
+        """Convert raw index scores to similarity scores (1 = identical)."""
+        if self.metric == COSINE:
+            return scores
+        # Squared L2 distance: normalize and invert
+        return 1 - np.minimum(np.maximum(scores, 0) / 10, 1.0)
+
+    def load_embeddings(self, queryset) -> Tuple[List[Dict], np.ndarray]:
+        """
+        Load the stored embeddings of a question queryset.
+        
+        Only questions without a stored embedding for this model, or whose
+        text changed since it was stored, are encoded; the fresh vectors are
+        persisted in one batch. The model is not loaded when every stored
+        embedding is current.
+        
+        Args:
+            queryset: Question queryset to load embeddings for
             
+        Returns:
+            Tuple of (questions as dicts with 'id' and 'question_text',
+            float32 matrix with one row per question)
+        """
         questions = list(queryset.values('id', 'question_text'))
-        self.add_questions(questions)
+        if not questions:
+            return questions, np.empty((0, 0), dtype='float32')
+
+        stored = {
+            question_id: (stored_hash, vector)
+            for question_id, stored_hash, vector in QuestionEmbedding.objects.filter(
+                model_name=self.embedding_key,
+                question__in=queryset.values('id')
+            ).values_list('question_id', 'text_hash', 'vector')
+        }
+
+        vectors = [None] * len(questions)
+        stale_rows = []
+        stale_hashes = []
+        for row, question in enumerate(questions):
+            content_hash = text_hash(question['question_text'])
+            entry = stored.get(question['id'])
+            if entry and entry[0] == content_hash:
+                vectors[row] = np.frombuffer(entry[1], dtype='float32')
+            else:
+                stale_rows.append(row)
+                stale_hashes.append(content_hash)
+
+        if stale_rows:
+            fresh = self._encode([questions[row]['question_text'] for row in stale_rows])
+            for row, vector in zip(stale_rows, fresh):
+                vectors[row] = vector
+            QuestionEmbedding.objects.bulk_create(
+                [
+                    QuestionEmbedding(
+                        question_id=questions[row]['id'],
+                        model_name=self.embedding_key,
+                        text_hash=content_hash,
+                        vector=vector.tobytes()
+                    )
+                    for row, content_hash, vector in zip(stale_rows, stale_hashes, fresh)
+                ],
+                update_conflicts=True,
+                unique_fields=['question', 'model_name'],
+                update_fields=['text_hash', 'vector', 'updated_at']
+            )
+            logger.info(f"Encoded and stored {len(stale_rows)} question embeddings")
+
+        return questions, np.vstack(vectors)
+
+    @staticmethod
+    def _scope_queryset(scope: Tuple):
+        kind, scope_id = scope
+        queryset = Question.objects.all()
+        if kind == 'bank':
+            queryset = queryset.filter(question_bank_id=scope_id)
+        elif kind == 'course':
+            queryset = queryset.filter(question_bank__course_id=scope_id)
+        return queryset
+
+    @staticmethod
+    def _load_metadata(queryset, question_ids: List[int]) -> QuestionMetadata:
+        """Read the metadata side table of a scope in two queries."""
+        details = {
+            question_id: (question_bank_id, difficulty)
+            for question_id, question_bank_id, difficulty in queryset.values_list(
+                'id', 'question_bank_id', 'difficulty'
+            )
+        }
+        taxonomies = defaultdict(dict)
+        taxonomy_names = {}
+        for question_id, taxonomy_id, taxonomy_name, level in QuestionTaxonomy.objects.filter(
+            question__in=queryset.values('id')
+        ).values_list('question_id', 'taxonomy_id', 'taxonomy__name', 'level'):
+            taxonomies[question_id][taxonomy_id] = level
+            taxonomy_names[taxonomy_id] = taxonomy_name
+        return QuestionMetadata(
+            [details[question_id][0] for question_id in question_ids],
+            [details[question_id][1] for question_id in question_ids],
+            [taxonomies.get(question_id, {}) for question_id in question_ids],
+            taxonomy_names
+        )
+
+    def _build_index(self, scope: Tuple, fingerprint=None) -> SimilarityIndex:
+        queryset = self._scope_queryset(scope)
+        questions, embeddings = self.load_embeddings(queryset)
+        embeddings = self._prepare(embeddings)
+        index, backend = build_faiss_index(embeddings, self.metric)
+        question_ids = [q['id'] for q in questions]
         
-        logger.info(f"Built similarity index with {len(questions)} questions")
-        return len(questions)
+        logger.info(f"Built {backend} similarity index {scope} with {len(questions)} questions")
+        return SimilarityIndex(
+            index,
+            question_ids,
+            [q['question_text'] for q in questions],
+            embeddings,
+            fingerprint,
+            self.metric,
+            backend,
+            self._load_metadata(queryset, question_ids)
+        )
+
+    def get_index(
+        self,
+        question_bank_id: Optional[int] = None,
+        course_id: Optional[int] = None
+    ) -> SimilarityIndex:
+        """
+        Return the similarity index for a question bank, a course or, when
+        neither is given, every question in the database.
+        
+        Cached indexes are reused as long as the question and taxonomy
+        counts and latest update times of their scope are unchanged, so
+        edits made through other worker processes are picked up too.
+        """
+        if question_bank_id:
+            scope = bank_scope(question_bank_id)
+        elif course_id:
+            scope = course_scope(course_id)
+        else:
+            scope = GLOBAL_SCOPE
+
+        fingerprint = tuple(self._scope_queryset(scope).aggregate(
+            count=Count('id', distinct=True),
+            last_updated=Max('updated_at'),
+            taxonomy_count=Count('taxonomies'),
+            taxonomy_last_updated=Max('taxonomies__updated_at')
+        ).values())
+        return self.indexes.get(
+            scope,
+            lambda: self._build_index(scope, fingerprint),
+            fingerprint
+        )
+
+    def invalidate(self, question_bank_id: int, course_id: Optional[int] = None):
+        """Drop the cached indexes containing questions of a question bank."""
+        scopes = [bank_scope(question_bank_id), GLOBAL_SCOPE]
+        if course_id:
+            scopes.append(course_scope(course_id))
+        self.indexes.invalidate(*scopes)
     
     def find_similar_questions(
         self, 
         query_text: str, 
+        question_bank_id: Optional[int] = None,
+        course_id: Optional[int] = None,
         threshold: float = 0.75, 
-        top_k: int = 5
+        top_k: int = 5,
+        filters: Optional[Dict] = None
     ) -> List[Dict]:
         """
         Find questions similar to the query text.
         
         Args:
             query_text: The question text to find similarities for
-            threshold: Similarity threshold (lower distance = more similar)
+            question_bank_id: Optional ID to restrict the search to a question bank
+            course_id: Optional ID to restrict the search to a course
+            threshold: Minimum similarity score (cosine similarity in COSINE mode)
             top_k: Maximum number of similar questions to return
+            filters: Optional QuestionMetadata.mask arguments (question_bank_ids,
+                difficulties, taxonomy_id, taxonomy_levels)
+            
+        Returns:
+            List of similar questions with similarity scores, texts and metadata
+        """
+        return self.find_similar_questions_batch(
+            [query_text], question_bank_id, course_id, threshold, top_k, filters=filters
+        )['matches'][0]
+
+    def find_similar_questions_batch(
+        self,
+        query_texts: List[str],
+        question_bank_id: Optional[int] = None,
+        course_id: Optional[int] = None,
+        threshold: float = 0.75,
+        top_k: int = 5,
+        duplicate_threshold: Optional[float] = None,
+        filters: Optional[Dict] = None
+    ) -> Dict:
+        """
+        Find the questions similar to each of many candidate texts.
+        
+        All candidates are encoded in one call and searched with one index
+        query, so checking a generated batch or an upload costs about as
+        much as checking a single text.
+        
+        Args:
+            query_texts: Candidate question texts
+            question_bank_id: Optional ID to restrict the search to a question bank
+            course_id: Optional ID to restrict the search to a course
+            threshold: Minimum similarity score (cosine similarity in COSINE mode)
+            top_k: Maximum number of similar questions per candidate
+            duplicate_threshold: If given, also report pairs of candidates
+                at least this similar to each other
+            filters: Optional QuestionMetadata.mask arguments restricting
+                which questions may match
             
         Returns:
-            List of similar questions with similarity scores
+            Dict containing:
+                - matches: For each candidate, its list of similar questions
+                  with their texts and metadata
+                - batch_duplicates: Pairs of similar candidates (index1 < index2),
+                  most similar first; only with duplicate_threshold
         """
-        if not self.index or self.index.ntotal == 0:
+        result = {'matches': [[] for _ in query_texts]}
+        if duplicate_threshold is not None:
+            result['batch_duplicates'] = []
+        if not query_texts:
+            return result
+
+        similarity_index = self.get_index(question_bank_id, course_id)
+        if similarity_index.ntotal == 0 and duplicate_threshold is None:
             logger.warning("Similarity index is empty")
-            return []
+            return result
             
-        # Generate embedding for query
-        query_embedding = self.model.encode([query_text], convert_to_numpy=True)
+        # Generate embeddings for all candidates at once
+        query_embeddings = self._prepare(self._encode(query_texts))
         
         # Search the index
-        distances, indices = self.index.search(
-            np.array(query_embedding).astype('float32'), 
-            min(top_k, self.index.ntotal)
-        )
-        
-        # Format results
-        results = []
-        for i, (idx, distance) in enumerate(zip(indices[0], distances[0])):
-            # Convert distance to similarity score (1 = identical, 0 = completely different)
-            similarity = 1 - min(distance / 10, 1.0)  # Normalize and invert
+        if similarity_index.ntotal:
+            mask = similarity_index.metadata.mask(**filters) if filters else None
+            scores, indices = similarity_index.search(query_embeddings, top_k, mask)
+            similarities = self._to_similarity(scores)
             
-            if similarity >= threshold:
-                question_id = self.question_ids[idx]
-                results.append({
-                    'question_id': question_id,
-                    'similarity': round(float(similarity), 4)
-                })
+            # Format results from the index's side table
+            for matches, row_indices, row_similarities in zip(result['matches'], indices, similarities):
+                for idx, similarity in zip(row_indices, row_similarities):
+                    if idx >= 0 and similarity >= threshold:
+                        match = similarity_index.describe(idx)
+                        match['similarity'] = round(float(similarity), 4)
+                        matches.append(match)
+
+        if duplicate_threshold is not None and len(query_texts) > 1:
+            gram = query_embeddings @ query_embeddings.T
+            if self.metric == COSINE:
+                pair_similarities = gram
+            else:
+                squared_norms = np.diag(gram)
+                pair_similarities = self._to_similarity(
+                    squared_norms[:, None] + squared_norms[None, :] - 2 * gram
+                )
+            rows, cols = np.nonzero(np.triu(pair_similarities >= duplicate_threshold, k=1))
+            pair_scores = pair_similarities[rows, cols]
+            order = np.argsort(-pair_scores, kind='stable')
+            result['batch_duplicates'] = [
+                {'index1': int(i), 'index2': int(j), 'similarity': round(float(score), 4)}
+                for i, j, score in zip(rows[order], cols[order], pair_scores[order])
+            ]
                 
-        return results
+        return result
     
     def find_similar_pairs(
         self, 
         question_bank_id: Optional[int] = None,
         threshold: float = 0.85,
-        max_pairs: int = 100
+        max_pairs: int = 100,
+        block_size: int = 512
     ) -> List[Dict]:
         """
         Find all pairs of similar questions within a question bank.
         
+        Scores are computed in blocks of rows against the cached embedding
+        matrix, so memory stays at block_size x bank size no matter how
+        large the bank is. Each unordered pair is reported once.
+        
         Args:
             question_bank_id: Optional ID to filter questions by question bank
             threshold: Similarity threshold
             max_pairs: Maximum number of pairs to return
+            block_size: Number of rows scored per matrix product
             
         Returns:
-            List of similar question pairs with similarity scores
+            The max_pairs most similar question pairs, highest similarity first
         """
-        # Build or update the index
-        self.build_index_from_db(question_bank_id)
+        similarity_index = self.get_index(question_bank_id)
+        total = similarity_index.ntotal
         
-        if self.index.ntotal < 2:
+        if total < 2 or max_pairs <= 0:
             return []
             
-        # Get all questions
-        queryset = Question.objects.all()
-        if question_bank_id:
-            queryset = queryset.filter(question_bank_id=question_bank_id)
-            
-        questions = list(queryset.values('id', 'question_text'))
+        embeddings = similarity_index.embeddings
+        if self.metric == L2:
+            sq_norms = (embeddings ** 2).sum(axis=1)
+            # Squared distance at which the similarity score drops below the threshold
+            radius = 10 * (1 - threshold) if threshold > 0 else np.inf
         
-        # Find similar pairs
-        similar_pairs = []
-        for i, question in enumerate(questions):
-            if len(similar_pairs) >= max_pairs:
-                break
-                
-            similar = self.find_similar_questions(
-                question['question_text'],
-                threshold=threshold,
-                top_k=10
-            )
+        rows = np.empty(0, dtype=np.int64)
+        cols = np.empty(0, dtype=np.int64)
+        scores = np.empty(0, dtype=np.float32)
+        
+        for start in range(0, total, block_size):
+            stop = min(start + block_size, total)
+            # Only columns from `start` on are needed: earlier ones were paired in previous blocks
+            gram = embeddings[start:stop] @ embeddings[start:].T
+            if self.metric == COSINE:
+                # Rows are unit length, so the Gram matrix holds the cosine similarities
+                hits = gram >= threshold
+            else:
+                # distance <= radius  <=>  gram >= (|a|^2 + |b|^2 - radius) / 2
+                hits = gram >= (sq_norms[start:stop, None] + sq_norms[None, start:] - radius) / 2
+            # Drop self-matches and the mirrored half of the diagonal block
+            hits[:, :stop - start] &= np.triu(np.ones((stop - start, stop - start), dtype=bool), 1)
+            
+            block_rows, block_cols = np.nonzero(hits)
+            if self.metric == COSINE:
+                block_scores = gram[block_rows, block_cols]
+            else:
+                block_scores = self._to_similarity(
+                    sq_norms[block_rows + start] + sq_norms[block_cols + start]
+                    - 2 * gram[block_rows, block_cols]
+                )
+            rows = np.concatenate([rows, block_rows + start])
+            cols = np.concatenate([cols, block_cols + start])
+            scores = np.concatenate([scores, block_scores])
             
-            # Filter out self-matches and format pairs
-            for match in similar:
-                if match['question_id'] != question['id']:
-                    similar_pairs.append({
-                        'question1_id': question['id'],
-                        'question1_text': question['question_text'],
-                        'question2_id': match['question_id'],
-                        'question2_text': next(
-                            (q['question_text'] for q in questions if q['id'] == match['question_id']), 
-                            ''
-                        ),
-                        'similarity': match['similarity']
-                    })
-                    
-                    if len(similar_pairs) >= max_pairs:
-                        break
+            # Keep only the best max_pairs candidates seen so far
+            if len(scores) > max_pairs:
+                keep = np.argpartition(-scores, max_pairs - 1)[:max_pairs]
+                rows, cols, scores = rows[keep], cols[keep], scores[keep]
         
         # Sort by similarity (highest first)
-        similar_pairs.sort(key=lambda x: x['similarity'], reverse=True)
-        return similar_pairs
+        order = np.argsort(-scores, kind='stable')
+        question_ids = similarity_index.question_ids
+        question_texts = similarity_index.question_texts
+        return [
+            {
+                'question1_id': question_ids[i],
+                'question1_text': question_texts[i],
+                'question2_id': question_ids[j],
+                'question2_text': question_texts[j],
+                'similarity': round(float(score), 4)
+            }
+            for i, j, score in zip(rows[order], cols[order], scores[order])
+        ]
 
     def compare_tests(
         self,
         test1_questions: List[Dict],
         test2_questions: List[Dict],
-        similarity_threshold: float = 0.75
+        similarity_threshold: float = 0.75,
+        include_matching: bool = False
     ) -> Dict:
         """
         Calculate the similarity between two tests based on their questions.
@@ -194,6 +913,7 @@ class SimilarityService:
             test1_questions: List of question dictionaries from first test
             test2_questions: List of question dictionaries from second test
             similarity_threshold: Threshold to consider questions as similar (0.0-1.0)
+            include_matching: Also compute the optimal one-to-one question matching
             
         Returns:
             Dict containing:
@@ -201,95 +921,281 @@ class SimilarityService:
                 - similar_question_pairs: List of pairs of similar questions
                 - similarity_metrics: Additional similarity metrics
         """
-        # Initialize results
-        similar_question_pairs = []
-        similarity_scores = []
+        empty_result = {
+            'overall_similarity': 0.0,
+            'similar_question_pairs': [],
+            'similarity_metrics': {
+                'max_similarity': 0.0,
+                'similar_question_count': 0,
+                'question_coverage': 0.0,
+                'average_similarity': 0.0
+            }
+        }
         
         # Validate inputs
         if not test1_questions or not test2_questions:
             logger.warning("One or both test question lists are empty")
-            return {
-                'overall_similarity': 0.0,
-                'similar_question_pairs': [],
-                'similarity_metrics': {
-                    'max_similarity': 0.0,
-                    'similar_question_count': 0,
-                    'question_coverage': 0.0,
-                    'average_similarity': 0.0
-                }
-            }
+            return empty_result
         
-        # Generate embeddings for all questions in both tests
-        test1_texts = [q.get('question_text', '') for q in test1_questions if q.get('question_text')]
-        test2_texts = [q.get('question_text', '') for q in test2_questions if q.get('question_text')]
+        test1_questions = [q for q in test1_questions if q.get('question_text')]
+        test2_questions = [q for q in test2_questions if q.get('question_text')]
         
-        if not test1_texts or not test2_texts:
+        if not test1_questions or not test2_questions:
             logger.warning("No valid question texts found in one or both tests")
-            return {
-                'overall_similarity': 0.0,
-                'similar_question_pairs': [],
-                'similarity_metrics': {
-                    'max_similarity': 0.0,
-                    'similar_question_count': 0,
-                    'question_coverage': 0.0,
-                    'average_similarity': 0.0
-                }
-            }
+            return empty_result
         
-        test1_embeddings = self.model.encode(test1_texts, convert_to_numpy=True)
-        test2_embeddings = self.model.encode(test2_texts, convert_to_numpy=True)
+        # Unit-length embeddings: dot products are cosine similarities
+        test1_embeddings = self._normalize(self._encode([q['question_text'] for q in test1_questions]))
+        test2_embeddings = self._normalize(self._encode([q['question_text'] for q in test2_questions]))
         
-        # Calculate similarity between each pair of questions
-        for i, (embed1, text1) in enumerate(zip(test1_embeddings, test1_texts)):
-            for j, (embed2, text2) in enumerate(zip(test2_embeddings, test2_texts)):
-                # Calculate cosine similarity
-                norm1 = np.linalg.norm(embed1)
-                norm2 = np.linalg.norm(embed2)
-                
-                if norm1 > 0 and norm2 > 0:  # Avoid division by zero
-                    similarity = float(np.dot(embed1, embed2) / (norm1 * norm2))
-                    similarity_scores.append(similarity)
-                    
-                    # If similarity exceeds threshold, record the pair
-                    if similarity >= similarity_threshold:
-                        similar_question_pairs.append({
-                            'test1_question_index': i,
-                            'test1_question_text': text1,
-                            'test1_question_id': test1_questions[i].get('id'),
-                            'test2_question_index': j,
-                            'test2_question_text': text2,
-                            'test2_question_id': test2_questions[j].get('id'),
-                            'similarity_score': round(similarity, 4)
-                        })
-        
-        # Calculate overall similarity metrics
-        if similarity_scores:
-            overall_similarity = sum(similarity_scores) / len(similarity_scores)
-            max_similarity = max(similarity_scores) if similarity_scores else 0
-            similar_question_count = len(similar_question_pairs)
-            total_possible_pairs = len(test1_texts) * len(test2_texts)
-            similar_pair_ratio = similar_question_count / total_possible_pairs if total_possible_pairs > 0 else 0
-            question_coverage = similar_question_count / min(len(test1_texts), len(test2_texts))
-        else:
-            overall_similarity = 0
-            max_similarity = 0
-            similar_question_count = 0
-            similar_pair_ratio = 0
-            question_coverage = 0
+        return self.compare_embeddings(
+            test1_questions,
+            test1_embeddings,
+            test2_questions,
+            test2_embeddings,
+            similarity_threshold,
+            include_matching
+        )
+
+    @staticmethod
+    def compare_embeddings(
+        test1_questions: List[Dict],
+        test1_embeddings: np.ndarray,
+        test2_questions: List[Dict],
+        test2_embeddings: np.ndarray,
+        similarity_threshold: float = 0.75,
+        include_matching: bool = False
+    ) -> Dict:
+        """
+        Compare two tests given the unit-length embeddings of their questions.
+        
+        All pairwise cosine similarities come from a single matrix product;
+        every metric is a reduction over that matrix. See compare_tests for
+        the arguments and result format.
+        """
+        return SimilarityService.compare_similarity_matrix(
+            test1_embeddings @ test2_embeddings.T,
+            test1_questions,
+            test2_questions,
+            similarity_threshold,
+            include_matching
+        )
+
+    @staticmethod
+    def compare_similarity_matrix(
+        similarity_matrix: np.ndarray,
+        test1_questions: List[Dict],
+        test2_questions: List[Dict],
+        similarity_threshold: float = 0.75,
+        include_matching: bool = False
+    ) -> Dict:
+        """
+        Build the compare_tests result from a precomputed matrix of cosine
+        similarities between the questions of two tests.
+        """
+        n1, n2 = similarity_matrix.shape
         
-        # Sort similar pairs by similarity score (highest first)
-        similar_question_pairs.sort(key=lambda x: x['similarity_score'], reverse=True)
+        # Record every pair at or above the threshold, highest first
+        rows, cols = np.nonzero(similarity_matrix >= similarity_threshold)
+        scores = similarity_matrix[rows, cols]
+        order = np.argsort(-scores, kind='stable')
+        similar_question_pairs = [
+            {
+                'test1_question_index': int(i),
+                'test1_question_text': test1_questions[i]['question_text'],
+                'test1_question_id': test1_questions[i].get('id'),
+                'test2_question_index': int(j),
+                'test2_question_text': test2_questions[j]['question_text'],
+                'test2_question_id': test2_questions[j].get('id'),
+                'similarity_score': round(float(score), 4)
+            }
+            for i, j, score in zip(rows[order], cols[order], scores[order])
+        ]
+        
+        similar_question_count = len(similar_question_pairs)
+        similarity_metrics = {
+            'max_similarity': round(float(similarity_matrix.max()), 4),
+            'similar_question_count': similar_question_count,
+            'similar_pair_ratio': round(similar_question_count / (n1 * n2), 4),
+            'question_coverage': round(similar_question_count / min(n1, n2), 4),
+            'total_questions_test1': n1,
+            'total_questions_test2': n2
+        }
+        
+        if include_matching:
+            # Hungarian assignment: pair each question with at most one
+            # question of the other test, maximizing the total similarity
+            from scipy.optimize import linear_sum_assignment
+            matched_rows, matched_cols = linear_sum_assignment(similarity_matrix, maximize=True)
+            matched_scores = similarity_matrix[matched_rows, matched_cols]
+            matched_count = int((matched_scores >= similarity_threshold).sum())
+            similarity_metrics.update({
+                'matched_similarity': round(float(matched_scores.mean()), 4),
+                'matched_question_count': matched_count,
+                'matched_coverage': round(matched_count / min(n1, n2), 4)
+            })
         
-        # Return results
         return {
-            'overall_similarity': round(float(overall_similarity), 4),
+            'overall_similarity': round(float(similarity_matrix.mean()), 4),
             'similar_question_pairs': similar_question_pairs,
-            'similarity_metrics': {
-                'max_similarity': round(float(max_similarity), 4),
-                'similar_question_count': similar_question_count,
-                'similar_pair_ratio': round(float(similar_pair_ratio), 4),
-                'question_coverage': round(float(question_coverage), 4),
-                'total_questions_test1': len(test1_texts),
-                'total_questions_test2': len(test2_texts)
-            }
+            'similarity_metrics': similarity_metrics
         }
+
+    def signature_for_questions(self, queryset) -> TestSignature:
+        """Build an uncached signature for an ad-hoc set of stored questions."""
+        questions, embeddings = self.load_embeddings(queryset.exclude(question_text=''))
+        return TestSignature(questions, self._normalize(embeddings))
+
+    def get_test_signatures(self, tests) -> Dict[int, TestSignature]:
+        """
+        Return the signatures of the given tests that have questions.
+        
+        Test membership is read with a single query. Signatures are cached
+        and reused while a test's questions and their update times are
+        unchanged; all missing ones are built from the stored question
+        embeddings in one batch.
+        
+        Args:
+            tests: Test queryset
+            
+        Returns:
+            Dict mapping test id to its signature
+        """
+        membership = defaultdict(list)
+        for test_id, question_id, question_text, updated_at in TestQuestion.objects.filter(
+            test__in=tests
+        ).values_list('test_id', 'question_id', 'question__question_text', 'question__updated_at'):
+            # Questions without text are skipped, as in compare_tests
+            if question_text:
+                membership[test_id].append((question_id, question_text, updated_at))
+
+        signatures = {}
+        missing = {}
+        for test_id, rows in membership.items():
+            fingerprint = tuple((question_id, updated_at) for question_id, _, updated_at in rows)
+            signature = self.test_signatures.lookup(test_scope(test_id), fingerprint)
+            if signature is None:
+                missing[test_id] = (rows, fingerprint)
+            else:
+                signatures[test_id] = signature
+
+        if missing:
+            questions, embeddings = self.load_embeddings(
+                Question.objects.filter(test_questions__test_id__in=list(missing)).distinct()
+            )
+            embeddings = self._normalize(embeddings)
+            row_of = {question['id']: row for row, question in enumerate(questions)}
+            for test_id, (rows, fingerprint) in missing.items():
+                signature = TestSignature(
+                    [{'id': question_id, 'question_text': text} for question_id, text, _ in rows],
+                    embeddings[[row_of[question_id] for question_id, _, _ in rows]],
+                    fingerprint
+                )
+                self.test_signatures.put(test_scope(test_id), signature)
+                signatures[test_id] = signature
+
+        return signatures
+
+    def rank_similar_tests(
+        self,
+        signature: TestSignature,
+        candidates: Dict[int, TestSignature],
+        similarity_threshold: float = 0.75
+    ) -> List[Tuple[int, Dict]]:
+        """
+        Compare a test against many others and keep those whose overall
+        similarity exceeds the threshold.
+        
+        Overall similarity equals the dot product of the centroids, so all
+        candidates are filtered exactly with one matrix-vector product. The
+        survivors are then compared in full with one matrix product against
+        their stacked embeddings.
+        
+        Returns:
+            List of (test id, compare_tests result), most similar first
+        """
+        test_ids = list(candidates)
+        if not signature.questions or not test_ids:
+            return []
+
+        centroids = np.stack([candidates[test_id].centroid for test_id in test_ids])
+        overall = np.round(centroids @ signature.centroid, 4)
+        survivors = [test_id for test_id, score in zip(test_ids, overall) if score > similarity_threshold]
+        if not survivors:
+            return []
+
+        similarity_matrix = signature.embeddings @ np.vstack(
+            [candidates[test_id].embeddings for test_id in survivors]
+        ).T
+        results = []
+        offset = 0
+        for test_id in survivors:
+            candidate = candidates[test_id]
+            width = len(candidate.questions)
+            results.append((test_id, self.compare_similarity_matrix(
+                similarity_matrix[:, offset:offset + width],
+                signature.questions,
+                candidate.questions,
+                similarity_threshold
+            )))
+            offset += width
+
+        results.sort(key=lambda result: result[1]['overall_similarity'], reverse=True)
+        return results
+
+
+_similarity_service = None
+
+
+def get_similarity_service() -> SimilarityService:
+    """Return the process-wide similarity service."""
+    global _similarity_service
+    if _similarity_service is None:
+        _similarity_service = SimilarityService()
+    return _similarity_service
+
+
+def queue_question_change(question: Question):
+    """
+    Schedule the cached indexes of a saved or deleted question's bank to be dropped.
+    
+    Embeddings are not encoded here: load_embeddings re-encodes the ones
+    whose text changed when an index is next built, so saving a question
+    never runs the model. Changes are collected until the surrounding
+    transaction commits, so a bulk create inside one transaction drops each
+    affected index once; changes of a rolled back transaction are dropped.
+    """
+    changes = getattr(_pending_changes, 'changes', None)
+    if changes is None or not changes.is_pending():
+        # Nothing queued yet, or the transaction the queued changes belonged to rolled back
+        changes = _QuestionChanges()
+        _pending_changes.changes = changes
+    changes.question_bank_ids.add(question.question_bank_id)
+    if not changes.registered:
+        changes.registered = True
+        transaction.on_commit(changes.flush)
+
+
+class _QuestionChanges:
+    """Question banks changed in the current transaction."""
+
+    def __init__(self):
+        self.question_bank_ids = set()
+        self.registered = False
+
+    def is_pending(self) -> bool:
+        # Callbacks of rolled back transactions and savepoints are discarded by Django
+        return not self.registered or any(
+            func == self.flush for _, func, _ in transaction.get_connection().run_on_commit
+        )
+
+    def flush(self):
+        if getattr(_pending_changes, 'changes', None) is self:
+            _pending_changes.changes = None
+        courses = dict(
+            QuestionBank.objects.filter(id__in=self.question_bank_ids).values_list('id', 'course_id')
+        )
+        service = get_similarity_service()
+        for question_bank_id in self.question_bank_ids:
+            # A deleted bank has no course left; its course index is rebuilt once its fingerprint changes
+            service.invalidate(question_bank_id, courses.get(question_bank_id))
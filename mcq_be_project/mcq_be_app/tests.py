@@ -1,3 +1,1227 @@
-from django.test import TestCase
+import csv
+import importlib.util
+import io
+import json
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from django.contrib.auth.models import User
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection, transaction
+from django.db.migrations.executor import MigrationExecutor
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient
+
+from .embedding_cache import EmbeddingCache, text_hash
+from .embedding_service import (
+    ONNX_INT8, TORCH, EmbeddingClient, EmbeddingServiceError, load_sentence_transformer, service_authkey
+)
+from .calibration import calibrate_test, run_pending_jobs
+from .irt import ABILITY_BOUNDS, EAP, MLE, ItemParameters, estimate_abilities
+from .irt_engine import calibrate
+from .item_analysis import OMITTED, analyze_items
+from .management.commands.benchmark_scoring import Command as BenchmarkScoring, legacy_score
+from .result_files import ResultFileError, open_result_upload
+from .responses import load_result_matrices, pack_answers, pack_rows, unpack_answers, unpack_rows
+from .models import (
+    Answer, CachedEmbedding, CalibrationJob, Course, Question, QuestionBank, QuestionEmbedding, QuestionGroup,
+    QuestionTaxonomy, Taxonomy, Test, TestQuestion, TestResult, TestVersionMapping
+)
+from .scoring import VersionIndex, build_version_mappings, mapping_mismatches, score_answer_sheet
+from .similarity_service import (
+    AUTO, COSINE, FLAT, HNSW, IVFPQ, IVFPQ_MIN_TRAINING_SIZE, L2, IndexRegistry, SimilarityIndex, SimilarityService,
+    _pending_changes, build_faiss_index, get_similarity_service, select_index_backend
+)
+
+
+@unittest.skipUnless(
+    importlib.util.find_spec('onnxruntime') and importlib.util.find_spec('optimum'),
+    'ONNX Runtime and Optimum are not installed'
+)
+class OnnxInferenceParityTest(SimpleTestCase):
+    """The int8 ONNX embedder must rank questions like the PyTorch one."""
+
+    @classmethod
+    def setUpClass(cls):
+        # Both backends start from the downloaded model, so don't run without it
+        if os.environ.get('HF_HUB_OFFLINE', '').lower() not in ('', '0', 'false'):
+            raise unittest.SkipTest('HF_HUB_OFFLINE is set')
+        from sentence_transformers import SentenceTransformer
+        try:
+            SentenceTransformer(SimilarityService().model_name, local_files_only=True)
+        except Exception as e:
+            raise unittest.SkipTest(f'The model is not in the local Hugging Face cache: {e}')
+        super().setUpClass()
+
+    corpus = [
+        'What is the powerhouse of the cell?',
+        'Which organelle produces most of the energy in a cell?',
+        'What is the capital of France?',
+        'Which city is the capital of France?',
+        'Solve for x: 2x + 3 = 7.',
+        'What value of x satisfies 2x + 3 = 7?',
+        'Who wrote Romeo and Juliet?',
+        'Which playwright wrote Romeo and Juliet?',
+        'What is the boiling point of water at sea level?',
+        'At what temperature does water boil at sea level?',
+    ]
+
+    def test_int8_ranking_matches_torch(self):
+        with tempfile.TemporaryDirectory() as cache_dir, override_settings(SIMILARITY_ONNX_CACHE_DIR=cache_dir):
+            torch_embeddings = SimilarityService(inference_backend=TORCH).model.encode(
+                self.corpus, normalize_embeddings=True
+            )
+            int8_embeddings = SimilarityService(inference_backend=ONNX_INT8).model.encode(
+                self.corpus, normalize_embeddings=True
+            )
+
+        # Quantization only perturbs the vectors slightly
+        cosines = np.sum(torch_embeddings * int8_embeddings, axis=1)
+        self.assertGreater(cosines.min(), 0.95)
+
+        # Every question keeps its nearest neighbour, and the full ranking barely moves
+        torch_scores = torch_embeddings @ torch_embeddings.T
+        int8_scores = int8_embeddings @ int8_embeddings.T
+        np.fill_diagonal(torch_scores, -np.inf)
+        np.fill_diagonal(int8_scores, -np.inf)
+        np.testing.assert_array_equal(torch_scores.argmax(axis=1), int8_scores.argmax(axis=1))
+        top3_agreement = np.mean([
+            len(set(np.argsort(-t)[:3]) & set(np.argsort(-q)[:3])) / 3
+            for t, q in zip(torch_scores, int8_scores)
+        ])
+        self.assertGreaterEqual(top3_agreement, 0.8)
+
+
+@unittest.skipUnless(importlib.util.find_spec('openpyxl'), 'openpyxl is not installed')
+@override_settings(RESULTS_BULK_BATCH_SIZE=100, CALIBRATION_EXECUTOR='worker')
+class ResultUploadRoundTripTest(TestCase):
+    """Uploading results must write in batches, not one statement per row."""
+
+    num_questions = 10
+    num_students = 250
+
+    def setUp(self):
+        self.user = User.objects.create(username='teacher')
+        self.course = Course.objects.create(name='Course', course_id='C1', owner=self.user)
+        bank = QuestionBank.objects.create(name='Bank', bank_id='B1', created_by=self.user, course=self.course)
+        self.test = Test.objects.create(title='Midterm', course=self.course)
+        for i in range(self.num_questions):
+            question = Question.objects.create(question_bank=bank, question_text=f'Question {i + 1}')
+            TestQuestion.objects.create(test=self.test, question=question, order=i)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def _frames(self):
+        rng = np.random.default_rng(0)
+        codes = rng.choice(['A0', 'B1'], size=(self.num_students, self.num_questions))
+        answers = pd.DataFrame(codes, columns=[f'C{i + 1}' for i in range(self.num_questions)])
+        mapping = pd.DataFrame({
+            'Question': range(1, self.num_questions + 1),
+            'Version 1': range(1, self.num_questions + 1),
+            'Version 2': range(self.num_questions, 0, -1),
+        })
+        return answers, mapping
+
+    def _upload_file(self):
+        answers, mapping = self._frames()
+        file = io.BytesIO()
+        with pd.ExcelWriter(file) as writer:
+            answers.to_excel(writer, sheet_name='Answers', index=False)
+            pd.DataFrame().to_excel(writer, sheet_name='Unused', index=False)
+            mapping.to_excel(writer, sheet_name='Mapping', index=False)
+        file.seek(0)
+        file.name = 'results.xlsx'
+        return file
+
+    @staticmethod
+    def _writes(queries):
+        return sum(
+            query['sql'].startswith(('INSERT', 'UPDATE'))
+            and ('testresult' in query['sql'] or 'question"' in query['sql'])
+            for query in queries
+        )
+
+    def test_upload_round_trips(self):
+        # Before: one INSERT per student and one UPDATE per question
+        questions = list(Question.objects.filter(test_questions__test=self.test))
+        with CaptureQueriesContext(connection) as before:
+            for i in range(self.num_students):
+                TestResult.objects.create(test=self.test, student_id=f'legacy-{i}', answers=[])
+            for question in questions:
+                question.save()
+        self.assertEqual(self._writes(before.captured_queries), self.num_students + self.num_questions)
+
+        # After: batched INSERTs in the upload; in the calibration job, batched UPDATEs of
+        # the students' abilities and a single batched UPDATE of the questions
+        with CaptureQueriesContext(connection) as after:
+            response = self.client.post(
+                f'/api/courses/{self.course.id}/tests/{self.test.id}/results/upload/',
+                {'file': self._upload_file()},
+                format='multipart'
+            )
+            self.assertEqual(response.status_code, 201, response.data)
+            self.assertEqual(run_pending_jobs(), 1)
+        self.assertEqual(TestResult.objects.filter(test=self.test).count(), 2 * self.num_students)
+        self.assertEqual(self._writes(after.captured_queries), 3 + 3 + 1)
+        job = CalibrationJob.objects.get(pk=response.data['calibration_job_id'])
+        self.assertEqual(job.status, CalibrationJob.COMPLETED, job.error)
+        self.assertEqual(job.result['responses'], self.num_students)
+        self.assertTrue(all(question.statistics for question in Question.objects.all()))
+        self.assertFalse(TestResult.objects.filter(test=self.test, answer_count=self.num_questions, theta=None).exists())
+
+    @override_settings(RESULTS_UPLOAD_CHUNK_SIZE=64)
+    def test_csv_pair_upload_matches_workbook_upload(self):
+        answers, mapping = self._frames()
+        response = self.client.post(
+            f'/api/courses/{self.course.id}/tests/{self.test.id}/results/upload/',
+            {
+                'file': SimpleUploadedFile('answers.csv', answers.to_csv(index=False).encode()),
+                'mapping_file': SimpleUploadedFile('mapping.csv', mapping.to_csv(index=False).encode()),
+            },
+            format='multipart'
+        )
+        self.assertEqual(response.status_code, 201, response.data)
+        from_csv = list(
+            TestResult.objects.filter(test=self.test).order_by('id').values_list('answer_bits', 'choice_bytes')
+        )
+        self.assertEqual(len(from_csv), self.num_students)
+
+        TestResult.objects.all().delete()
+        TestVersionMapping.objects.all().delete()
+        response = self.client.post(
+            f'/api/courses/{self.course.id}/tests/{self.test.id}/results/upload/',
+            {'file': self._upload_file()},
+            format='multipart'
+        )
+        self.assertEqual(response.status_code, 201, response.data)
+        from_workbook = list(
+            TestResult.objects.filter(test=self.test).order_by('id').values_list('answer_bits', 'choice_bytes')
+        )
+        self.assertEqual(from_csv, from_workbook)
+
+    @override_settings(CALIBRATION_SCOPE='course')
+    def test_course_scope_job_is_polled_through_the_test(self):
+        response = self.client.post(
+            f'/api/courses/{self.course.id}/tests/{self.test.id}/results/upload/',
+            {'file': self._upload_file()},
+            format='multipart'
+        )
+        self.assertEqual(response.status_code, 201, response.data)
+        self.assertEqual(response.data['calibration_scope'], CalibrationJob.COURSE)
+        job_id = response.data['calibration_job_id']
+        self.assertEqual(run_pending_jobs(), 1)
+
+        for url in (
+            f'/api/courses/{self.course.id}/tests/{self.test.id}/calibration-jobs/{job_id}/',
+            f'/api/courses/{self.course.id}/calibration-jobs/{job_id}/',
+        ):
+            with self.subTest(url=url):
+                response = self.client.get(url)
+                self.assertEqual(response.status_code, 200, response.data)
+                self.assertEqual(response.data['status'], CalibrationJob.COMPLETED)
+
+        # Not through a test of another course
+        other_test = Test.objects.create(title='Other', course=Course.objects.create(
+            name='Other', course_id='C2', owner=self.user
+        ))
+        response = self.client.get(f'/api/courses/{self.course.id}/tests/{other_test.id}/calibration-jobs/{job_id}/')
+        self.assertEqual(response.status_code, 404)
+
+
+@unittest.skipUnless(importlib.util.find_spec('openpyxl'), 'openpyxl is not installed')
+class ResultFileTest(SimpleTestCase):
+    """Answers are read in chunks from a workbook or a CSV pair."""
+
+    answers = pd.DataFrame({'Student': ['s1', 's2', 's3', 's4', 's5'], 'Q1': ['01', '12', None, '03', '20']})
+    mapping = pd.DataFrame({'Question': [1], 'Version 1': [1]})
+
+    def _csv(self, frame, name):
+        return SimpleUploadedFile(name, frame.to_csv(index=False).encode())
+
+    def _workbook(self, *frames):
+        file = io.BytesIO()
+        with pd.ExcelWriter(file) as writer:
+            for number, frame in enumerate(frames):
+                frame.to_excel(writer, sheet_name=f'Sheet{number + 1}', index=False)
+        return SimpleUploadedFile('results.xlsx', file.getvalue())
+
+    def test_csv_pair(self):
+        with open_result_upload(self._csv(self.answers, 'answers.csv'), self._csv(self.mapping, 'mapping.csv'), 2) as (
+            mapping, chunks
+        ):
+            chunks = list(chunks)
+        pd.testing.assert_frame_equal(mapping, self.mapping)
+        self.assertEqual([len(chunk) for chunk in chunks], [2, 2, 1])
+        # Answer codes are kept as text, leading zeros included
+        self.assertEqual(list(pd.concat(chunks)['Q1'].fillna('')), ['01', '12', '', '03', '20'])
+
+    def test_csv_without_mapping(self):
+        with self.assertRaises(ResultFileError):
+            with open_result_upload(self._csv(self.answers, 'answers.csv')):
+                pass
+        # Fine when the test has a stored mapping
+        with open_result_upload(self._csv(self.answers, 'answers.csv'), with_mapping=False) as (mapping, chunks):
+            self.assertIsNone(mapping)
+            self.assertEqual(sum(len(chunk) for chunk in chunks), 5)
+
+    def test_workbook_chunks_and_mapping_sheet(self):
+        workbook = self._workbook(self.answers, pd.DataFrame(), self.mapping)
+        with open_result_upload(workbook, chunk_size=2) as (mapping, chunks):
+            chunks = list(chunks)
+        pd.testing.assert_frame_equal(mapping, self.mapping)
+        self.assertEqual([len(chunk) for chunk in chunks], [2, 2, 1])
+        self.assertEqual(list(pd.concat(chunks)['Student']), list(self.answers['Student']))
+
+    def test_workbook_without_mapping_sheet(self):
+        with self.assertRaises(ResultFileError):
+            with open_result_upload(self._workbook(self.answers, pd.DataFrame())):
+                pass
+        # A separate mapping file stands in for the third sheet
+        with open_result_upload(
+            self._workbook(self.answers, pd.DataFrame()), self._csv(self.mapping, 'mapping.csv')
+        ) as (mapping, chunks):
+            pd.testing.assert_frame_equal(mapping, self.mapping)
+            self.assertEqual(sum(len(chunk) for chunk in chunks), 5)
+
+
+class QuestionListQueryCountTest(TestCase):
+    """Question-returning views must issue the same number of queries however many questions there are."""
+
+    def setUp(self):
+        self.user = User.objects.create(username='teacher')
+        self.course = Course.objects.create(name='Course', course_id='C1', owner=self.user)
+        self.bank = QuestionBank.objects.create(name='Bank', bank_id='B1', created_by=self.user, course=self.course)
+        self.group = QuestionGroup.objects.create(name='Group', question_bank=self.bank)
+        self.test = Test.objects.create(title='Midterm', course=self.course)
+        self.taxonomy = Taxonomy.objects.create(name="Bloom's", category='cognitive', levels=['Remember', 'Apply'])
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def _add_questions(self, count):
+        # bulk_create: no embedding updates from the post_save signal
+        start = Question.objects.count()
+        questions = Question.objects.bulk_create([
+            Question(question_bank=self.bank, question_group=self.group, question_text=f'Question {start + i}')
+            for i in range(count)
+        ])
+        Answer.objects.bulk_create([
+            Answer(question=question, answer_text=text, is_correct=text == 'Yes')
+            for question in questions for text in ('Yes', 'No')
+        ])
+        QuestionTaxonomy.objects.bulk_create([
+            QuestionTaxonomy(question=question, taxonomy=self.taxonomy, level='Apply') for question in questions
+        ])
+        TestQuestion.objects.bulk_create([
+            TestQuestion(test=self.test, question=question, order=start + i) for i, question in enumerate(questions)
+        ])
+
+    def _queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries.captured_queries), response.data
+
+    def test_query_count_does_not_grow_with_questions(self):
+        base = f'/api/courses/{self.course.id}'
+        urls = [
+            f'{base}/question-banks/{self.bank.id}/questions/',
+            f'{base}/question-banks/{self.bank.id}/groups/{self.group.id}/questions/',
+            f'{base}/tests/{self.test.id}/',
+            f'{base}/question-banks/{self.bank.id}/',
+        ]
+        self._add_questions(2)
+        small = {url: self._queries(url)[0] for url in urls}
+        self._add_questions(40)
+        for url in urls:
+            with self.subTest(url=url):
+                count, data = self._queries(url)
+                self.assertEqual(count, small[url])
+
+        # The prefetched data is what gets serialized
+        questions = self._queries(urls[0])[1]
+        self.assertEqual(len(questions), 42)
+        self.assertEqual([answer['answer_text'] for answer in questions[0]['answers']], ['Yes', 'No'])
+        self.assertEqual(questions[0]['taxonomies'][0]['taxonomy']['name'], "Bloom's")
+        self.assertEqual(questions[0]['question_bank_id'], self.bank.id)
+        self.assertEqual(self._queries(urls[2])[1]['question_count'], 42)
+
+    def test_bank_tree_query_count_does_not_grow_with_depth(self):
+        def add_level(parent, depth):
+            bank = QuestionBank.objects.create(
+                name=f'Level {depth}', bank_id=f'L{depth}', created_by=self.user, course=self.course, parent=parent
+            )
+            Question.objects.bulk_create([
+                Question(question_bank=bank, question_text=f'Level {depth} question {i}') for i in range(2)
+            ])
+            return bank
+
+        base = f'/api/courses/{self.course.id}/question-banks'
+        urls = [f'{base}/', f'{base}/{self.bank.id}/']
+        leaf = add_level(self.bank, 1)
+        shallow = {url: self._queries(url)[0] for url in urls}
+        for depth in range(2, 6):
+            leaf = add_level(leaf, depth)
+        for url in urls:
+            with self.subTest(url=url):
+                self.assertEqual(self._queries(url)[0], shallow[url])
+
+        # Counts and nesting come from the aggregated, in-memory tree
+        node = self._queries(urls[1])[1]
+        for depth in range(1, 6):
+            self.assertEqual(len(node['children']), 1)
+            node = node['children'][0]
+            self.assertEqual(node['name'], f'Level {depth}')
+            self.assertEqual(node['question_count'], 2)
+            self.assertEqual(len(node['questions']), 2)
+        self.assertEqual(node['children'], [])
+
+
+class QuestionChangeQueueTest(TestCase):
+    """Question saves only drop cached indexes, once per committed transaction."""
+
+    def setUp(self):
+        user = User.objects.create(username='teacher')
+        self.course = Course.objects.create(name='Course', course_id='C1', owner=user)
+        self.bank = QuestionBank.objects.create(name='Bank', bank_id='B1', created_by=user, course=self.course)
+        self.other_bank = QuestionBank.objects.create(name='Other', bank_id='B2', created_by=user, course=self.course)
+        _pending_changes.changes = None
+
+    def test_commit_invalidates_once_without_encoding(self):
+        with mock.patch.object(SimilarityService, 'invalidate') as invalidate, \
+                mock.patch.object(SimilarityService, '_encode') as encode:
+            with CaptureQueriesContext(connection) as queries, self.captureOnCommitCallbacks(execute=True):
+                for i in range(3):
+                    Question.objects.create(question_bank=self.bank, question_text=f'Question {i}')
+            invalidate.assert_called_once_with(self.bank.id, self.course.id)
+            encode.assert_not_called()
+        # Three INSERTs and one query resolving the courses
+        self.assertEqual(len(queries.captured_queries), 4)
+
+    def test_rolled_back_changes_are_dropped(self):
+        with mock.patch.object(SimilarityService, 'invalidate') as invalidate:
+            with self.captureOnCommitCallbacks(execute=True):
+                try:
+                    with transaction.atomic():
+                        Question.objects.create(question_bank=self.other_bank, question_text='Rolled back')
+                        raise RuntimeError
+                except RuntimeError:
+                    pass
+                Question.objects.create(question_bank=self.bank, question_text='Committed')
+            invalidate.assert_called_once_with(self.bank.id, self.course.id)
+
+
+class LazyModelLoadingTest(TestCase):
+    """Stored embeddings are served without loading the model."""
+
+    def test_stored_embeddings_do_not_load_the_model(self):
+        user = User.objects.create(username='teacher')
+        course = Course.objects.create(name='Course', course_id='C1', owner=user)
+        bank = QuestionBank.objects.create(name='Bank', bank_id='B1', created_by=user, course=course)
+        empty_bank = QuestionBank.objects.create(name='Empty', bank_id='B2', created_by=user, course=course)
+        test = Test.objects.create(title='Test', course=course)
+        service = SimilarityService()
+        for order, vector in enumerate(([1, 0, 0, 0], [0, 1, 0, 0])):
+            question = Question.objects.create(question_bank=bank, question_text=f'Question {order}')
+            TestQuestion.objects.create(test=test, question=question, order=order)
+            QuestionEmbedding.objects.create(
+                question=question,
+                model_name=service.embedding_key,
+                text_hash=text_hash(question.question_text),
+                vector=np.array(vector, dtype='float32').tobytes()
+            )
+
+        with mock.patch('mcq_be_app.similarity_service.create_encoder') as create_encoder:
+            self.assertEqual(service.get_index(bank.id).ntotal, 2)
+            self.assertEqual(service.get_index(empty_bank.id).ntotal, 0)
+            self.assertEqual(service.get_test_signatures(Test.objects.all())[test.id].embeddings.shape, (2, 4))
+            self.assertEqual(len(service.find_similar_pairs(bank.id, threshold=0.5)), 0)
+        create_encoder.assert_not_called()
+        self.assertIsNone(service._model)
+
+
+@mock.patch.object(SimilarityService, 'dimension', new_callable=mock.PropertyMock, return_value=4)
+@mock.patch.object(
+    SimilarityService, '_encode',
+    side_effect=lambda texts: np.tile(np.array([[1, 0, 0, 0]], dtype='float32'), (len(texts), 1))
+)
+class SimilarityEndpointTest(TestCase):
+    """Request handling of the similarity endpoints, with a stub encoder."""
+
+    def setUp(self):
+        self.user = User.objects.create(username='teacher')
+        self.course = Course.objects.create(name='Course', course_id='C1', owner=self.user)
+        self.bank = QuestionBank.objects.create(name='Bank', bank_id='B1', created_by=self.user, course=self.course)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        get_similarity_service().indexes.clear()
+
+    def _filter_fixture(self):
+        other_bank = QuestionBank.objects.create(
+            name='Other', bank_id='B2', created_by=self.user, course=self.course
+        )
+        taxonomy = Taxonomy.objects.create(name="Bloom's", category='cognitive', levels=['Remember', 'Apply'])
+        questions = {
+            'easy': Question.objects.create(question_bank=self.bank, question_text='Easy', difficulty='easy'),
+            'hard': Question.objects.create(question_bank=self.bank, question_text='Hard', difficulty='hard'),
+            'other': Question.objects.create(question_bank=other_bank, question_text='Other', difficulty='easy'),
+        }
+        QuestionTaxonomy.objects.create(question=questions['easy'], taxonomy=taxonomy, level='Remember')
+        QuestionTaxonomy.objects.create(question=questions['other'], taxonomy=taxonomy, level='Apply')
+        return questions, other_bank, taxonomy
+
+    def test_metadata_filters_and_enrichment(self, *mocks):
+        questions, other_bank, taxonomy = self._filter_fixture()
+
+        def matches(**data):
+            response = self.client.post(
+                '/api/questions/check-similarity/',
+                {'question_text': 'Query', 'course_id': self.course.id, **data},
+                format='json'
+            )
+            self.assertEqual(response.status_code, 200, response.data)
+            return {match['question_id']: match for match in response.data['similar_questions']}
+
+        self.assertEqual(set(matches()), {question.id for question in questions.values()})
+        self.assertEqual(set(matches(question_bank_ids=[other_bank.id])), {questions['other'].id})
+        self.assertEqual(set(matches(difficulty='hard')), {questions['hard'].id})
+        self.assertEqual(set(matches(taxonomy_id=taxonomy.id)), {questions['easy'].id, questions['other'].id})
+        self.assertEqual(
+            set(matches(taxonomy_id=taxonomy.id, taxonomy_levels=['Apply'], difficulties=['easy'])),
+            {questions['other'].id}
+        )
+
+        match = matches(question_bank_ids=[self.bank.id], difficulties=['easy'])[questions['easy'].id]
+        self.assertEqual(match['question_bank_id'], self.bank.id)
+        self.assertEqual(match['difficulty'], 'easy')
+        self.assertEqual(match['taxonomies'], [
+            {'taxonomy_id': taxonomy.id, 'taxonomy_name': "Bloom's", 'level': 'Remember'}
+        ])
+
+    def test_form_encoded_filters(self, *mocks):
+        questions, other_bank, _ = self._filter_fixture()
+        response = self.client.post(
+            '/api/questions/check-similarity/',
+            {'question_text': 'Query', 'question_bank_ids': f'{self.bank.id},{other_bank.id}', 'difficulty': 'easy'},
+            format='multipart'
+        )
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertEqual(
+            {match['question_id'] for match in response.data['similar_questions']},
+            {questions['easy'].id, questions['other'].id}
+        )
+
+    def test_malformed_filters_are_rejected(self, *mocks):
+        for url, data in (
+            ('/api/questions/check-similarity/', {'question_text': 'Query', 'taxonomy_id': 'abc'}),
+            ('/api/questions/check-similarity/', {'question_text': 'Query', 'question_bank_ids': ['x']}),
+            ('/api/questions/check-similarity/batch/', {'question_texts': ['Query'], 'question_bank_ids': [1.5]}),
+            ('/api/questions/check-similarity/batch/', {'question_texts': ['Query'], 'question_bank_ids': {'id': 1}}),
+        ):
+            with self.subTest(data=data):
+                response = self.client.post(url, data, format='json')
+                self.assertEqual(response.status_code, 400)
+
+        # A single id is a list of one
+        response = self.client.post(
+            '/api/questions/check-similarity/', {'question_text': 'Query', 'question_bank_ids': 5}, format='json'
+        )
+        self.assertEqual(response.status_code, 200, response.data)
+
+    def test_search_scope_is_checked(self, *mocks):
+        stranger = User.objects.create(username='stranger')
+        other_course = Course.objects.create(name='Other', course_id='C2', owner=stranger)
+        other_bank = QuestionBank.objects.create(name='Other', bank_id='B2', created_by=stranger, course=other_course)
+        Question.objects.create(question_bank=other_bank, question_text='Private question')
+
+        for url, data in (
+            ('/api/questions/check-similarity/', {'question_text': 'Query'}),
+            ('/api/questions/check-similarity/batch/', {'question_texts': ['Query']}),
+        ):
+            for scope, expected in (
+                ({'course_id': 'abc'}, 400),
+                ({'question_bank_id': -1}, 400),
+                ({'course_id': 999999}, 404),
+                ({'question_bank_id': 999999}, 404),
+                ({'course_id': other_course.id}, 403),
+                ({'question_bank_id': other_bank.id}, 403),
+                ({'question_bank_id': other_bank.id, 'course_id': self.course.id}, 403),
+                ({'course_id': str(self.course.id)}, 200),
+                ({'question_bank_id': self.bank.id}, 200),
+            ):
+                with self.subTest(url=url, scope=scope):
+                    # Course.teachers has no migration yet; nobody is a teacher here
+                    with mock.patch.object(Course, 'teachers', mock.Mock(**{'all.return_value': []})):
+                        response = self.client.post(url, {**data, **scope}, format='json')
+                    self.assertEqual(response.status_code, expected, response.data)
+
+    def test_questions_without_text_are_not_missing(self, *mocks):
+        question = Question.objects.create(question_bank=self.bank, question_text='What is 2 + 2?')
+        blank = Question.objects.create(question_bank=self.bank, question_text='')
+        response = self.client.post(
+            f'/api/courses/{self.course.id}/check-test-similarity/',
+            {'question_ids': [question.id, blank.id, 999999]},
+            format='json'
+        )
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertEqual(response.data['missing_question_ids'], [999999])
+        self.assertEqual(response.data['candidate_questions_count'], 2)
+
+    def test_include_matching_form_values(self, *mocks):
+        tests = []
+        for title in ('First', 'Second'):
+            test = Test.objects.create(title=title, course=self.course)
+            question = Question.objects.create(question_bank=self.bank, question_text=f'{title} question')
+            TestQuestion.objects.create(test=test, question=question, order=0)
+            tests.append(test)
+
+        for value, included in (('false', False), ('0', False), ('TRUE', True), ('1', True)):
+            with self.subTest(include_matching=value):
+                response = self.client.post(
+                    '/api/compare-tests/',
+                    {'test1_id': tests[0].id, 'test2_id': tests[1].id, 'include_matching': value},
+                    format='multipart'
+                )
+                self.assertEqual(response.status_code, 200, response.data)
+                self.assertEqual('matched_similarity' in response.data['similarity_metrics'], included)
+
+    def test_invalid_numeric_parameters_are_rejected(self, *mocks):
+        question = Question.objects.create(question_bank=self.bank, question_text='What is 2 + 2?')
+        requests = [
+            ('/api/questions/check-similarity/batch/', {'question_texts': ['Text'], 'threshold': 'high'}),
+            ('/api/questions/check-similarity/batch/', {'question_texts': ['Text'], 'threshold': 1.5}),
+            ('/api/questions/check-similarity/batch/', {'question_texts': ['Text'], 'top_k': 0}),
+            ('/api/questions/check-similarity/batch/', {'question_texts': ['Text'], 'top_k': None}),
+            ('/api/questions/check-similarity/batch/', {'question_texts': ['Text'], 'within_batch_threshold': -1}),
+            (f'/api/courses/{self.course.id}/check-test-similarity/', {'question_ids': [question.id], 'threshold': 'x'}),
+            (f'/api/courses/{self.course.id}/check-test-similarity/', {'question_ids': [question.id], 'max_results': 0}),
+            ('/api/questions/check-similarity/', {'question_text': 'Text', 'threshold': 'high'}),
+            ('/api/questions/check-similarity/', {'question_text': 'Text', 'threshold': 2}),
+            ('/api/compare-tests/', {'test1_questions': [question.id], 'test2_questions': [question.id],
+                                     'similarity_threshold': 'x'}),
+        ]
+        for url, data in requests:
+            with self.subTest(url=url, data=data):
+                response = self.client.post(url, data, format='json')
+                self.assertEqual(response.status_code, 400)
+                self.assertIn('must be a number', response.data['error'])
+
+        test = Test.objects.create(title='Test', course=self.course)
+        for url, params in (
+            (f'/api/question-banks/{self.bank.id}/similar-pairs/', {'threshold': 'nan'}),
+            ('/api/questions/similar-pairs/', {'max_pairs': 0}),
+            (f'/api/tests/{test.id}/similar-tests/', {'threshold': '-0.5'}),
+            (f'/api/tests/{test.id}/similar-tests/', {'max_results': 'all'}),
+        ):
+            with self.subTest(url=url, params=params):
+                response = self.client.get(url, params)
+                self.assertEqual(response.status_code, 400)
+                self.assertIn('must be a number', response.data['error'])
+        response = self.client.post(
+            '/api/questions/check-similarity/', {'question_text': 'Text', 'threshold': '0.5'}, format='json'
+        )
+        self.assertEqual(response.status_code, 200, response.data)
+
+        with override_settings(SIMILARITY_BATCH_MAX_TEXTS=10):
+            response = self.client.post(
+                '/api/questions/check-similarity/batch/', {'question_texts': ['Text'], 'top_k': 11}, format='json'
+            )
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post(
+            '/api/questions/check-similarity/batch/',
+            {'question_texts': ['Text'], 'threshold': '0.5', 'top_k': '3', 'check_within_batch': 'false'},
+            format='json'
+        )
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertNotIn('within_batch_duplicates', response.data)
+
+
+class IndexRegistryTest(SimpleTestCase):
+    """LRU order and memory budget of the similarity index cache."""
+
+    @staticmethod
+    def entry(nbytes, fingerprint=None):
+        return mock.Mock(nbytes=nbytes, fingerprint=fingerprint)
+
+    def test_least_recently_used_index_is_evicted_beyond_budget(self):
+        registry = IndexRegistry(memory_budget=100)
+        registry.put(('bank', 1), self.entry(40))
+        registry.put(('bank', 2), self.entry(40))
+        registry.lookup(('bank', 1))
+        registry.put(('bank', 3), self.entry(40))
+
+        self.assertIsNotNone(registry.lookup(('bank', 1)))
+        self.assertIsNone(registry.lookup(('bank', 2)))
+        self.assertIsNotNone(registry.lookup(('bank', 3)))
+        self.assertEqual(registry.nbytes, 80)
+
+    def test_index_over_budget_is_kept_alone(self):
+        registry = IndexRegistry(memory_budget=100)
+        registry.put(('bank', 1), self.entry(40))
+        registry.put(('course', 1), self.entry(150))
+
+        self.assertIsNone(registry.lookup(('bank', 1)))
+        self.assertIsNotNone(registry.lookup(('course', 1)))
+        self.assertEqual(registry.nbytes, 150)
+
+    def test_stale_fingerprint_is_rebuilt(self):
+        registry = IndexRegistry(memory_budget=100)
+        build = mock.Mock(side_effect=lambda: self.entry(10, fingerprint=build.call_count))
+
+        first = registry.get(('bank', 1), build, fingerprint=1)
+        self.assertIs(registry.get(('bank', 1), build, fingerprint=1), first)
+        self.assertEqual(build.call_count, 1)
+        self.assertIsNot(registry.get(('bank', 1), build, fingerprint=2), first)
+        self.assertEqual(build.call_count, 2)
+
+        registry.invalidate(('bank', 1))
+        self.assertIsNone(registry.lookup(('bank', 1)))
+
+
+class FindSimilarPairsTest(SimpleTestCase):
+    """Blocked pair search must agree with scoring every pair."""
+
+    def _service(self, metric):
+        rng = np.random.default_rng(0)
+        embeddings = rng.normal(size=(70, 8)).astype('float32')
+        # Near-duplicates, plus a group of four identical questions whose six pairs tie
+        embeddings[10:20] = embeddings[:10] + rng.normal(scale=0.05, size=(10, 8))
+        embeddings[40:44] = embeddings[40]
+        service = SimilarityService(metric=metric)
+        embeddings = service._prepare(embeddings)
+        index, backend = build_faiss_index(embeddings, metric, FLAT)
+        similarity_index = SimilarityIndex(
+            index, list(range(100, 170)), [f'Question {i}' for i in range(70)], embeddings, metric=metric,
+            backend=backend
+        )
+        return service, similarity_index
+
+    @staticmethod
+    def _brute_force(service, embeddings, threshold):
+        pairs = []
+        for i in range(len(embeddings)):
+            for j in range(i + 1, len(embeddings)):
+                if service.metric == COSINE:
+                    score = float(embeddings[i] @ embeddings[j])
+                else:
+                    score = float(service._to_similarity(np.sum((embeddings[i] - embeddings[j]) ** 2)))
+                if score >= threshold:
+                    pairs.append((100 + i, 100 + j, round(score, 4)))
+        return sorted(pairs, key=lambda pair: -pair[2])
+
+    def test_matches_brute_force(self):
+        for metric, threshold in ((COSINE, 0.9), (L2, 0.95)):
+            with self.subTest(metric=metric):
+                service, similarity_index = self._service(metric)
+                expected = self._brute_force(service, similarity_index.embeddings, threshold)
+                self.assertGreater(len(expected), 10)
+                with mock.patch.object(service, 'get_index', return_value=similarity_index):
+                    pairs = service.find_similar_pairs(threshold=threshold, max_pairs=1000, block_size=16)
+                found = [(pair['question1_id'], pair['question2_id'], pair['similarity']) for pair in pairs]
+                self.assertEqual(set(found), set(expected))
+                self.assertEqual(len(found), len(expected))
+                self.assertEqual([pair[2] for pair in found], sorted((pair[2] for pair in found), reverse=True))
+                self.assertEqual(pairs[0]['question1_text'], f"Question {pairs[0]['question1_id'] - 100}")
+
+    def test_max_pairs_keeps_the_best(self):
+        service, similarity_index = self._service(COSINE)
+        expected = self._brute_force(service, similarity_index.embeddings, 0.9)
+        # The cutoff falls inside the tie of the identical group
+        self.assertEqual([pair[2] for pair in expected[:6]], [1.0] * 6)
+        self.assertLess(expected[6][2], 1.0)
+        with mock.patch.object(service, 'get_index', return_value=similarity_index):
+            for max_pairs in (4, 6, 9):
+                with self.subTest(max_pairs=max_pairs):
+                    pairs = service.find_similar_pairs(threshold=0.9, max_pairs=max_pairs, block_size=16)
+                    found = [(pair['question1_id'], pair['question2_id'], pair['similarity']) for pair in pairs]
+                    self.assertEqual([pair[2] for pair in found], [pair[2] for pair in expected[:max_pairs]])
+                    self.assertTrue(set(found) <= set(expected))
+            self.assertEqual(service.find_similar_pairs(threshold=0.9, max_pairs=0), [])
+
+
+class IndexBackendTest(SimpleTestCase):
+    """Backend selection by corpus size, and recall of the approximate backends."""
+
+    def test_backend_selection(self):
+        self.assertEqual(select_index_backend(49999, AUTO), FLAT)
+        self.assertEqual(select_index_backend(50000, AUTO), HNSW)
+        self.assertEqual(select_index_backend(1999999, AUTO), HNSW)
+        self.assertEqual(select_index_backend(2000000, AUTO), IVFPQ)
+        with override_settings(SIMILARITY_HNSW_MIN_SIZE=10, SIMILARITY_IVFPQ_MIN_SIZE=20):
+            self.assertEqual(select_index_backend(9), FLAT)
+            self.assertEqual(select_index_backend(10), HNSW)
+            self.assertEqual(select_index_backend(20), IVFPQ)
+        # Explicit choices are kept, except IVF-PQ without enough vectors to train it
+        self.assertEqual(select_index_backend(5, HNSW), HNSW)
+        self.assertEqual(select_index_backend(IVFPQ_MIN_TRAINING_SIZE - 1, IVFPQ), FLAT)
+        self.assertEqual(select_index_backend(IVFPQ_MIN_TRAINING_SIZE, IVFPQ), IVFPQ)
+        with self.assertRaises(ValueError):
+            select_index_backend(5, 'annoy')
+
+    @override_settings(
+        SIMILARITY_HNSW_M=16, SIMILARITY_IVFPQ_M=8, SIMILARITY_IVFPQ_NLIST=16, SIMILARITY_IVFPQ_NPROBE=8
+    )
+    def test_recall_against_flat(self):
+        rng = np.random.default_rng(0)
+        centers = rng.normal(size=(50, 32))
+        size = IVFPQ_MIN_TRAINING_SIZE
+        corpus = centers[rng.integers(0, 50, size)] + rng.normal(scale=0.5, size=(size, 32))
+        queries = corpus[:100] + rng.normal(scale=0.1, size=(100, 32))
+
+        for metric in (COSINE, L2):
+            service = SimilarityService(metric=metric)
+            embeddings = service._prepare(corpus.astype('float32'))
+            prepared_queries = service._prepare(queries.astype('float32'))
+            flat, _ = build_faiss_index(embeddings, metric, FLAT)
+            _, exact = flat.search(prepared_queries, 10)
+
+            for backend in (HNSW, IVFPQ):
+                with self.subTest(metric=metric, backend=backend):
+                    index, built = build_faiss_index(embeddings, metric, backend)
+                    self.assertEqual(built, backend)
+                    similarity_index = SimilarityIndex(
+                        index, list(range(len(embeddings))), [''] * len(embeddings), embeddings, metric=metric,
+                        backend=backend
+                    )
+                    scores, found = similarity_index.search(prepared_queries, 10)
+                    recall = np.mean([len(set(a) & set(b)) / 10 for a, b in zip(found, exact)])
+                    self.assertGreaterEqual(recall, 0.95)
+                    if backend == IVFPQ:
+                        # Re-ranking returns exact scores and recovers what quantization loses
+                        vectors = embeddings[found]
+                        if metric == COSINE:
+                            expected = np.einsum('qd,qkd->qk', prepared_queries, vectors)
+                        else:
+                            expected = ((prepared_queries[:, None] - vectors) ** 2).sum(axis=2)
+                        np.testing.assert_allclose(scores, expected, rtol=1e-4, atol=1e-4)
+                        _, quantized = index.search(prepared_queries, 10)
+                        self.assertLess(np.mean([len(set(a) & set(b)) / 10 for a, b in zip(quantized, exact)]), recall)
+
+
+class EmbeddingCacheTest(TestCase):
+    """Two-tier embedding cache: LRU in memory, then the database."""
+
+    def test_hits_and_misses_are_counted_per_tier(self):
+        cache = EmbeddingCache(max_entries=2, persist=True)
+        vectors = {text_hash(text): np.full(4, number, dtype='float32') for number, text in enumerate('abc')}
+        first, second, third = vectors
+        cache.put_many('model', vectors)
+        # The first vector no longer fits in memory, but is in the database
+        self.assertEqual(cache.stats()['entries'], 2)
+        self.assertEqual(CachedEmbedding.objects.filter(model_name='model').count(), 3)
+
+        self.assertEqual(list(cache.get_many('model', [third])), [third])
+        np.testing.assert_array_equal(cache.get_many('model', [first])[first], vectors[first])
+        self.assertEqual(cache.get_many('model', [text_hash('d')]), {})
+        self.assertEqual(cache.get_many('other model', [second]), {})
+        # Database hits are promoted to memory, evicting the least recently used
+        self.assertEqual(list(cache.get_many('model', [first])), [first])
+        self.assertEqual(cache.get_many('model', [second]).keys(), {second})
+
+        self.assertEqual(cache.stats(), {
+            'entries': 2,
+            'max_entries': 2,
+            'persist': True,
+            'memory_hits': 2,
+            'database_hits': 2,
+            'misses': 2,
+            'hit_rate': 0.6667
+        })
+        # Whitespace and Unicode normalization don't change the key
+        self.assertEqual(text_hash('  What is\n2 + 2? '), text_hash('What is 2 + 2?'))
+        self.assertEqual(text_hash('caf\u0065\u0301'), text_hash('caf\u00e9'))
+
+    def test_stats_endpoint(self):
+        cache = EmbeddingCache(max_entries=10)
+        cache.put_many('model', {text_hash('a'): np.ones(4, dtype='float32')})
+        cache.get_many('model', [text_hash('a'), text_hash('b')])
+        client = APIClient()
+        with mock.patch.object(get_similarity_service(), 'embedding_cache', cache):
+            client.force_authenticate(User.objects.create(username='teacher'))
+            self.assertEqual(client.get('/api/similarity/cache-stats/').status_code, 403)
+            client.force_authenticate(User.objects.create(username='admin', is_staff=True))
+            response = client.get('/api/similarity/cache-stats/')
+        self.assertEqual(response.status_code, 200, response.data)
+        stats = response.data['embedding_cache']
+        self.assertEqual((stats['memory_hits'], stats['database_hits'], stats['misses']), (1, 0, 1))
+        self.assertEqual(stats['hit_rate'], 0.5)
+        self.assertIsInstance(response.data['index_cache_bytes'], int)
+
+
+class EmbeddingServiceTest(SimpleTestCase):
+    """Error handling of the embedding client and model loading."""
+
+    def test_timed_out_connection_is_not_reused(self):
+        from multiprocessing.connection import Listener
+
+        with tempfile.TemporaryDirectory() as directory:
+            address = os.path.join(directory, 'embedding.sock')
+            closed = []
+
+            def serve(listener):
+                # First connection: never reply, only notice the client closing it; second: reply
+                connection = listener.accept()
+                connection.recv()
+                try:
+                    connection.recv()
+                except EOFError:
+                    closed.append(True)
+                connection.close()
+                connection = listener.accept()
+                request = connection.recv()
+                connection.send(('ok', f'reply to {request[2][0]}'))
+                connection.close()
+
+            with Listener(address, authkey=b'key') as listener:
+                server = threading.Thread(target=serve, args=(listener,), daemon=True)
+                server.start()
+                client = EmbeddingClient('model', address, b'key', timeout=0.2)
+                with self.assertRaises(EmbeddingServiceError):
+                    client.encode(['first'])
+                self.assertEqual(client.encode(['second']), 'reply to second')
+                server.join(5)
+            self.assertEqual(closed, [True])
+
+    @unittest.skipUnless(importlib.util.find_spec('sentence_transformers'), 'sentence-transformers is not installed')
+    def test_missing_quantized_model_is_reported(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            # An export directory left without its quantized file
+            os.makedirs(os.path.join(cache_dir, 'model', 'onnx-int8-avx2', 'onnx'))
+            with self.assertRaisesRegex(FileNotFoundError, 'avx2 int8 model'):
+                load_sentence_transformer('model', ONNX_INT8, cache_dir, 'avx2')
+
+    @override_settings(EMBEDDING_SERVICE_AUTHKEY='', SECRET_KEY='')
+    def test_authkey_requires_a_secret(self):
+        with self.assertRaises(ImproperlyConfigured):
+            service_authkey()
+        with override_settings(EMBEDDING_SERVICE_AUTHKEY='shared'):
+            self.assertEqual(service_authkey(), b'shared')
+
+
+def simulate_responses(rng, model, participants, items):
+    """+1/-1 responses drawn from a logistic IRT model, with the generating parameters."""
+    discrimination = np.full(items, 1.3) if model == '1PL' else rng.uniform(0.6, 2.2, items)
+    difficulty = rng.normal(0, 1, items)
+    guessing = rng.uniform(0.1, 0.3, items) if model == '3PL' else np.zeros(items)
+    theta = rng.normal(0, 1, participants)
+    p = guessing + (1 - guessing) / (1 + np.exp(-discrimination * (theta[:, None] - difficulty)))
+    responses = np.where(rng.random(p.shape) < p, 1, -1).astype('int8')
+    return sparse.csr_matrix(responses), discrimination, difficulty, guessing, theta
+
+
+class IRTEngineTest(TestCase):
+    """Model selection and the fit cache of irt_engine.calibrate."""
+
+    def test_recalibrating_unchanged_results_hits_the_cache(self):
+        user = User.objects.create(username='teacher')
+        course = Course.objects.create(name='Course', course_id='C1', owner=user)
+        bank = QuestionBank.objects.create(name='Bank', bank_id='B1', created_by=user, course=course)
+        test = Test.objects.create(title='Midterm', course=course)
+        responses = simulate_responses(np.random.default_rng(0), '2PL', 500, 15)[0].toarray()
+        for i in range(responses.shape[1]):
+            question = Question.objects.create(question_bank=bank, question_text=f'Question {i + 1}')
+            TestQuestion.objects.create(test=test, question=question, order=i)
+        TestResult.objects.bulk_create([
+            TestResult(test=test, student_id=f'student-{i}', answers=(row > 0).tolist())
+            for i, row in enumerate(responses)
+        ])
+
+        first = calibrate_test(test)['irt_diagnostics']
+        self.assertFalse(first['cached'])
+        # The second run warm-starts from the parameters the first one stored, and still hits the cache
+        second = calibrate_test(test)['irt_diagnostics']
+        self.assertTrue(second['cached'])
+        self.assertEqual(second['response_hash'], first['response_hash'])
+
+    def test_recovers_parameters_and_selects_the_generating_model(self):
+        rng = np.random.default_rng(1)
+        for model in ('1PL', '2PL', '3PL'):
+            responses, discrimination, difficulty, _, _ = simulate_responses(rng, model, 4000, 30)
+            for criterion in ('aic', 'bic'):
+                with self.subTest(model=model, criterion=criterion):
+                    fit = calibrate(responses, criterion=criterion)
+                    self.assertEqual(fit.parameters.model, model, fit.diagnostics['candidates'])
+                    self.assertFalse(fit.diagnostics['cached'])
+                    self.assertGreater(np.corrcoef(fit.parameters.difficulty, difficulty)[0, 1], 0.9)
+                    if model != '1PL':
+                        self.assertGreater(np.corrcoef(fit.parameters.discrimination, discrimination)[0, 1], 0.8)
+                    self.assertTrue(calibrate(responses, criterion=criterion).diagnostics['cached'])
+
+
+class AnswerPackingTest(TestCase):
+    """Bit-packed TestResult answers decode to what was stored."""
+
+    lengths = [0, 1, 7, 8, 9, 15, 17, 60, 61]
+
+    def test_pack_unpack_round_trip(self):
+        rng = np.random.default_rng(0)
+        for length in self.lengths:
+            with self.subTest(length=length):
+                answers = rng.integers(0, 2, length).tolist()
+                bits, count = pack_answers(answers)
+                self.assertEqual(len(bits), (length + 7) // 8)
+                self.assertEqual(count, length)
+                self.assertEqual(unpack_answers(bits, count), answers)
+                if length:
+                    matrix = rng.integers(0, 2, (5, length))
+                    np.testing.assert_array_equal(unpack_rows(pack_rows(matrix), length), matrix)
+
+    def test_answers_property_and_result_matrices(self):
+        user = User.objects.create(username='teacher')
+        course = Course.objects.create(name='Course', course_id='C1', owner=user)
+        test = Test.objects.create(title='Midterm', course=course)
+        rng = np.random.default_rng(1)
+        rows = rng.integers(0, 2, (4, 13)).tolist()
+        for i, answers in enumerate(rows):
+            result = TestResult(test=test, student_id=f'student-{i}', choice_bytes=b'AB' * 6 + b'C' if i else b'')
+            result.answers = answers
+            result.save()
+        # An upload from before the test had 13 questions
+        TestResult.objects.create(test=test, student_id='legacy', answers=[1, 0, 1])
+
+        stored = TestResult.objects.filter(test=test).order_by('id')
+        self.assertEqual([result.answers for result in stored[:4]], rows)
+        self.assertEqual(stored[4].answers, [1, 0, 1])
+
+        responses, choices = load_result_matrices(stored, 13)
+        np.testing.assert_array_equal(responses, rows)
+        np.testing.assert_array_equal(choices[0], np.zeros(13))  # No options recorded
+        self.assertEqual(choices[1].tobytes(), b'AB' * 6 + b'C')
+
+
+class AnswerPackingMigrationTest(TransactionTestCase):
+    """Migration 0016 packs the JSON answers of existing results, and unpacks them when reversed."""
+
+    before = [('mcq_be_app', '0015_calibrationjob_scope')]
+    after = [('mcq_be_app', '0016_testresult_answer_bits')]
+
+    def _migrate(self, targets):
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate(targets)
+        return executor.loader.project_state(targets).apps
+
+    def tearDown(self):
+        executor = MigrationExecutor(connection)
+        self._migrate(executor.loader.graph.leaf_nodes())
+
+    def test_answers_survive_the_migration(self):
+        answers = [[1, 0, 1], [], [0] * 8, [1, 1, 0, 1, 0, 0, 1, 1, 1]]
+        apps = self._migrate(self.before)
+        user = apps.get_model('auth', 'User').objects.create(username='teacher')
+        course = apps.get_model('mcq_be_app', 'Course').objects.create(name='Course', course_id='C1', owner_id=user.id)
+        test = apps.get_model('mcq_be_app', 'Test').objects.create(title='Midterm', course=course)
+        OldTestResult = apps.get_model('mcq_be_app', 'TestResult')
+        ids = [
+            OldTestResult.objects.create(test=test, student_id=f'student-{i}', answers=row).id
+            for i, row in enumerate(answers)
+        ]
+
+        apps = self._migrate(self.after)
+        TestResult = apps.get_model('mcq_be_app', 'TestResult')
+        for result_id, row in zip(ids, answers):
+            result = TestResult.objects.get(pk=result_id)
+            self.assertEqual(result.answer_count, len(row))
+            self.assertEqual(unpack_answers(bytes(result.answer_bits), result.answer_count), row)
+
+        apps = self._migrate(self.before)
+        OldTestResult = apps.get_model('mcq_be_app', 'TestResult')
+        self.assertEqual([OldTestResult.objects.get(pk=result_id).answers for result_id in ids], answers)
+
+
+class ItemAnalysisTest(SimpleTestCase):
+    """Classical statistics against values worked out by hand."""
+
+    # Totals 3, 2, 1, 1, 0: mean 1.4, variance 1.04; p = .6, .6, .2
+    responses = np.array([
+        [1, 1, 1],
+        [1, 1, 0],
+        [1, 0, 0],
+        [0, 1, 0],
+        [0, 0, 0],
+    ])
+    choices = np.array([[ord(c) if c != ' ' else 0 for c in row] for row in ['AAC', 'AAB', 'ABD', 'BAB', ' CB']])
+
+    def test_hand_computed_fixture(self):
+        items, test = analyze_items(self.responses, self.choices)
+
+        self.assertEqual([item['p_value'] for item in items], [0.6, 0.6, 0.2])
+        self.assertEqual(test['mean_score'], 1.4)
+        self.assertAlmostEqual(test['sd_score'], np.sqrt(1.04))
+        # KR-20 = 3/2 (1 - .64 / 1.04); alpha on sample variances = 3/2 (1 - .8 / 1.3); both 15/26
+        self.assertAlmostEqual(test['kr20'], 15 / 26)
+        self.assertAlmostEqual(test['cronbach_alpha'], 15 / 26)
+        self.assertAlmostEqual(test['sem'], np.sqrt(1.04 * (1 - 15 / 26)))
+
+        # Item 1: covariance with the total .36; with the rest of the test .12, whose variance is .56
+        self.assertAlmostEqual(items[0]['point_biserial'], 0.36 / np.sqrt(0.24 * 1.04))
+        self.assertAlmostEqual(items[0]['corrected_item_total'], 0.12 / np.sqrt(0.24 * 0.56))
+
+        # 27% of 5 students: the top scorer against the bottom one
+        self.assertEqual(test['group_size'], 1)
+        self.assertEqual([item['upper_p'] for item in items], [1.0, 1.0, 1.0])
+        self.assertEqual([item['lower_p'] for item in items], [0.0, 0.0, 0.0])
+        self.assertEqual([item['discrimination_index'] for item in items], [1.0, 1.0, 1.0])
+
+        self.assertEqual(items[0]['options'], {
+            'A': {'rate': 0.6, 'upper': 1.0, 'lower': 0.0},
+            'B': {'rate': 0.2, 'upper': 0.0, 'lower': 0.0},
+            OMITTED: {'rate': 0.2, 'upper': 0.0, 'lower': 1.0},
+        })
+        self.assertEqual({option: rates['rate'] for option, rates in items[2]['options'].items()},
+                         {'B': 0.6, 'C': 0.2, 'D': 0.2})
+
+    def test_zero_variance(self):
+        items, test = analyze_items(np.ones((4, 3)))
+        for item in items:
+            self.assertEqual(item['p_value'], 1.0)
+            self.assertIsNone(item['point_biserial'])
+            self.assertIsNone(item['corrected_item_total'])
+            self.assertEqual(item['discrimination_index'], 0.0)
+        self.assertEqual(test['sd_score'], 0.0)
+        self.assertIsNone(test['kr20'])
+        self.assertIsNone(test['cronbach_alpha'])
+        self.assertIsNone(test['sem'])
+
+    def test_single_student(self):
+        items, test = analyze_items(np.array([[1, 0, 1]]), np.array([[ord('A'), ord('B'), 0]]))
+        self.assertEqual([item['p_value'] for item in items], [1.0, 0.0, 1.0])
+        self.assertEqual(test['mean_score'], 2.0)
+        self.assertEqual(test['group_size'], 1)
+        self.assertIsNone(test['kr20'])
+        self.assertIsNone(test['cronbach_alpha'])
+        self.assertIsNone(items[0]['point_biserial'])
+        # The student is both the upper and the lower group
+        self.assertEqual(items[0]['discrimination_index'], 0.0)
+        self.assertEqual(items[2]['options'], {OMITTED: {'rate': 1.0, 'upper': 1.0, 'lower': 1.0}})
+
+
+class AbilityEstimationTest(SimpleTestCase):
+    """EAP and MLE abilities from known item parameters."""
+
+    num_items = 10
+    parameters = ItemParameters(
+        discrimination=np.full(num_items, 1.2),
+        difficulty=np.linspace(-2, 2, num_items),
+        guessing=np.zeros(num_items),
+        model='1PL'
+    )
+
+    def _responses(self):
+        # Row k: the k easiest items right, the others wrong
+        correct = np.arange(self.num_items)[None, :] < np.arange(self.num_items + 1)[:, None]
+        return sparse.csr_matrix(np.where(correct, 1, -1).astype('int8'))
+
+    def test_eap_increases_with_raw_score(self):
+        theta, se = estimate_abilities(self._responses(), self.parameters, EAP)
+        self.assertTrue(np.all(np.diff(theta) > 0), theta)
+        self.assertTrue(np.all(np.isfinite(se)) and np.all(se > 0))
+
+    def test_mle_clips_perfect_and_zero_scores(self):
+        theta, se = estimate_abilities(self._responses(), self.parameters, MLE)
+        self.assertTrue(np.all(np.isfinite(theta)) and np.all(np.isfinite(se)))
+        self.assertEqual(theta[0], ABILITY_BOUNDS[0])
+        self.assertEqual(theta[-1], ABILITY_BOUNDS[1])
+        self.assertTrue(np.all(np.diff(theta) > 0), theta)
+
+
+class ResultExportTest(TestCase):
+    """The results export streams every student's score and ability."""
+
+    def setUp(self):
+        user = User.objects.create(username='teacher')
+        self.course = Course.objects.create(name='Course', course_id='C1', owner=user)
+        self.test = Test.objects.create(title='Midterm', course=self.course)
+        TestResult.objects.create(
+            test=self.test, student_id='s1', answers=[1, 0, 1, 1, 0, 1, 1, 1, 1], theta=0.5, theta_se=0.3
+        )
+        TestResult.objects.create(test=self.test, student_id='s2', answers=[0] * 9)
+        self.client = APIClient()
+        self.client.force_authenticate(user)
+
+    def _export(self, output):
+        response = self.client.get(
+            f'/api/courses/{self.course.id}/tests/{self.test.id}/results/export/', {'output': output}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        return b''.join(response.streaming_content).decode()
+
+    def test_csv(self):
+        rows = list(csv.DictReader(io.StringIO(self._export('csv'))))
+        self.assertEqual(rows, [
+            {'student_id': 's1', 'score': '7', 'max_score': '9', 'theta': '0.5', 'theta_se': '0.3'},
+            {'student_id': 's2', 'score': '0', 'max_score': '9', 'theta': '', 'theta_se': ''},
+        ])
+
+    def test_ndjson(self):
+        rows = [json.loads(line) for line in self._export('ndjson').splitlines()]
+        self.assertEqual(rows, [
+            {'student_id': 's1', 'score': 7, 'max_score': 9, 'theta': 0.5, 'theta_se': 0.3},
+            {'student_id': 's2', 'score': 0, 'max_score': 9, 'theta': None, 'theta_se': None},
+        ])
+
+
+class AnswerSheetScoringTest(TestCase):
+    """Vectorized scoring matches the legacy loop; mappings are validated before they are stored."""
+
+    def test_parity_with_the_legacy_loop(self):
+        rng = np.random.default_rng(0)
+        for num_questions, num_versions, num_students in ((5, 1, 30), (12, 3, 200), (20, 6, 400)):
+            with self.subTest(questions=num_questions, versions=num_versions):
+                df_mapping = BenchmarkScoring._mapping_sheet(rng, num_questions, num_versions)
+                # A version missing its last question, and a row without a test question number
+                df_mapping = df_mapping.astype(object)
+                df_mapping.iloc[-1, -1] = None
+                df_mapping.loc[len(df_mapping)] = [None] + [1] * num_versions
+                df_answers = BenchmarkScoring._answer_sheet(rng, num_students, num_questions)
+
+                version_mappings = build_version_mappings(df_mapping)
+                response_matrix, rows, used_versions, _ = score_answer_sheet(
+                    df_answers, VersionIndex.from_mappings(version_mappings, num_questions), num_questions
+                )
+                legacy_matrix, legacy_versions = legacy_score(df_answers, version_mappings, num_questions)
+                self.assertEqual(response_matrix.tolist(), legacy_matrix)
+                self.assertEqual(used_versions, legacy_versions)
+                self.assertEqual(len(rows), len(legacy_matrix))
+
+    def test_mismatched_mappings(self):
+        df_mapping = pd.DataFrame({'Question': [1, 2, 3], 'Version 1': [1, 2, 3], 'Version 2': [3, None, 1]})
+        version_mappings = build_version_mappings(df_mapping)
+        self.assertEqual(version_mappings, {'Version 1': {1: 1, 2: 2, 3: 3}, 'Version 2': {3: 1, 1: 3}})
+        self.assertEqual(mapping_mismatches(version_mappings, 3), {'Version 2': 2})
+        self.assertEqual(mapping_mismatches(version_mappings, 4), {'Version 1': 3, 'Version 2': 2})
+
+    def test_only_valid_mappings_are_stored(self):
+        user = User.objects.create(username='teacher')
+        course = Course.objects.create(name='Course', course_id='C1', owner=user)
+        bank = QuestionBank.objects.create(name='Bank', bank_id='B1', created_by=user, course=course)
+        test = Test.objects.create(title='Midterm', course=course)
+        for i in range(3):
+            question = Question.objects.create(question_bank=bank, question_text=f'Question {i + 1}')
+            TestQuestion.objects.create(test=test, question=question, order=i)
+        client = APIClient()
+        client.force_authenticate(user)
+        url = f'/api/courses/{course.id}/tests/{test.id}/version-mapping/'
+
+        def put(content):
+            return client.put(
+                url, {'mapping_file': SimpleUploadedFile('mapping.csv', content.encode(), 'text/csv')},
+                format='multipart'
+            )
+
+        response = put('Question,Version 1,Version 2\n1,1,3\n2,2,\n3,3,1\n')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['mapped_questions'], 2)
+        self.assertEqual(client.get(url).status_code, 404)
+
+        response = put('Question,Version 1,Version 2\n1,1,3\n2,2,2\n3,3,1\n')
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertEqual(client.get(url).data['mapping'], {'Version 1': [1, 2, 3], 'Version 2': [3, 2, 1]})
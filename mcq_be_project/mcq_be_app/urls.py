@@ -25,6 +25,24 @@ urlpatterns = [
     path('courses/<int:course_id>/tests/<int:test_id>/results/upload/',
          views.upload_test_results,
          name='upload-test-results'),
+    path('courses/<int:course_id>/tests/<int:test_id>/calibration-jobs/<int:job_id>/',
+         views.calibration_job_detail,
+         name='calibration-job-detail'),
+    path('courses/<int:course_id>/tests/<int:test_id>/statistics/',
+         views.test_statistics_detail,
+         name='test-statistics-detail'),
+    path('courses/<int:course_id>/tests/<int:test_id>/version-mapping/',
+         views.test_version_mapping,
+         name='test-version-mapping'),
+    path('courses/<int:course_id>/tests/<int:test_id>/results/export/',
+         views.test_results_export,
+         name='test-results-export'),
+    path('courses/<int:course_id>/calibration-jobs/',
+         views.course_calibration_create,
+         name='course-calibration-create'),
+    path('courses/<int:course_id>/calibration-jobs/<int:job_id>/',
+         views.course_calibration_detail,
+         name='course-calibration-detail'),
     path('test-drafts/', views.test_draft_create, name='test-draft-create'),
     path('test-drafts/list/', views.test_draft_list, name='test-draft-list'),
     path('test-drafts/<int:draft_id>', views.test_draft_detail, name='test-draft-detail'),
@@ -42,8 +60,10 @@ urlpatterns = [
          views.question_group_questions, 
          name='question-group-questions'),
     path('questions/check-similarity/', views.check_question_similarity, name='check_question_similarity'),
+    path('questions/check-similarity/batch/', views.check_question_similarity_batch, name='check_question_similarity_batch'),
     path('question-banks/<int:question_bank_id>/similar-pairs/', views.find_similar_question_pairs, name='similar_question_pairs'),
     path('questions/similar-pairs/', views.find_similar_question_pairs, name='all_similar_question_pairs'),
+    path('similarity/cache-stats/', views.similarity_cache_stats, name='similarity-cache-stats'),
     path('generate-distractors/', 
          views.generate_distractors, 
          name='generate-distractors'),
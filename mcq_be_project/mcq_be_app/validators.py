@@ -1,14 +1,21 @@
 import re
-import spacy
 from typing import List, Dict, Any
 
-# Load spaCy model for grammatical analysis
-try:
-    nlp = spacy.load("en_core_web_sm")
-except OSError:
-    # Fallback if model isn't installed
-    import en_core_web_sm
-    nlp = en_core_web_sm.load()
+_nlp = None
+
+
+def get_nlp():
+    """Load the spaCy model for grammatical analysis on first use."""
+    global _nlp
+    if _nlp is None:
+        import spacy
+        try:
+            _nlp = spacy.load("en_core_web_sm")
+        except OSError:
+            # Fallback if model isn't installed
+            import en_core_web_sm
+            _nlp = en_core_web_sm.load()
+    return _nlp
 
 def check_missing_fields(mcq: Dict[str, Any]) -> List[str]:
     """Check if any required fields are missing."""
@@ -59,6 +66,7 @@ def check_grammatical_consistency(mcq: Dict[str, Any]) -> List[str]:
     option_texts = list(options.values())
     
     # Analyze grammatical structure
+    nlp = get_nlp()
     option_docs = [nlp(text) for text in option_texts]
     
     # Check if all options start with the same part of speech
@@ -6,24 +6,30 @@ from django.contrib.auth.models import User
 from django.contrib.auth.hashers import make_password
 from rest_framework.permissions import AllowAny
 from rest_framework.decorators import api_view, permission_classes
-from .models import QuestionBank, Question, Answer, Course, Taxonomy, QuestionTaxonomy, Test, TestQuestion, TestResult, TestDraft, QuestionGroup
-from .serializers import QuestionBankSerializer, QuestionSerializer, CourseSerializer, TestSerializer, TestDraftSerializer, QuestionTaxonomySerializer, QuestionGroupSerializer
+from .models import QuestionBank, Question, Answer, Course, Taxonomy, QuestionTaxonomy, Test, TestQuestion, TestResult, TestDraft, QuestionGroup, CalibrationJob, TestStatistics, TestVersionMapping
+from .serializers import QuestionBankSerializer, QuestionSerializer, CourseSerializer, TestSerializer, TestDraftSerializer, QuestionTaxonomySerializer, QuestionGroupSerializer, CalibrationJobSerializer, TestStatisticsSerializer, TestVersionMappingSerializer, load_bank_tree, question_prefetches, test_prefetches
+import math
 import uuid
 from django.db import transaction
+from django.db.models import Q
+from django.conf import settings
+from django.http import StreamingHttpResponse
 from .ai_service import AIService
 import io
 import csv
 from rest_framework.parsers import MultiPartParser
-import pandas as pd
-import numpy as np
-from sklearn.preprocessing import StandardScaler
-from girth import twopl_mml
-from datetime import datetime
-from .similarity_service import SimilarityService
+from .similarity_service import get_similarity_service
 from .permissions import IsCourseTeacherOrOwner
+from .scoring import VersionIndex, build_version_mappings, mapping_mismatches, score_answer_sheet
+from .responses import pack_rows
+from .result_export import CONTENT_TYPES, encode_rows, iter_result_rows
+from .calibration import enqueue_calibration
+import logging
 
-# Initialize the similarity service
-similarity_service = SimilarityService()
+logger = logging.getLogger(__name__)
+
+# The similarity service is cheap to create; its model loads on first use
+similarity_service = get_similarity_service()
 
 @api_view(['POST'])
 @permission_classes([AllowAny])
@@ -62,7 +68,7 @@ def question_bank_list(request, course_id):
                 # Get root-level banks (those without parent)
                 question_banks = QuestionBank.objects.filter(course=course, parent=None)
             
-            serializer = QuestionBankSerializer(question_banks, many=True)
+            serializer = QuestionBankSerializer(load_bank_tree(question_banks), many=True)
             return Response(serializer.data)
         
         elif request.method == 'POST':
@@ -94,7 +100,7 @@ def question_bank_detail(request, course_id, pk):
         return Response(status=status.HTTP_404_NOT_FOUND)
 
     if request.method == 'GET':
-        serializer = QuestionBankSerializer(question_bank)
+        serializer = QuestionBankSerializer(load_bank_tree([question_bank])[0])
         return Response(serializer.data)
 
     elif request.method == 'PUT':
@@ -123,7 +129,7 @@ def question_list(request, course_id, bank_id):
         return Response(status=status.HTTP_404_NOT_FOUND)
 
     if request.method == 'GET':
-        questions = Question.objects.filter(question_bank=question_bank)
+        questions = Question.objects.filter(question_bank=question_bank).prefetch_related(*question_prefetches())
         serializer = QuestionSerializer(questions, many=True)
         return Response(serializer.data)
 
@@ -358,7 +364,7 @@ def test_list(request, course_id):
         return Response({'error': 'Course not found'}, status=status.HTTP_404_NOT_FOUND)
 
     if request.method == 'GET':
-        tests = Test.objects.filter(course=course)
+        tests = Test.objects.filter(course=course).prefetch_related(*test_prefetches())
         serializer = TestSerializer(tests, many=True)
         return Response(serializer.data)
 
@@ -373,8 +379,11 @@ def test_list(request, course_id):
 @api_view(['GET', 'PUT', 'DELETE'])
 @permission_classes([IsAuthenticated, IsCourseTeacherOrOwner])
 def test_detail(request, course_id, pk):
+    tests = Test.objects.select_related('course')
+    if request.method == 'GET':
+        tests = tests.prefetch_related(*test_prefetches())
     try:
-        test = Test.objects.get(course_id=course_id, pk=pk)
+        test = tests.get(course_id=course_id, pk=pk)
         # Check object-level permissions
         if not IsCourseTeacherOrOwner().has_object_permission(request, None, test.course):
             return Response({"detail": "You do not have permission to access this test."}, 
@@ -407,7 +416,7 @@ def test_detail(request, course_id, pk):
                 )
         
         # Return updated test data
-        serializer = TestSerializer(test)
+        serializer = TestSerializer(Test.objects.prefetch_related(*test_prefetches()).get(pk=test.pk))
         return Response(serializer.data)
 
     elif request.method == 'DELETE':
@@ -505,7 +514,7 @@ def create_test(request, course_id):
             except Question.DoesNotExist:
                 continue
         
-        serializer = TestSerializer(test)
+        serializer = TestSerializer(Test.objects.prefetch_related(*test_prefetches()).get(pk=test.pk))
         return Response(serializer.data, status=status.HTTP_201_CREATED)
     
     except Exception as e:
@@ -531,7 +540,7 @@ def upload_test_results(request, course_id, test_id):
         
         # Get the number of questions in this test
         num_questions = test_questions.count()
-        print(f"Number of questions in test: {num_questions}")
+        logger.debug("Number of questions in test: %s", num_questions)
         
     except Test.DoesNotExist:
         return Response({'error': 'Test not found'}, status=status.HTTP_404_NOT_FOUND)
@@ -540,242 +549,258 @@ def upload_test_results(request, course_id, test_id):
         return Response({'error': 'File is required'}, status=status.HTTP_400_BAD_REQUEST)
 
     file = request.FILES['file']
-    results = []
-    response_matrix = []
+    # Replaces the test's stored version mapping; otherwise the stored one is used, and
+    # only without one is the workbook's third sheet read (and stored for next time)
+    mapping_file = request.FILES.get('mapping_file')
+    stored_mapping = TestVersionMapping.objects.filter(test=test).first()
+    use_stored_mapping = mapping_file is None and stored_mapping is not None
+    if use_stored_mapping and stored_mapping.num_questions != num_questions:
+        return Response({
+            'error': f'The stored version mapping is for {stored_mapping.num_questions} questions, '
+                     f'but the test now has {num_questions}; upload a new mapping_file',
+            'test_questions': num_questions,
+            'mapped_questions': stored_mapping.num_questions
+        }, status=status.HTTP_400_BAD_REQUEST)
+    results_count = 0
+    students_read = 0
 
     try:
-        # Read all sheets from Excel file
-        excel_file = pd.ExcelFile(file)
-        
-        # Read answers from first sheet
-        df_answers = pd.read_excel(excel_file, sheet_name=0)
-        
-        # Read mapping from third sheet
-        df_mapping = pd.read_excel(excel_file, sheet_name=2)
-        print("Available columns:", df_mapping.columns.tolist())
-        
-        # Create mapping dictionaries for each version
-        version_mappings = {}
-        db_col = df_mapping.columns[0]  # First column has our DB question numbers
-        
-        # For each version (each column after the first)
-        for version_col in df_mapping.columns[1:]:
-            version_mapping = {}
-            # For each row in mapping
-            for index, row in df_mapping.iterrows():
-                db_question = row[db_col]      # Get the DB question number
-                version_q = row[version_col]   # Get the shuffled question number
-                if pd.notna(db_question) and pd.notna(version_q):
-                    # Map from shuffled question number to DB question number
-                    version_mapping[int(version_q)] = int(db_question)
-            version_mappings[version_col] = version_mapping
-        
-        # Verify that the mapping contains all questions from the test
-        for version, mapping in version_mappings.items():
-            mapped_questions = set(mapping.values())
-            if len(mapped_questions) != num_questions:
-                return Response({
-                    'error': f'Mapping mismatch: Test has {num_questions} questions, but mapping for version {version} has {len(mapped_questions)} questions',
-                    'test_questions': num_questions,
-                    'mapped_questions': len(mapped_questions)
-                }, status=status.HTTP_400_BAD_REQUEST)
-        
-        # Initialize response matrix
-        response_matrix = []
-        
-        # Process each student's answers
-        for idx, row in df_answers.iterrows():
-            student_responses = [0] * num_questions  # Initialize with zeros
-            has_answers = False
-            student_id = str(uuid.uuid4())
-            
-            # Get all C columns that exist
-            c_columns = [col for col in df_answers.columns if col.startswith('C')]
-            
-            # Try each version's mapping until we find one that works
-            used_version = None
-            for version, mapping in version_mappings.items():
-                test_responses = [0] * num_questions
-                valid_answers = 0
-                
-                # Try mapping all answers using this version
-                for col in c_columns:
-                    if pd.notna(row[col]):
-                        q_num = int(col[1:])  # Extract number from C1, C2, etc.
-                        if q_num in mapping:
-                            db_q_num = mapping[q_num]  # Get original DB question number
-                            answer_value = str(row[col])
-                            is_correct = answer_value.endswith('1')
-                            
-                            # Adjust index to 0-based
-                            mapped_index = db_q_num - 1
-                            if 0 <= mapped_index < num_questions:
-                                test_responses[mapped_index] = 1 if is_correct else 0
-                                valid_answers += 1
-                
-                # If this version gave us the most valid answers, use it
-                if valid_answers > sum(student_responses):
-                    student_responses = test_responses
-                    used_version = version
-                    has_answers = valid_answers > 0
-            
-            if has_answers:
-                print(f"Student {idx} used version {used_version} with {sum(student_responses)} valid answers")
-                
-                # Check if the number of valid answers matches the test's question count
-                if valid_answers != num_questions:
-                    print(f"Warning: Student {idx} has {valid_answers} valid answers, but test has {num_questions} questions")
-                
-                response_matrix.append(student_responses)
-                # Create TestResult record
-                TestResult.objects.create(
-                    test=test,
-                    student_id=student_id,
-                    answers=student_responses
-                )
-                results.append({
-                    'student_id': student_id,
-                    'answers': student_responses,
-                    'version': used_version
-                })
+        # Imported here: pandas is slow to import and only this upload needs it
+        from .result_files import open_result_upload
+
+        with open_result_upload(
+            file, mapping_file, settings.RESULTS_UPLOAD_CHUNK_SIZE, with_mapping=not use_stored_mapping
+        ) as (df_mapping, answer_chunks):
+            if use_stored_mapping:
+                version_index = stored_mapping.version_index()
             else:
-                print(f"Skipped student {idx} - no valid answers found in any version")
-        
-        # Check if we have any valid responses
-        if len(response_matrix) == 0:
-            return Response({
-                'error': 'No valid student responses found in the uploaded file'
-            }, status=status.HTTP_400_BAD_REQUEST)
-        
-        # Convert to numpy array for IRT calculation
-        response_matrix = np.array(response_matrix)
-        print(f"Final response matrix shape: {response_matrix.shape}")
-
-        # Verify response matrix dimensions match test questions
-        if response_matrix.shape[1] != num_questions:
-            return Response({
-                'error': f'Response matrix has {response_matrix.shape[1]} columns, but test has {num_questions} questions',
-                'test_questions': num_questions,
-                'response_columns': response_matrix.shape[1]
-            }, status=status.HTTP_400_BAD_REQUEST)
-            
-        try:
-            print("Attempting IRT calculation...")
-            print(f"Response matrix shape before IRT: {response_matrix.shape}")
-            
-            # Create a mapping of array index to question ID
-            index_to_question = {}
-            for i, question in enumerate(test_questions):
-                index_to_question[i] = question
-            
-            # Calculate classical statistics first
-            question_stats = {}
-            for i in range(response_matrix.shape[1]):
-                if i in index_to_question:
-                    question = index_to_question[i]
-                    total_responses = len(response_matrix)
-                    correct_responses = int(response_matrix[:, i].sum())
-                    p_value = float(correct_responses / total_responses) if total_responses > 0 else 0
-                    
-                    question_stats[question.id] = {
-                        'classical_parameters': {
-                            'p_value': p_value,
-                            'total_responses': total_responses,
-                            'correct_responses': correct_responses,
-                        }
-                    }
-                    print(f"Classical stats for question {question.id}: p={p_value}, correct={correct_responses}/{total_responses}")
-            
-            try:
-                # Import 3PL model from girth
-                from girth import threepl_mml
-                
-                # Call threepl_mml without the guessing parameter
-                # Let the function handle guessing initialization internally
-                irt_result = threepl_mml(response_matrix)
-                
-                # Extract parameters from result
-                discrimination = irt_result['Discrimination']
-                difficulty = irt_result['Difficulty']
-                guessing = irt_result['Guessing']  # The guessing param should be in the result
-                
-                # Update statistics for each question
-                for i, question in enumerate(test_questions):
-                    if not question.statistics:
-                        question.statistics = {}
-                    
-                    if question.id in question_stats:
-                        new_stats = {
-                            'irt_parameters': {
-                                'difficulty': float(difficulty[i]),
-                                'discrimination': float(discrimination[i]),
-                                'guessing': float(guessing[i]),
-                            },
-                            'classical_parameters': question_stats[question.id]['classical_parameters'],
-                            'last_updated': str(datetime.now())
-                        }
-                        
-                        print(f"Updating statistics for question {question.id}:")
-                        print(f"Old statistics: {question.statistics}")
-                        print(f"New statistics: {new_stats}")
-                        
-                        question.statistics.update(new_stats)
-                        question.save()
-            
-            except Exception as irt_calc_error:
-                print(f"IRT calculation specific error: {str(irt_calc_error)}")
-                # Even if IRT fails, save the classical statistics
-                for question in test_questions:
-                    if not question.statistics:
-                        question.statistics = {}
-                    
-                    if question.id in question_stats:
-                        question.statistics.update({
-                            'classical_parameters': question_stats[question.id]['classical_parameters'],
-                            'error': f'IRT calculation failed: {str(irt_calc_error)}',
-                            'last_updated': str(datetime.now())
-                        })
-                        question.save()
-                raise
-
-        except Exception as irt_error:
-            print(f"IRT calculation error: {str(irt_error)}")
-            # Fallback to classical statistics
-            for i, question in enumerate(test_questions):
-                if not question.statistics:
-                    question.statistics = {}
-                
-                total_responses = len(response_matrix)
-                correct_responses = int(response_matrix[:, i].sum()) if len(response_matrix) > 0 else 0
+                logger.debug("Available columns: %s", df_mapping.columns.tolist())
+
+                # Verify that the mapping contains all questions from the test
+                version_mappings = build_version_mappings(df_mapping)
+                mismatch = _mapping_mismatch_response(version_mappings, num_questions)
+                if mismatch is not None:
+                    return mismatch
+                version_index = VersionIndex.from_mappings(version_mappings, num_questions)
+
+            # Score and store the students chunk by chunk, all or nothing
+            with transaction.atomic():
+                for df_answers in answer_chunks:
+                    response_matrix, scored_rows, used_versions, choices = score_answer_sheet(
+                        df_answers, version_index, num_questions
+                    )
+                    students_read += len(df_answers)
+                    TestResult.objects.bulk_create(
+                        [
+                            TestResult(
+                                test=test,
+                                student_id=str(uuid.uuid4()),
+                                answer_bits=answer_bits,
+                                answer_count=num_questions,
+                                choice_bytes=student_choices.tobytes()
+                            )
+                            for answer_bits, student_choices in zip(pack_rows(response_matrix), choices)
+                        ],
+                        batch_size=settings.RESULTS_BULK_BATCH_SIZE
+                    )
+                    results_count += len(response_matrix)
                 
-                new_stats = {
-                    'classical_parameters': {
-                        'p_value': float(correct_responses / total_responses) if total_responses > 0 else 0,
-                        'total_responses': total_responses,
-                        'correct_responses': correct_responses,
-                    },
-                    'error': f'IRT calculation failed: {str(irt_error)}',
-                    'last_updated': str(datetime.now())
-                }
+                logger.info(
+                    "Test %s: scored %s of %s students; skipped %s with no valid answers in any version",
+                    test.id, results_count, students_read, students_read - results_count
+                )
                 
-                print(f"Updating statistics for question {question.id} (error fallback):")
-                print(f"Old statistics: {question.statistics}")
-                print(f"New statistics: {new_stats}")
+                # Check if we have any valid responses
+                if results_count == 0:
+                    return Response({
+                        'error': 'No valid student responses found in the uploaded file'
+                    }, status=status.HTTP_400_BAD_REQUEST)
                 
-                question.statistics.update(new_stats)
-                question.save()
+                if not use_stored_mapping:
+                    _save_version_mapping(test, version_index, num_questions, request.user)
+
+                # Queue the IRT calibration
+                job = enqueue_calibration(
+                    test.course,
+                    None if settings.CALIBRATION_SCOPE == CalibrationJob.COURSE else test,
+                    request.user
+                )
 
         return Response({
             'message': 'Test results uploaded successfully',
             'test_id': test.id,
-            'results_count': len(results),
-            'irt_calculated': True,
-            'model_used': '3PL'  # Add information about which model was used
+            'results_count': results_count,
+            'irt_calculated': False,
+            'model_used': None,  # Selected by the calibration job
+            'calibration_job_id': job.id,
+            'calibration_scope': job.scope,
+            'calibration_status': job.status
         }, status=status.HTTP_201_CREATED)
 
     except Exception as e:
         return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
+def _mapping_mismatch_response(version_mappings, num_questions):
+    """400 response if the mapping does not cover exactly the test's questions in every version."""
+    if not version_mappings:
+        return Response({'error': 'The mapping has no version columns'}, status=status.HTTP_400_BAD_REQUEST)
+    mismatches = mapping_mismatches(version_mappings, num_questions)
+    if not mismatches:
+        return None
+    version, mapped_questions = next(iter(mismatches.items()))
+    return Response({
+        'error': f'Mapping mismatch: Test has {num_questions} questions, but mapping for version {version} has {mapped_questions} questions',
+        'test_questions': num_questions,
+        'mapped_questions': mapped_questions
+    }, status=status.HTTP_400_BAD_REQUEST)
+
+def _save_version_mapping(test, version_index, num_questions, user):
+    mapping = TestVersionMapping.objects.filter(test=test).first() or TestVersionMapping(test=test)
+    mapping.set_version_index(version_index)
+    mapping.num_questions = num_questions
+    mapping.created_by = user
+    mapping.save()
+    return mapping
+
+@api_view(['GET', 'PUT', 'DELETE'])
+@permission_classes([IsAuthenticated, IsCourseTeacherOrOwner])
+@parser_classes([MultiPartParser])
+def test_version_mapping(request, course_id, test_id):
+    """
+    The stored version mapping of a test. PUT a mapping_file (CSV, or xlsx
+    with the mapping on its first sheet) to validate and store it; result
+    uploads then only need the answers.
+    """
+    try:
+        test = Test.objects.select_related('course').get(course_id=course_id, pk=test_id)
+    except Test.DoesNotExist:
+        return Response({'error': 'Test not found'}, status=status.HTTP_404_NOT_FOUND)
+
+    # Check object-level permissions
+    if not IsCourseTeacherOrOwner().has_object_permission(request, None, test.course):
+        return Response({"detail": "You do not have permission to access this test."},
+                       status=status.HTTP_403_FORBIDDEN)
+
+    if request.method == 'PUT':
+        if 'mapping_file' not in request.FILES:
+            return Response({'error': 'mapping_file is required'}, status=status.HTTP_400_BAD_REQUEST)
+        num_questions = TestQuestion.objects.filter(test=test).count()
+        try:
+            from .result_files import read_mapping
+
+            version_mappings = build_version_mappings(read_mapping(request.FILES['mapping_file']))
+        except Exception as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        mismatch = _mapping_mismatch_response(version_mappings, num_questions)
+        if mismatch is not None:
+            return mismatch
+        mapping = _save_version_mapping(
+            test, VersionIndex.from_mappings(version_mappings, num_questions), num_questions, request.user
+        )
+        return Response(TestVersionMappingSerializer(mapping).data)
+
+    try:
+        mapping = test.version_mapping
+    except TestVersionMapping.DoesNotExist:
+        return Response({'error': 'This test has no stored version mapping'}, status=status.HTTP_404_NOT_FOUND)
+    if request.method == 'DELETE':
+        mapping.delete()
+        return Response(status=status.HTTP_204_NO_CONTENT)
+    return Response(TestVersionMappingSerializer(mapping).data)
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated, IsCourseTeacherOrOwner])
+def calibration_job_detail(request, course_id, test_id, job_id):
+    """A job of the test, or a pooled job of its course (what uploads queue when CALIBRATION_SCOPE = "course")."""
+    try:
+        job = CalibrationJob.objects.select_related('course').filter(
+            Q(test_id=test_id) | Q(scope=CalibrationJob.COURSE, course__tests__id=test_id),
+            course_id=course_id
+        ).get(pk=job_id)
+    except CalibrationJob.DoesNotExist:
+        return Response({'error': 'Calibration job not found'}, status=status.HTTP_404_NOT_FOUND)
+
+    # Check object-level permissions
+    if not IsCourseTeacherOrOwner().has_object_permission(request, None, job.course):
+        return Response({"detail": "You do not have permission to access this test."},
+                       status=status.HTTP_403_FORBIDDEN)
+
+    return Response(CalibrationJobSerializer(job).data)
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated, IsCourseTeacherOrOwner])
+def test_statistics_detail(request, course_id, test_id):
+    try:
+        statistics = TestStatistics.objects.select_related('test__course').get(
+            test_id=test_id, test__course_id=course_id
+        )
+    except TestStatistics.DoesNotExist:
+        return Response({'error': 'No statistics for this test yet'}, status=status.HTTP_404_NOT_FOUND)
+
+    # Check object-level permissions
+    if not IsCourseTeacherOrOwner().has_object_permission(request, None, statistics.test.course):
+        return Response({"detail": "You do not have permission to access this test."},
+                       status=status.HTTP_403_FORBIDDEN)
+
+    return Response(TestStatisticsSerializer(statistics).data)
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated, IsCourseTeacherOrOwner])
+def test_results_export(request, course_id, test_id):
+    """Stream every student's score, ability and standard error; ?output=csv (default) or ndjson."""
+    try:
+        test = Test.objects.select_related('course').get(course_id=course_id, pk=test_id)
+    except Test.DoesNotExist:
+        return Response({'error': 'Test not found'}, status=status.HTTP_404_NOT_FOUND)
+
+    # Check object-level permissions
+    if not IsCourseTeacherOrOwner().has_object_permission(request, None, test.course):
+        return Response({"detail": "You do not have permission to access this test."},
+                       status=status.HTTP_403_FORBIDDEN)
+
+    # Not ?format=, which DRF reserves for choosing a renderer
+    output = request.query_params.get('output', 'csv')
+    if output not in CONTENT_TYPES:
+        return Response({'error': f'output must be one of: {", ".join(CONTENT_TYPES)}'},
+                        status=status.HTTP_400_BAD_REQUEST)
+
+    rows = iter_result_rows(TestResult.objects.filter(test=test), settings.RESULTS_UPLOAD_CHUNK_SIZE)
+    response = StreamingHttpResponse(encode_rows(rows, output), content_type=CONTENT_TYPES[output])
+    response['Content-Disposition'] = f'attachment; filename="test_{test.id}_results.{output}"'
+    return response
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated, IsCourseTeacherOrOwner])
+def course_calibration_create(request, course_id):
+    """Queue a pooled calibration of every question of the course on all its results."""
+    try:
+        course = Course.objects.get(pk=course_id)
+    except Course.DoesNotExist:
+        return Response({'error': 'Course not found'}, status=status.HTTP_404_NOT_FOUND)
+
+    # Check object-level permissions
+    if not IsCourseTeacherOrOwner().has_object_permission(request, None, course):
+        return Response({"detail": "You do not have permission to access this course."},
+                       status=status.HTTP_403_FORBIDDEN)
+
+    job = enqueue_calibration(course, user=request.user)
+    return Response(CalibrationJobSerializer(job).data, status=status.HTTP_202_ACCEPTED)
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated, IsCourseTeacherOrOwner])
+def course_calibration_detail(request, course_id, job_id):
+    try:
+        job = CalibrationJob.objects.select_related('course').get(pk=job_id, course_id=course_id)
+    except CalibrationJob.DoesNotExist:
+        return Response({'error': 'Calibration job not found'}, status=status.HTTP_404_NOT_FOUND)
+
+    # Check object-level permissions
+    if not IsCourseTeacherOrOwner().has_object_permission(request, None, job.course):
+        return Response({"detail": "You do not have permission to access this course."},
+                       status=status.HTTP_403_FORBIDDEN)
+
+    return Response(CalibrationJobSerializer(job).data)
+
 @api_view(['POST', 'DELETE'])
 @permission_classes([IsAuthenticated, IsCourseTeacherOrOwner])
 def test_draft_create(request):
@@ -968,7 +993,7 @@ def update_test(request, course_id, test_id):
                 )
         
         # Return updated test data
-        serializer = TestSerializer(test)
+        serializer = TestSerializer(Test.objects.prefetch_related(*test_prefetches()).get(pk=test.pk))
         return Response(serializer.data)
         
     except Test.DoesNotExist:
@@ -1046,19 +1071,136 @@ def question_group_questions(request, course_id, bank_id, group_id):
     except (Course.DoesNotExist, QuestionBank.DoesNotExist, QuestionGroup.DoesNotExist):
         return Response(status=status.HTTP_404_NOT_FOUND)
 
-    questions = Question.objects.filter(question_group=question_group)
+    questions = Question.objects.filter(question_group=question_group).prefetch_related(*question_prefetches())
     serializer = QuestionSerializer(questions, many=True)
     return Response(serializer.data)
 
+def _flag(value) -> bool:
+    """Boolean request parameter: a JSON boolean, or "true"/"1" in any case from form data or a query string."""
+    if isinstance(value, str):
+        return value.strip().lower() in ('true', '1')
+    return value in (True, 1)
+
+def _number_param(data, name, default, cast, minimum=None, maximum=None):
+    """
+    Numeric request parameter within [minimum, maximum].
+
+    Raises:
+        ValueError: With a message for the client if the value is not a number or out of bounds
+    """
+    value = data.get(name, default)
+    try:
+        value = cast(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{name} must be a number")
+    if not math.isfinite(value) or (minimum is not None and value < minimum) or (
+        maximum is not None and value > maximum
+    ):
+        if minimum is not None and maximum is not None:
+            bounds = f" between {minimum} and {maximum}"
+        elif minimum is not None:
+            bounds = f" of at least {minimum}"
+        elif maximum is not None:
+            bounds = f" of at most {maximum}"
+        else:
+            bounds = ""
+        raise ValueError(f"{name} must be a number{bounds}")
+    return value
+
+def _list_param(data, name):
+    """List request parameter: a JSON list or single value, or repeated or comma-separated form values."""
+    if hasattr(data, 'getlist'):
+        values = data.getlist(name)
+    else:
+        value = data.get(name)
+        values = value if isinstance(value, (list, tuple)) else [value]
+    items = []
+    for value in values:
+        if isinstance(value, str):
+            items.extend(part.strip() for part in value.split(',') if part.strip())
+        elif value is not None:
+            items.append(value)
+    return items
+
+def _similarity_filters(data):
+    """
+    Metadata filters for similarity search, from request data.
+
+    Raises:
+        ValueError: With a message for the client if a filter is malformed
+    """
+    filters = {}
+    if data.get('question_bank_ids') is not None:
+        bank_ids = _list_param(data, 'question_bank_ids')
+        if not all(
+            isinstance(bank_id, int) and not isinstance(bank_id, bool) or isinstance(bank_id, str) and bank_id.isdigit()
+            for bank_id in bank_ids
+        ):
+            raise ValueError("question_bank_ids must be a list of question bank ids")
+        filters['question_bank_ids'] = [int(bank_id) for bank_id in bank_ids]
+    difficulties = _list_param(data, 'difficulties') or _list_param(data, 'difficulty')
+    if difficulties:
+        filters['difficulties'] = [str(difficulty) for difficulty in difficulties]
+    if data.get('taxonomy_id') not in (None, ''):
+        filters['taxonomy_id'] = _number_param(data, 'taxonomy_id', None, int, 1)
+        filters['taxonomy_levels'] = [str(level) for level in _list_param(data, 'taxonomy_levels')] or None
+    return filters
+
+def _similarity_scope(request):
+    """
+    Question bank and course a similarity search is restricted to, from request data.
+
+    Returns:
+        (question_bank_id, course_id, error) where error is a 404 or 403
+        response if the bank or course does not exist or is not the user's
+
+    Raises:
+        ValueError: With a message for the client if an id is malformed
+    """
+    ids = {}
+    for name in ('question_bank_id', 'course_id'):
+        if request.data.get(name) in (None, ''):
+            ids[name] = None
+        else:
+            ids[name] = _number_param(request.data, name, None, int, 1)
+    question_bank_id, course_id = ids['question_bank_id'], ids['course_id']
+
+    # The bank takes precedence over the course when searching, so check the one that is used
+    if question_bank_id:
+        try:
+            scope = QuestionBank.objects.select_related('course').get(pk=question_bank_id)
+        except QuestionBank.DoesNotExist:
+            return question_bank_id, course_id, Response(
+                {"error": f"Question bank with id {question_bank_id} does not exist"}, 
+                status=status.HTTP_404_NOT_FOUND
+            )
+    elif course_id:
+        try:
+            scope = Course.objects.get(pk=course_id)
+        except Course.DoesNotExist:
+            return question_bank_id, course_id, Response(
+                {"error": f"Course with id {course_id} does not exist"}, 
+                status=status.HTTP_404_NOT_FOUND
+            )
+    else:
+        return question_bank_id, course_id, None
+    if not IsCourseTeacherOrOwner().has_object_permission(request, None, scope):
+        return question_bank_id, course_id, Response(
+            {"error": "You do not have permission to access this course"}, 
+            status=status.HTTP_403_FORBIDDEN
+        )
+    return question_bank_id, course_id, None
+
 @api_view(['POST'])
 @permission_classes([IsAuthenticated, IsCourseTeacherOrOwner])
 def check_question_similarity(request):
     """
     Check if a question is similar to existing questions in the database.
+    
+    Matches can be filtered by question_bank_ids, difficulties (or difficulty),
+    and taxonomy_id with optional taxonomy_levels.
     """
     question_text = request.data.get('question_text')
-    question_bank_id = request.data.get('question_bank_id')
-    threshold = request.data.get('threshold', 0.75)
     
     if not question_text:
         return Response(
@@ -1066,52 +1208,111 @@ def check_question_similarity(request):
             status=status.HTTP_400_BAD_REQUEST
         )
     
-    # Build or update the index if question_bank_id is provided
-    if question_bank_id:
-        try:
-            question_bank = QuestionBank.objects.get(pk=question_bank_id)
-            similarity_service.build_index_from_db(question_bank_id)
-        except QuestionBank.DoesNotExist:
-            return Response(
-                {"error": f"Question bank with id {question_bank_id} does not exist"}, 
-                status=status.HTTP_404_NOT_FOUND
-            )
-    else:
-        # Use all questions if no question bank specified
-        similarity_service.build_index_from_db()
+    try:
+        threshold = _number_param(request.data, 'threshold', 0.75, float, 0, 1)
+        question_bank_id, course_id, error = _similarity_scope(request)
+        filters = _similarity_filters(request.data)
+    except ValueError as e:
+        return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    # Validate question bank or course if provided; otherwise search all questions
+    if error:
+        return error
     
-    # Find similar questions
+    # Find similar questions; results come enriched from the index's metadata
     similar_questions = similarity_service.find_similar_questions(
         question_text, 
-        threshold=threshold
+        question_bank_id=question_bank_id,
+        course_id=course_id,
+        threshold=threshold,
+        filters=filters
     )
     
-    # Get full question details
-    if similar_questions:
-        question_ids = [q['question_id'] for q in similar_questions]
-        questions = Question.objects.filter(id__in=question_ids)
-        
-        # Enrich results with question details
-        for result in similar_questions:
-            question = next((q for q in questions if q.id == result['question_id']), None)
-            if question:
-                result['question_text'] = question.question_text
-                result['question_bank_id'] = question.question_bank_id
-    
     return Response({
         "question_text": question_text,
         "similar_questions": similar_questions,
         "total_matches": len(similar_questions)
     }, status=status.HTTP_200_OK)
 
+@api_view(['POST'])
+@permission_classes([IsAuthenticated, IsCourseTeacherOrOwner])
+def check_question_similarity_batch(request):
+    """
+    Check many candidate questions (e.g. a generated batch or an upload) against
+    existing questions at once, optionally flagging near-duplicates within the batch.
+    Accepts the same filters as check_question_similarity.
+    """
+    question_texts = request.data.get('question_texts')
+    check_within_batch = _flag(request.data.get('check_within_batch', False))
+    max_texts = getattr(settings, 'SIMILARITY_BATCH_MAX_TEXTS', 1000)
+    try:
+        threshold = _number_param(request.data, 'threshold', 0.75, float, 0, 1)
+        top_k = _number_param(request.data, 'top_k', 5, int, 1, max_texts)
+        within_batch_threshold = _number_param(request.data, 'within_batch_threshold', threshold, float, 0, 1)
+        filters = _similarity_filters(request.data)
+        question_bank_id, course_id, error = _similarity_scope(request)
+    except ValueError as e:
+        return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    
+    if not isinstance(question_texts, list) or not question_texts:
+        return Response(
+            {"error": "question_texts must be a non-empty list"}, 
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    if len(question_texts) > max_texts:
+        return Response(
+            {"error": f"At most {max_texts} question texts can be checked at once"}, 
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    if not all(isinstance(text, str) and text.strip() for text in question_texts):
+        return Response(
+            {"error": "Every question text must be a non-empty string"}, 
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    
+    # Validate question bank or course if provided; otherwise search all questions
+    if error:
+        return error
+    
+    # One encode and one index search for the whole batch; matches come enriched
+    # from the index's metadata
+    batch_result = similarity_service.find_similar_questions_batch(
+        question_texts,
+        question_bank_id=question_bank_id,
+        course_id=course_id,
+        threshold=threshold,
+        top_k=top_k,
+        duplicate_threshold=within_batch_threshold if check_within_batch else None,
+        filters=filters
+    )
+    
+    results = []
+    for index, (question_text, similar_questions) in enumerate(zip(question_texts, batch_result['matches'])):
+        results.append({
+            "index": index,
+            "question_text": question_text,
+            "similar_questions": similar_questions,
+            "total_matches": len(similar_questions)
+        })
+    
+    response = {
+        "results": results,
+        "candidates_with_matches": sum(1 for result in results if result['total_matches'])
+    }
+    if check_within_batch:
+        response["within_batch_duplicates"] = batch_result['batch_duplicates']
+    return Response(response, status=status.HTTP_200_OK)
+
 @api_view(['GET'])
 @permission_classes([IsAuthenticated, IsCourseTeacherOrOwner])
 def find_similar_question_pairs(request, question_bank_id=None):
     """
     Find all pairs of similar questions within a question bank.
     """
-    threshold = float(request.query_params.get('threshold', 0.85))
-    max_pairs = int(request.query_params.get('max_pairs', 100))
+    try:
+        threshold = _number_param(request.query_params, 'threshold', 0.85, float, 0, 1)
+        max_pairs = _number_param(request.query_params, 'max_pairs', 100, int, 1)
+    except ValueError as e:
+        return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
     
     # Validate question bank if provided
     if question_bank_id:
@@ -1132,6 +1333,17 @@ def find_similar_question_pairs(request, question_bank_id=None):
     
     return Response(similar_pairs, status=status.HTTP_200_OK)
 
+@api_view(['GET'])
+@permission_classes([IsAuthenticated, IsAdminUser])
+def similarity_cache_stats(request):
+    """
+    Embedding cache hit/miss counters and index cache size of this worker process.
+    """
+    return Response({
+        'embedding_cache': similarity_service.embedding_cache.stats(),
+        'index_cache_bytes': similarity_service.indexes.nbytes
+    }, status=status.HTTP_200_OK)
+
 @api_view(['POST'])
 @permission_classes([IsAuthenticated, IsCourseTeacherOrOwner])
 def generate_distractors(request):
@@ -1303,13 +1515,20 @@ def compare_tests(request):
         "test2_questions": [{...}, {...}],
         "similarity_threshold": 0.75  # optional
     }
+    
+    Set "include_matching": true to also get the optimal one-to-one
+    question matching metrics.
     """
     # Get parameters
     test1_id = request.data.get('test1_id')
     test2_id = request.data.get('test2_id')
     test1_questions = request.data.get('test1_questions')
     test2_questions = request.data.get('test2_questions')
-    similarity_threshold = float(request.data.get('similarity_threshold', 0.75))
+    include_matching = _flag(request.data.get('include_matching', False))
+    try:
+        similarity_threshold = _number_param(request.data, 'similarity_threshold', 0.75, float, 0, 1)
+    except ValueError as e:
+        return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
     
     # Validate that we have either test IDs or question lists
     if not ((test1_id and test2_id) or (test1_questions and test2_questions)):
@@ -1352,7 +1571,8 @@ def compare_tests(request):
         similarity_result = similarity_service.compare_tests(
             test1_questions=test1_questions,
             test2_questions=test2_questions,
-            similarity_threshold=similarity_threshold
+            similarity_threshold=similarity_threshold,
+            include_matching=include_matching
         )
         
         # Add test information to the response
@@ -1393,10 +1613,12 @@ def find_similar_tests(request, test_id):
     - max_results: Maximum number of similar tests to return (default: 5)
     """
     try:
-        # Get parameters
-        threshold = float(request.query_params.get('threshold', 0.75))
-        max_results = int(request.query_params.get('max_results', 5))
-        
+        threshold = _number_param(request.query_params, 'threshold', 0.75, float, 0, 1)
+        max_results = _number_param(request.query_params, 'max_results', 5, int, 1)
+    except ValueError as e:
+        return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    
+    try:
         # Get the test and check permissions
         test = Test.objects.get(pk=test_id)
         course = test.course
@@ -1406,63 +1628,45 @@ def find_similar_tests(request, test_id):
                 "error": "You do not have permission to access this test"
             }, status=status.HTTP_403_FORBIDDEN)
         
-        # Get questions from the target test
-        test_questions = list(Question.objects.filter(
-            test_questions__test=test
-        ).values('id', 'question_text'))
-        
-        # Find other tests in the same course
-        other_tests = Test.objects.filter(course=course).exclude(pk=test_id)
+        # Signatures (question embeddings + centroid) of every test in the course
+        course_tests = Test.objects.filter(course=course)
+        signatures = similarity_service.get_test_signatures(course_tests)
+        test_signature = signatures.pop(test.id, None)
+        test_titles = dict(course_tests.exclude(pk=test_id).values_list('id', 'title'))
         
         similar_tests = []
         
-        # Compare with each other test
-        for other_test in other_tests:
-            other_test_questions = list(Question.objects.filter(
-                test_questions__test=other_test
-            ).values('id', 'question_text'))
-            
-            if not other_test_questions:
-                continue
+        # Compare with every other test at once; only those above the threshold come back
+        if test_signature:
+            ranked = similarity_service.rank_similar_tests(test_signature, signatures, threshold)
+        else:
+            ranked = []
+        
+        for other_test_id, similarity_result in ranked:
+            other_test_questions = signatures[other_test_id].questions
             
-            # Calculate similarity
-            similarity_result = similarity_service.compare_tests(
-                test1_questions=test_questions,
-                test2_questions=other_test_questions,
-                similarity_threshold=threshold
-            )
+            # Get the actual list of unique questions from test2 that appear in similar pairs
+            unique_test2_questions = set()
+            for pair in similarity_result['similar_question_pairs']:
+                if pair.get('test2_question_id'):
+                    unique_test2_questions.add(pair['test2_question_id'])
             
-            # Add to results if there's meaningful similarity
-            if similarity_result['overall_similarity'] > threshold:
-                # Get the actual list of unique questions from test1 and test2 that appear in similar pairs
-                unique_test1_questions = set()
-                unique_test2_questions = set()
-                
-                for pair in similarity_result['similar_question_pairs']:
-                    if pair.get('test1_question_id'):
-                        unique_test1_questions.add(pair['test1_question_id'])
-                    if pair.get('test2_question_id'):
-                        unique_test2_questions.add(pair['test2_question_id'])
-                
-                similar_tests.append({
-                    'test_id': other_test.id,
-                    'test_title': other_test.title,
-                    'similarity_score': similarity_result['overall_similarity'],
-                    'similar_question_count': len(unique_test2_questions),  # Count of unique questions in other test that have similarities
-                    'total_questions': len(other_test_questions),
-                    'question_coverage': len(unique_test2_questions) / len(other_test_questions) if len(other_test_questions) > 0 else 0
-                })
-        
-        # Sort by similarity (highest first)
-        similar_tests.sort(key=lambda x: x['similarity_score'], reverse=True)
+            similar_tests.append({
+                'test_id': other_test_id,
+                'test_title': test_titles.get(other_test_id),
+                'similarity_score': similarity_result['overall_similarity'],
+                'similar_question_count': len(unique_test2_questions),  # Count of unique questions in other test that have similarities
+                'total_questions': len(other_test_questions),
+                'question_coverage': len(unique_test2_questions) / len(other_test_questions) if len(other_test_questions) > 0 else 0
+            })
         
-        # Limit results
+        # Limit results (already sorted by similarity, highest first)
         similar_tests = similar_tests[:max_results]
         
         return Response({
             'test_id': test_id,
             'test_title': test.title,
-            'total_questions': len(test_questions),
+            'total_questions': len(test_signature.questions) if test_signature else 0,
             'similar_tests': similar_tests,
             'total_similar_tests': len(similar_tests)
         }, status=status.HTTP_200_OK)
@@ -1492,8 +1696,11 @@ def check_test_similarity_before_creation(request, course_id):
     """
     # Get parameters
     question_ids = request.data.get('question_ids', [])
-    threshold = float(request.data.get('threshold', 0.75))
-    max_results = int(request.data.get('max_results', 5))
+    try:
+        threshold = _number_param(request.data, 'threshold', 0.75, float, 0, 1)
+        max_results = _number_param(request.data, 'max_results', 5, int, 1)
+    except ValueError as e:
+        return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
     
     # Validate input
     if not question_ids:
@@ -1509,66 +1716,46 @@ def check_test_similarity_before_creation(request, course_id):
                 "error": "You do not have permission to access this course"
             }, status=status.HTTP_403_FORBIDDEN)
         
-        # Get the questions being considered for the new test
-        candidate_questions = list(Question.objects.filter(
-            id__in=question_ids
-        ).values('id', 'question_text'))
+        # Get the questions being considered for the new test, from stored embeddings
+        candidate_questions = Question.objects.filter(id__in=question_ids)
+        candidate_signature = similarity_service.signature_for_questions(candidate_questions)
         
-        # If some questions weren't found, note them
-        found_ids = [q['id'] for q in candidate_questions]
+        # If some questions weren't found, note them (questions without text are skipped silently)
+        found_ids = set(candidate_questions.values_list('id', flat=True))
         missing_ids = [qid for qid in question_ids if qid not in found_ids]
         
-        # Find all tests in the course
+        # Signatures of all tests in the course, compared in one batch
         existing_tests = Test.objects.filter(course=course)
+        signatures = similarity_service.get_test_signatures(existing_tests)
+        test_titles = dict(existing_tests.values_list('id', 'title'))
+        ranked = similarity_service.rank_similar_tests(candidate_signature, signatures, threshold)
         
         similar_tests = []
         
-        # Compare with each existing test
-        for existing_test in existing_tests:
-            existing_test_questions = list(Question.objects.filter(
-                test_questions__test=existing_test
-            ).values('id', 'question_text'))
-            
-            if not existing_test_questions:
-                continue
+        for existing_test_id, similarity_result in ranked:
+            existing_test_questions = signatures[existing_test_id].questions
             
-            # Calculate similarity
-            similarity_result = similarity_service.compare_tests(
-                test1_questions=candidate_questions,
-                test2_questions=existing_test_questions,
-                similarity_threshold=threshold
-            )
+            # Get the actual list of unique questions from the existing test that appear in similar pairs
+            unique_existing_questions = set()
+            for pair in similarity_result['similar_question_pairs']:
+                if pair.get('test2_question_id'):
+                    unique_existing_questions.add(pair['test2_question_id'])
             
-            # Add to results if there's meaningful similarity
-            if similarity_result['overall_similarity'] > threshold:
-                # Get the actual list of unique questions from both tests that appear in similar pairs
-                unique_candidate_questions = set()
-                unique_existing_questions = set()
-                
-                for pair in similarity_result['similar_question_pairs']:
-                    if pair.get('test1_question_id'):
-                        unique_candidate_questions.add(pair['test1_question_id'])
-                    if pair.get('test2_question_id'):
-                        unique_existing_questions.add(pair['test2_question_id'])
-                
-                similar_tests.append({
-                    'test_id': existing_test.id,
-                    'test_title': existing_test.title,
-                    'similarity_score': similarity_result['overall_similarity'],
-                    'similar_question_count': len(unique_existing_questions),  # Count of unique questions with similarities
-                    'total_questions_in_existing_test': len(existing_test_questions),
-                    'question_coverage': len(unique_existing_questions) / len(existing_test_questions) if len(existing_test_questions) > 0 else 0,
-                    'similar_question_pairs': similarity_result['similar_question_pairs'][:5]  # Limit number of pairs returned
-                })
-        
-        # Sort by similarity (highest first)
-        similar_tests.sort(key=lambda x: x['similarity_score'], reverse=True)
+            similar_tests.append({
+                'test_id': existing_test_id,
+                'test_title': test_titles.get(existing_test_id),
+                'similarity_score': similarity_result['overall_similarity'],
+                'similar_question_count': len(unique_existing_questions),  # Count of unique questions with similarities
+                'total_questions_in_existing_test': len(existing_test_questions),
+                'question_coverage': len(unique_existing_questions) / len(existing_test_questions) if len(existing_test_questions) > 0 else 0,
+                'similar_question_pairs': similarity_result['similar_question_pairs'][:5]  # Limit number of pairs returned
+            })
         
-        # Limit results
+        # Limit results (already sorted by similarity, highest first)
         similar_tests = similar_tests[:max_results]
         
         return Response({
-            'candidate_questions_count': len(candidate_questions),
+            'candidate_questions_count': len(found_ids),
             'missing_question_ids': missing_ids if missing_ids else None,
             'similar_tests': similar_tests,
             'total_similar_tests': len(similar_tests)
@@ -21,6 +21,14 @@ sentry_sdk.init(
     send_default_pii=True,
 )
 
+def env_flag(name, default=False):
+    """Boolean environment variable: "1", "true" or "yes" in any case is true."""
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes")
+
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -149,3 +157,70 @@ STATIC_URL = "static/"
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
 OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
+
+# Similarity search
+# Memory budget for the per-question-bank FAISS indexes kept in each worker
+SIMILARITY_INDEX_MEMORY_BUDGET_MB = int(os.environ.get("SIMILARITY_INDEX_MEMORY_BUDGET_MB", 512))
+# "cosine" (inner product over normalized embeddings) or the legacy "l2"
+SIMILARITY_METRIC = os.environ.get("SIMILARITY_METRIC", "cosine")
+# "flat" (exact), "hnsw", "ivfpq", or "auto" to choose by corpus size
+SIMILARITY_INDEX_BACKEND = os.environ.get("SIMILARITY_INDEX_BACKEND", "auto")
+SIMILARITY_HNSW_MIN_SIZE = int(os.environ.get("SIMILARITY_HNSW_MIN_SIZE", 50000))
+SIMILARITY_IVFPQ_MIN_SIZE = int(os.environ.get("SIMILARITY_IVFPQ_MIN_SIZE", 2000000))
+# HNSW graph degree and search breadth: higher = better recall, slower search
+SIMILARITY_HNSW_M = int(os.environ.get("SIMILARITY_HNSW_M", 32))
+SIMILARITY_HNSW_EF_CONSTRUCTION = int(os.environ.get("SIMILARITY_HNSW_EF_CONSTRUCTION", 200))
+SIMILARITY_HNSW_EF_SEARCH = int(os.environ.get("SIMILARITY_HNSW_EF_SEARCH", 128))
+# IVF-PQ inverted lists (0 = 4 * sqrt(n)), lists probed per query and sub-quantizers
+SIMILARITY_IVFPQ_NLIST = int(os.environ.get("SIMILARITY_IVFPQ_NLIST", 0))
+SIMILARITY_IVFPQ_NPROBE = int(os.environ.get("SIMILARITY_IVFPQ_NPROBE", 32))
+SIMILARITY_IVFPQ_M = int(os.environ.get("SIMILARITY_IVFPQ_M", 96))
+# IVF-PQ candidates fetched per requested result before exact re-scoring
+SIMILARITY_RERANK_FACTOR = int(os.environ.get("SIMILARITY_RERANK_FACTOR", 10))
+# Maximum candidate texts per batch similarity check request
+SIMILARITY_BATCH_MAX_TEXTS = int(os.environ.get("SIMILARITY_BATCH_MAX_TEXTS", 1000))
+# Embedding inference: "torch", "onnx" (ONNX Runtime) or "onnx-int8" (dynamically
+# quantized; both need `pip install optimum[onnxruntime]`). ONNX models are exported
+# on first use and cached in SIMILARITY_ONNX_CACHE_DIR
+SIMILARITY_INFERENCE_BACKEND = os.environ.get("SIMILARITY_INFERENCE_BACKEND", "torch")
+SIMILARITY_ONNX_CACHE_DIR = os.environ.get("SIMILARITY_ONNX_CACHE_DIR", str(BASE_DIR / "onnx_models"))
+# "avx2", "avx512", "avx512_vnni" or "arm64"; empty picks arm64 or avx2 by platform
+SIMILARITY_ONNX_QUANTIZATION = os.environ.get("SIMILARITY_ONNX_QUANTIZATION", "")
+# Embedding cache keyed by normalized-text hash: in-process LRU capacity (entries),
+# and whether ad-hoc texts (drafts, raw test comparisons) are also persisted to the DB
+EMBEDDING_CACHE_SIZE = int(os.environ.get("EMBEDDING_CACHE_SIZE", 20000))
+EMBEDDING_CACHE_DB = env_flag("EMBEDDING_CACHE_DB")
+
+# Embedding encoding
+# "host:port" or a Unix socket path of `manage.py run_embedding_server`;
+# empty encodes in the web process
+EMBEDDING_SERVICE_ADDRESS = os.environ.get("EMBEDDING_SERVICE_ADDRESS", "")
+# Seconds to wait for the embedding server's reply
+EMBEDDING_SERVICE_TIMEOUT = int(os.environ.get("EMBEDDING_SERVICE_TIMEOUT", 30))
+# Shared secret of the embedding server and the web processes; empty uses SECRET_KEY
+EMBEDDING_SERVICE_AUTHKEY = os.environ.get("EMBEDDING_SERVICE_AUTHKEY", "")
+# Model worker processes of the embedding server (one model copy each)
+EMBEDDING_WORKERS = int(os.environ.get("EMBEDDING_WORKERS", 2))
+# Micro-batching: encode requests arriving within this window are merged
+EMBEDDING_MAX_BATCH_SIZE = int(os.environ.get("EMBEDDING_MAX_BATCH_SIZE", 64))
+EMBEDDING_BATCH_WAIT_MS = int(os.environ.get("EMBEDDING_BATCH_WAIT_MS", 5))
+
+# Test result ingestion
+# Rows per INSERT/UPDATE statement when saving uploaded results and question statistics
+RESULTS_BULK_BATCH_SIZE = int(os.environ.get("RESULTS_BULK_BATCH_SIZE", 500))
+# Students read, scored and stored at a time; bounds the memory of an upload
+RESULTS_UPLOAD_CHUNK_SIZE = int(os.environ.get("RESULTS_UPLOAD_CHUNK_SIZE", 1000))
+# IRT calibration of uploaded results runs outside the request: "thread" runs it in a
+# thread pool of the web process, "worker" leaves it to `manage.py run_calibration_worker`
+CALIBRATION_EXECUTOR = os.environ.get("CALIBRATION_EXECUTOR", "thread")
+CALIBRATION_THREADS = int(os.environ.get("CALIBRATION_THREADS", 1))
+# What an upload recalibrates: "test" fits the uploaded test's results alone; "course"
+# refits every question of the course jointly on all its results (statistics["pooled"])
+CALIBRATION_SCOPE = os.environ.get("CALIBRATION_SCOPE", "test")
+# Candidate IRT models, the fitted one with the lowest criterion ("aic" or "bic") is kept
+IRT_MODELS = [m.strip() for m in os.environ.get("IRT_MODELS", "1PL,2PL,3PL").split(",") if m.strip()]
+IRT_SELECTION_CRITERION = os.environ.get("IRT_SELECTION_CRITERION", "bic")
+# Reuse stored fits of identical response matrices instead of refitting
+IRT_FIT_CACHE = env_flag("IRT_FIT_CACHE", True)
+# Student abilities stored after each calibration: "eap" (posterior mean) or "mle"
+IRT_ABILITY_METHOD = os.environ.get("IRT_ABILITY_METHOD", "eap")